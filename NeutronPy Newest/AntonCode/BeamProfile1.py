@@ -1,12 +1,17 @@
 import numpy as np
-from scipy.interpolate import interp1d
+from scipy.interpolate import CubicSpline
 
 #---------------------------------------------------------------------------------
 # Function approximating pulse shape (See Hasemi publication for NOBORU pulse
 # Time is the time of the pulse relative to t0 (us) and E is energy of the neutron in eV
+# Time and E can be scalars or arrays, they are broadcast against each other
+# (e.g. Time of shape (N, M) with E of shape (N, 1) gives M time points for each of N energies)
 #---------------------------------------------------------------------------------
 def BeamPulseShape(Time, E): 
 
+    Time = np.asarray(Time, dtype=float)
+    E = np.asarray(E, dtype=float)
+
     C = 8.03e18 * np.exp((-8.21*pow(E, 0.0542)))
     to = 2.27e-2 + 2.03 * pow(E, -0.46)
     gamma1 = 2.95e-2 + 0.905 * pow(E, 0.343)
@@ -15,23 +20,19 @@ def BeamPulseShape(Time, E):
     sigma2 = 3.15e-2 + 1.71 * pow(E, -0.476);
     R = 0.404 - 0.29 * np.exp(-2.78e-4 * E)
 
-    if(Time < to):
-        F1 = np.exp((-0.5*((Time-to)**2)/(sigma1**2)))
-        F2 = F1
-    else :
-        if Time < to+gamma1*(sigma2**2): 
-            F1 = np.exp((-0.5*((Time-to)**2)/(sigma2**2)))
-        else:
-            F1 = np.exp((0.5*(gamma1**2)*(sigma2**2) - gamma1*(Time-to)))
-            
-        if Time < to+gamma2*(sigma2**2):
-            F2 = np.exp((-0.5*((Time-to)**2)/(sigma2**2)))
-        else:
-            F2 = np.exp((0.5*(gamma2**2)*(sigma2**2) - gamma2*(Time-to)))
+    # the piecewise regions become masks, every branch is evaluated everywhere and the right one picked
+    Rising = Time < to
+    Gauss2 = np.exp((-0.5*((Time-to)**2)/(sigma2**2)))
+    with np.errstate(over='ignore'):  # exponential tails are only used where Time >= to, they can overflow before it
+        F1 = np.where(Time < to+gamma1*(sigma2**2), Gauss2, np.exp((0.5*(gamma1**2)*(sigma2**2) - gamma1*(Time-to))))
+        F2 = np.where(Time < to+gamma2*(sigma2**2), Gauss2, np.exp((0.5*(gamma2**2)*(sigma2**2) - gamma2*(Time-to))))
+    Gauss1 = np.exp((-0.5*((Time-to)**2)/(sigma1**2)))
+    F1 = np.where(Rising, Gauss1, F1)
+    F2 = np.where(Rising, Gauss1, F2)
 
     F = C * ( (1-R)*F1 + R*F2)
 
-    return F
+    return F[()]  # plain float for scalar inputs
 
 # ---------------------------------------------------------------------------------------
 # Calculates Beam profile width in us
@@ -47,40 +48,71 @@ def BeamProfileWidth(E) :
     Tmax = np.exp(Tmax)
     return Tmax
 
+#---------------------------------------------------------------------------------
+# Calculates the pulse shapes from the moderator for a whole array of energies at once
+# Can be two pulses with gap between them
+# ProtonPulseGap - us, Earr - array of energies in eV, iBmProfDim - number of time points per profile
+# Returns (T, BmProf), both of shape (len(Earr), iBmProfDim): for every energy the time values (us)
+# relative to T0 and the beam profile normalized to unity
+#---------------------------------------------------------------------------------
+def BeamProfileArraysCalculated(ProtonPulseGap, Earr, iBmProfDim) :
+
+    Earr = np.atleast_1d(np.asarray(Earr, dtype=float))
+
+    # Tmax is the width of beam pulse
+    Tmax = BeamProfileWidth (Earr)
+
+    Tstep = Tmax / iBmProfDim   # time step of the arrays to be calculated
+    T = Tstep[:, np.newaxis] * np.arange(iBmProfDim)
+
+    #calculate the single pulse shapes here
+    BmProf_Pulse1 = BeamPulseShape(T, Earr[:, np.newaxis])
+
+    BmProf = AddSecondPulse(ProtonPulseGap, T, BmProf_Pulse1)
+
+    return T, BmProf
+
+#---------------------------------------------------------------------------------
+# Adds the second pulse, delayed by ProtonPulseGap (us), to the single pulse shapes BmProf_Pulse1
+# T, BmProf_Pulse1 - (energies x iBmProfDim) arrays as calculated in BeamProfileArraysCalculated,
+# every row of T has to start at 0 with a constant time step
+# Returns the two pulse profiles normalized to unity
+#---------------------------------------------------------------------------------
+def AddSecondPulse(ProtonPulseGap, T, BmProf_Pulse1) :
+
+    iBmProfDim = T.shape[1]
+    Tstep = T[:, 1]
+
+    #interpolate the Shape of one pulse for the second pulse: same not-a-knot cubic spline as
+    #interp1d(T, BmProf_Pulse1, kind='cubic'), built for all the rows at once in units of the time step
+    Spline = CubicSpline(np.arange(iBmProfDim), BmProf_Pulse1, axis=1)
+    Second = T > ProtonPulseGap
+    Row, Col = np.nonzero(Second)
+    u = (T[Row, Col] - ProtonPulseGap) / Tstep[Row]  # delayed time in units of the time step
+    k = np.clip(np.floor(u).astype(int), 0, iBmProfDim - 2)
+    dx = u - k
+    Coef = Spline.c[:, k, Row]
+    BmProf_Pulse2 = ((Coef[0] * dx + Coef[1]) * dx + Coef[2]) * dx + Coef[3]
+
+    #add the second pulse to the first one after ProtonPulseGap delay
+    BmProf = np.array(BmProf_Pulse1, dtype=float)
+    BmProf[Row, Col] += BmProf_Pulse2
+
+    #normalize the BeamPulse shapes to unity
+    BmProf /= np.sum(BmProf, axis=1, keepdims=True)
+
+    return BmProf
+
 #---------------------------------------------------------------------------------
 # Calculates the pulse shape from the moderator. Can be two pulses with gap between them
 # ProtonPulseGap - us, E in eV, 
 # T - (us) array to be filled in of time values for which beam profile to be calculated, relative to T0
 # BmProf - array to be filled in, iBmProfDim - size of the arrays
 # Time is the time of the pulse relative to t0 (us) and E is energy of the neutron in eV
+# (single energy version of BeamProfileArraysCalculated)
 #---------------------------------------------------------------------------------
 def BeamProfileArrayCalculated(ProtonPulseGap, E, T, BmProf, iBmProfDim) :
-    
-    # Tmax is the width of beam pulse
-    Tmax = BeamProfileWidth (E)
-
-    Tstep = Tmax / iBmProfDim   # time step of the array to be calculated
-    
-    BmProf_Pulse1 = np.zeros(iBmProfDim)
-
-    # fill in T array of times
-    for i in range(iBmProfDim):
-        T[i] = Tstep * i
-    
-    #calculate the single pulse shape here
-    for i in range(iBmProfDim):
-        BmProf_Pulse1[i]  = BeamPulseShape( T[i], E)
-
-    #interpolate the Shape of one pulse for the second pulse
-    BmProf_Pulse2 =  interp1d(T, BmProf_Pulse1, kind='cubic')
-    
-    #add the second pulse to the first one after ProtonPulseGap delay
-    for i in range(iBmProfDim):
-        if T[i] > ProtonPulseGap:
-            BmProf[i] = BmProf_Pulse1[i] + BmProf_Pulse2(T[i]-ProtonPulseGap)
-        else:
-            BmProf[i] = BmProf_Pulse1[i]
-            
-    #normalize the BeamPulse shape to unity
-    sum = np.sum(BmProf)
-    BmProf /= sum
+
+    T1, BmProf1 = BeamProfileArraysCalculated(ProtonPulseGap, [E], iBmProfDim)
+    T[:iBmProfDim] = T1[0]
+    BmProf[:iBmProfDim] = BmProf1[0]
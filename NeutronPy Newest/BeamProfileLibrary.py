@@ -0,0 +1,110 @@
+#---------------------------------------------------------------------------------
+# Precomputed beam profile kernels
+# The NOBORU beam profiles (AntonCode/BeamProfile1.py) only depend on the energy, the proton pulse gap
+# and the number of time points BEAM_ARR_DIM. The single pulse shape, sampled at the BEAM_ARR_DIM time
+# points, is tabulated once on a fixed log-spaced energy grid and interpolated between the two neighbouring
+# grid points of any energy. The second pulse is added afterwards for the exact energy: which time points
+# it reaches jumps with the energy, so it cannot be interpolated between table rows.
+# Tables are saved as .npy files named after (energy grid, BEAM_ARR_DIM), so the GUI, the fitting
+# routines and worker processes all load the same table instead of recomputing it, whatever the pulse gap.
+#---------------------------------------------------------------------------------
+import hashlib
+import os
+import tempfile
+from os import path
+import numpy as np
+from AntonCode import BeamProfile1 as bm
+
+BEAM_PROFILE_DIR = path.join(path.dirname(path.realpath(__file__)), 'AntonCode', 'BeamProfiles')
+
+# default energy grid (eV) of the tables, wide enough for any beamline setting
+TABLE_E_MIN = 1e-4
+TABLE_E_MAX = 1e6
+TABLE_POINTS_PER_DECADE = 1000
+
+
+#---------------------------------------------------------------------------------
+# Saves Array as the .npy file FileName so that no process ever sees it half written
+# Every writer uses its own temporary file in the same directory and renames it over FileName. Several
+# processes may build the same table at once (e.g. pool workers on first use): they all write the same
+# values, so when the rename fails because another process holds the file, the table is there already
+#---------------------------------------------------------------------------------
+def SaveTable(FileName, Array):
+    Dir = path.dirname(FileName)
+    os.makedirs(Dir, exist_ok=True)
+    Handle, TmpName = tempfile.mkstemp(dir=Dir, suffix='.npy')
+    try:
+        with os.fdopen(Handle, 'wb') as FILE:
+            np.save(FILE, Array)
+        os.replace(TmpName, FileName)
+    except OSError:
+        if not path.isfile(FileName):
+            raise
+    finally:
+        if path.isfile(TmpName):
+            os.remove(TmpName)
+
+
+class BeamProfileTable:
+    def __init__(self, BEAM_ARR_DIM, Emin=TABLE_E_MIN, Emax=TABLE_E_MAX,
+                 PointsPerDecade=TABLE_POINTS_PER_DECADE, CacheDir=BEAM_PROFILE_DIR):
+        '''
+        Loads the table for BEAM_ARR_DIM from CacheDir, or calculates and saves it
+        CacheDir = None keeps the table in memory only
+        '''
+        self.BEAM_ARR_DIM = BEAM_ARR_DIM
+        self.LogEmin = np.log10(Emin)
+        self.PointsPerDecade = PointsPerDecade
+        Npoints = int(round((np.log10(Emax) - self.LogEmin) * PointsPerDecade)) + 1
+        self.Earr = 10 ** (self.LogEmin + np.arange(Npoints) / PointsPerDecade)
+
+        FileName = None
+        if CacheDir is not None:
+            FileName = path.join(CacheDir, 'BeamProfiles_' + self.Key() + '.npy')
+        if FileName is not None and path.isfile(FileName):
+            self.Amp = np.load(FileName, mmap_mode='r')
+        else:
+            Tstep = bm.BeamProfileWidth(self.Earr) / BEAM_ARR_DIM
+            T = Tstep[:, np.newaxis] * np.arange(BEAM_ARR_DIM)
+            Pulse1 = bm.BeamPulseShape(T, self.Earr[:, np.newaxis])
+            # rows are normalized, shapes interpolate better than amplitudes changing by orders of magnitude
+            self.Amp = Pulse1 / np.sum(Pulse1, axis=1, keepdims=True)
+            if FileName is not None:
+                SaveTable(FileName, self.Amp)
+
+    def Key(self):
+        Grid = np.ascontiguousarray(self.Earr, dtype=np.float64).tobytes()
+        Settings = repr(int(self.BEAM_ARR_DIM)).encode()
+        return hashlib.sha1(Grid + Settings).hexdigest()
+
+    def Covers(self, Earr):
+        return np.min(Earr) >= self.Earr[0] and np.max(Earr) <= self.Earr[-1]
+
+    def Kernels(self, ProtonPulseGap, Earr):
+        '''
+        Beam profiles of the energies Earr (eV), the single pulse interpolated linearly in log(E) between
+        the table rows, the second pulse after ProtonPulseGap (us) added for the exact energies
+        Returns (BeamProfile_T, BeamProfile_Amp) of shape (len(Earr), BEAM_ARR_DIM), like
+        BeamProfile1.BeamProfileArraysCalculated
+        '''
+        Earr = np.atleast_1d(np.asarray(Earr, dtype=float))
+        if not self.Covers(Earr):
+            raise Exception("Energies outside of the beam profile table [{0}, {1}] eV".format(self.Earr[0], self.Earr[-1]))
+
+        u = (np.log10(Earr) - self.LogEmin) * self.PointsPerDecade
+        k = np.clip(np.floor(u).astype(int), 0, len(self.Earr) - 2)
+        w = (u - k)[:, np.newaxis]
+        Pulse1 = (1 - w) * self.Amp[k] + w * self.Amp[k + 1]
+
+        Tstep = bm.BeamProfileWidth(Earr) / self.BEAM_ARR_DIM
+        T = Tstep[:, np.newaxis] * np.arange(self.BEAM_ARR_DIM)
+        return T, bm.AddSecondPulse(ProtonPulseGap, T, Pulse1)
+
+
+# tables already loaded by this process, key is BEAM_ARR_DIM
+_Tables = {}
+
+def GetBeamProfileTable(BEAM_ARR_DIM):
+    if BEAM_ARR_DIM not in _Tables:
+        _Tables[BEAM_ARR_DIM] = BeamProfileTable(BEAM_ARR_DIM)
+    return _Tables[BEAM_ARR_DIM]
@@ -0,0 +1,279 @@
+#---------------------------------------------------------------------------------
+# Binary cross section library
+# All the cross section text files of AntonCode/CrossSections_BeamProfiles are compiled once into a single
+# .npy file holding a (2, N) float64 array: row 0 is the energy in eV, row 1 the cross section in barns,
+# the isotopes being stored one after the other. A .json index next to it keeps, for every isotope,
+# its offset and length in that array together with the size and modification time of its source file.
+# The library is opened memory-mapped and read-only, so loading any set of isotopes only touches the
+# pages actually used and the same file can be shared by many worker processes.
+#---------------------------------------------------------------------------------
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from os import listdir, path
+import numpy as np
+import pandas as pd
+
+CROSS_SECTION_DIR = path.join(path.dirname(path.realpath(__file__)), 'AntonCode', 'CrossSections_BeamProfiles')
+LIBRARY_FILE = path.join(path.dirname(path.realpath(__file__)), 'AntonCode', 'CrossSections.npy')
+
+
+#---------------------------------------------------------------------------------
+# Only tables with the energy in MeV in the first column are cross sections
+# (the same directory also holds beam profiles tabulated in time)
+# The first column header is the first tab separated field, it can contain spaces, e.g. "E (MeV)" of Na-23
+#---------------------------------------------------------------------------------
+def IsCrossSectionFile(FileName):
+    if not FileName.endswith('.txt'):
+        return False
+    with open(FileName) as FILE:
+        header = FILE.readline()
+    return header.split('\t')[0].find('MeV') != -1
+
+
+#---------------------------------------------------------------------------------
+# Reads one cross section text file, returns energy (eV) and cross section (barns) arrays
+# sorted by energy and without duplicate energies (first one is kept, like drop_duplicates)
+# Columns are separated by tabs in most files, by spaces in a few (e.g. Au-197)
+#---------------------------------------------------------------------------------
+def ReadCrossSectionFile(FileName):
+    S1 = pd.read_table(FileName, sep=r'\s+', header=None, skiprows=1, usecols=[0, 1])
+    Earr = pd.to_numeric(S1[S1.columns[0]], errors='coerce').to_numpy(dtype=float) * 1e6
+    Sarr = pd.to_numeric(S1[S1.columns[1]], errors='coerce').to_numpy(dtype=float)
+    good = ~(np.isnan(Earr) | np.isnan(Sarr))
+    Earr = Earr[good]
+    Sarr = Sarr[good]
+
+    # np.unique returns the first occurrence of every energy, already sorted
+    Earr, first = np.unique(Earr, return_index=True)
+    return Earr, Sarr[first]
+
+
+#---------------------------------------------------------------------------------
+# Binary search for the part of a sorted energy array Earr needed for [Emin, Emax] (eV)
+# Like the old selection it keeps one point below Emin and the first point above Emax,
+# so interpolation is defined over the whole interval. Returns the slice [start, stop)
+#---------------------------------------------------------------------------------
+def CrossSectionWindow(Earr, Emin, Emax):
+    ind1 = np.searchsorted(Earr, Emin, side='right')  # first index where E exceeds Emin
+    ind2 = np.searchsorted(Earr, Emax, side='right')  # first index where E exceeds Emax
+    return max(ind1 - 1, 0), min(ind2 + 1, len(Earr))
+
+
+def IndexFileName(LibraryFile):
+    return path.splitext(LibraryFile)[0] + '.json'
+
+
+#---------------------------------------------------------------------------------
+# Compiles SourceDir into LibraryFile. Only isotopes whose source file is new or changed
+# (size or modification time) are parsed again, the others are copied from the existing library.
+# Nothing is written if no file changed. Returns the index dictionary.
+#---------------------------------------------------------------------------------
+def CompileCrossSectionLibrary(SourceDir=CROSS_SECTION_DIR, LibraryFile=LIBRARY_FILE):
+    IndexFile = IndexFileName(LibraryFile)
+
+    OldIndex = {}
+    OldData = None
+    if path.isfile(IndexFile) and path.isfile(LibraryFile):
+        with open(IndexFile) as FILE:
+            OldIndex = json.load(FILE)
+        OldData = np.load(LibraryFile, mmap_mode='r')
+
+    Sources = {}
+    Skipped = []
+    for FileName in sorted(listdir(SourceDir)):
+        FullName = path.join(SourceDir, FileName)
+        if not path.isfile(FullName):
+            continue
+        if not IsCrossSectionFile(FullName):
+            Skipped.append(FileName)
+            continue
+        st = os.stat(FullName)
+        Sources[FileName[:-len('.txt')]] = (FullName, st.st_size, st.st_mtime_ns)
+
+    def unchanged(Name):
+        entry = OldIndex.get(Name)
+        return entry is not None and entry['size'] == Sources[Name][1] and entry['mtime_ns'] == Sources[Name][2]
+
+    if OldData is not None and set(OldIndex) == set(Sources) and all(unchanged(Name) for Name in Sources):
+        return OldIndex
+
+    # only reported when the library is rebuilt, not on every open
+    for FileName in Skipped:
+        print('Skipping', FileName, '- not a cross section table (no energy in MeV in the first column)')
+    Tables = {}
+    for Name, (FullName, size, mtime_ns) in Sources.items():
+        if OldData is not None and unchanged(Name):
+            entry = OldIndex[Name]
+            Tables[Name] = np.array(OldData[:, entry['offset']:entry['offset'] + entry['length']])
+        else:
+            print('Compiling cross section', Name)
+            Tables[Name] = np.vstack(ReadCrossSectionFile(FullName))
+
+    Index = {}
+    offset = 0
+    for Name, (FullName, size, mtime_ns) in Sources.items():
+        length = Tables[Name].shape[1]
+        Index[Name] = {'offset': offset, 'length': length, 'size': size, 'mtime_ns': mtime_ns}
+        offset += length
+
+    # write into temporary files and swap them in, processes which still map the old library keep reading it
+    # every process has its own temporary files, several of them may find the library out of date at once
+    del OldData
+    def WriteLibrary(TmpName):
+        Data = np.lib.format.open_memmap(TmpName, mode='w+', dtype=np.float64, shape=(2, offset))
+        for Name, entry in Index.items():
+            Data[:, entry['offset']:entry['offset'] + entry['length']] = Tables[Name]
+        Data.flush()
+        del Data
+    ReplaceFile(LibraryFile, WriteLibrary, '.npy')
+    def WriteIndex(TmpName):
+        with open(TmpName, 'w') as FILE:
+            json.dump(Index, FILE, indent=1)
+    ReplaceFile(IndexFile, WriteIndex, '.json')
+
+    return Index
+
+
+#---------------------------------------------------------------------------------
+# Writes FileName through a temporary file of its own in the same directory and renames it over FileName
+# Write(TmpName) writes the content into the temporary file TmpName. Processes compiling the same
+# sources write the same content, so when the rename fails because another process holds FileName
+# (Windows), FileName is already up to date
+#---------------------------------------------------------------------------------
+def ReplaceFile(FileName, Write, Suffix):
+    Handle, TmpName = tempfile.mkstemp(dir=path.dirname(path.abspath(FileName)), suffix=Suffix)
+    try:
+        os.close(Handle)
+        Write(TmpName)
+        os.replace(TmpName, FileName)
+    except OSError:
+        if not path.isfile(FileName):
+            raise
+    finally:
+        if path.isfile(TmpName):
+            os.remove(TmpName)
+
+
+class CrossSectionLibrary:
+    def __init__(self, LibraryFile=LIBRARY_FILE, SourceDir=CROSS_SECTION_DIR, Compile=True):
+        '''
+        Opens the compiled library read-only and memory-mapped
+        Compile - bring the library up to date with SourceDir first (only costs a stat per file when nothing changed)
+        '''
+        if Compile:
+            self.Index = CompileCrossSectionLibrary(SourceDir, LibraryFile)
+        else:
+            with open(IndexFileName(LibraryFile)) as FILE:
+                self.Index = json.load(FILE)
+        self.LibraryFile = LibraryFile
+        self.Data = np.load(LibraryFile, mmap_mode='r')
+
+    def __contains__(self, IsotopeName):
+        return IsotopeName in self.Index
+
+    def Names(self):
+        return list(self.Index)
+
+    def Get(self, IsotopeName):
+        # energy (eV) and cross section (barns) of one isotope, read-only views into the mapped file
+        if IsotopeName not in self.Index:
+            raise Exception("Cross section {0} is not in the library {1}".format(IsotopeName, self.LibraryFile))
+        entry = self.Index[IsotopeName]
+        Table = self.Data[:, entry['offset']:entry['offset'] + entry['length']]
+        return Table[0], Table[1]
+
+    def GetWindow(self, IsotopeName, Emin, Emax):
+        # same as Get, cut to [Emin, Emax] (eV) by binary search; still views, nothing is copied
+        Earr, Sarr = self.Get(IsotopeName)
+        start, stop = CrossSectionWindow(Earr, Emin, Emax)
+        return Earr[start:stop], Sarr[start:stop]
+
+    def GetWindows(self, IsotopeNames, Emin, Emax):
+        # batch version of GetWindow, cuts all the isotopes to the same energy interval
+        # returns a dictionary IsotopeName -> (Earr, Sarr)
+        return {Name: self.GetWindow(Name, Emin, Emax) for Name in IsotopeNames}
+
+
+# one library per process, opened on first use
+_Library = None
+
+def GetCrossSectionLibrary():
+    global _Library
+    if _Library is None:
+        _Library = CrossSectionLibrary()
+    return _Library
+
+
+#---------------------------------------------------------------------------------
+# Cache of cross sections already resampled onto an energy grid
+# Theory evaluations call every isotope's interpolation on the same Get_E_Array_Properly_Spaced grid
+# again and again (fitting loops, GUI edits); here each (isotope, grid) pair is interpolated only once.
+# MaxBytes - memory bound, the least recently used entries are dropped first
+# CacheDir - optional directory where resampled arrays are also saved as .npy and reloaded from
+#---------------------------------------------------------------------------------
+class ResampledCrossSections:
+    def __init__(self, MaxBytes=256 * 2**20, CacheDir=None):
+        self.MaxBytes = MaxBytes
+        self.CacheDir = CacheDir
+        self.Entries = OrderedDict()  # (IsotopeName, GridHash) -> resampled cross section
+        self.Bytes = 0
+        if CacheDir is not None and not path.isdir(CacheDir):
+            os.makedirs(CacheDir)
+
+    @staticmethod
+    def GridHash(Earr):
+        Earr = np.ascontiguousarray(Earr, dtype=np.float64)
+        return hashlib.sha1(Earr.tobytes()).hexdigest()
+
+    def DiskName(self, IsotopeName, GridHash):
+        # the source file size and mtime are part of the name, so recompiled tables never hit an old file
+        entry = GetCrossSectionLibrary().Index.get(IsotopeName, {})
+        Source = '{0}_{1}'.format(entry.get('size', 0), entry.get('mtime_ns', 0))
+        Key = hashlib.sha1((IsotopeName + Source + GridHash).encode()).hexdigest()
+        return path.join(self.CacheDir, IsotopeName + '_' + Key + '.npy')
+
+    def Get(self, IsotopeName, Earr, CrossSection=None):
+        '''
+        Cross section of IsotopeName on the grid Earr (eV), as a read-only array
+        CrossSection - function used on a miss, by default the linear interpolation of the library table
+        '''
+        Key = (IsotopeName, self.GridHash(Earr))
+        if Key in self.Entries:
+            self.Entries.move_to_end(Key)
+            return self.Entries[Key]
+
+        Sigma = None
+        if self.CacheDir is not None and path.isfile(self.DiskName(*Key)):
+            Sigma = np.load(self.DiskName(*Key))
+        if Sigma is None:
+            if CrossSection is None:
+                Etable, Stable = GetCrossSectionLibrary().Get(IsotopeName)
+                Sigma = np.interp(Earr, Etable, Stable)
+            else:
+                Sigma = np.asarray(CrossSection(Earr), dtype=np.float64)
+            if self.CacheDir is not None:
+                np.save(self.DiskName(*Key), Sigma)
+
+        Sigma.setflags(write=False)
+        self.Entries[Key] = Sigma
+        self.Bytes += Sigma.nbytes
+        while self.Bytes > self.MaxBytes and len(self.Entries) > 1:
+            OldKey, Old = self.Entries.popitem(last=False)
+            self.Bytes -= Old.nbytes
+        return Sigma
+
+    def Clear(self):
+        self.Entries.clear()
+        self.Bytes = 0
+
+
+_Resampled = None
+
+def GetResampledCrossSections():
+    global _Resampled
+    if _Resampled is None:
+        _Resampled = ResampledCrossSections()
+    return _Resampled
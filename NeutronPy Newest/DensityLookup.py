@@ -0,0 +1,126 @@
+#---------------------------------------------------------------------------------
+# Thickness sweep lookup tables for fast per-pixel density maps
+# For every material of the table (a group of Par['Elmnts'] in 'Thickness' mode, an isotope in 'Isotope' mode,
+# see TransmissionCalc.DensityParametrization) the transmission at the experimental TOF points is calculated
+# once for a dense sweep of that material's parameter, all the other materials staying at their table values
+# (the known matrix). More material only ever lowers the transmission, so the mean transmission over a window
+# of TOF points is monotonic along the sweep. The window is where the sweep changes the transmission the most,
+# i.e. around the resonances of that material. A pixel is then inverted by one np.interp of its own window
+# mean in that table instead of a nonlinear fit, which is a whole detector in a fraction of a second.
+# Tables are saved as compressed .npz files (float32 curves), so they are built once per sample and setting.
+#---------------------------------------------------------------------------------
+import numpy as np
+import TransmissionCalc as tr
+
+
+class ThicknessSweepTable:
+    def __init__(self, Labels, Sweeps, Curves, Windows, Texp, ExpIndex):
+        '''
+        Labels - name of every material (parameter of DensityParametrization)
+        Sweeps - (materials x Nsweep) swept values of every material's parameter, ascending
+        Curves - (materials x Nsweep x points) transmission at the experimental points Texp
+        Windows - list of the indices (into Texp) of the window of every material
+        Texp - selected experimental TOF values, ExpIndex - their indices in the full TOF array of the data
+        '''
+        self.Labels = list(Labels)
+        self.Sweeps = np.asarray(Sweeps, dtype=float)
+        self.Curves = np.asarray(Curves)
+        self.Windows = [np.asarray(Window, dtype=int) for Window in Windows]
+        self.Texp = np.asarray(Texp, dtype=float)
+        self.ExpIndex = np.asarray(ExpIndex, dtype=int)
+        # mean transmission of the window along the sweep, descending
+        self.Signals = np.array([self.Curves[k][:, Window].mean(axis=1, dtype=float) for k, Window in enumerate(self.Windows)])
+
+    def WindowRanges(self):
+        # (number of points, first TOF, last TOF) of the window of every material
+        return [(len(Window), self.Texp[Window[0]], self.Texp[Window[-1]]) for Window in self.Windows]
+
+    def MaterialIndex(self, Material):
+        # Material - position in Labels or the label itself
+        if isinstance(Material, str):
+            if Material not in self.Labels:
+                raise Exception("Material {0} is not in the lookup table, it has {1}".format(Material, self.Labels))
+            return self.Labels.index(Material)
+        return int(Material)
+
+    def WindowTransmission(self, Material, TrCube):
+        '''
+        Mean transmission over the window of Material of every pixel
+        TrCube - transmission of the full TOF array of the data with the TOF first, (slices x ...) like the image
+                 cube, either an array or a list of 2D slices; only the slices of the window are read
+        '''
+        Slices = self.ExpIndex[self.Windows[self.MaterialIndex(Material)]]
+        Sum = np.zeros(np.shape(TrCube[Slices[0]]))
+        for i in Slices:
+            Sum += TrCube[i]
+        return Sum / len(Slices)
+
+    def Invert(self, Material, TrCube):
+        '''
+        Parameter of Material (thickness in um or areal density, as in DensityParametrization) for every pixel
+        of TrCube (see WindowTransmission); pixels outside of the swept range are np.nan
+        '''
+        k = self.MaterialIndex(Material)
+        Signal = self.WindowTransmission(k, TrCube)
+        # np.interp needs the table ascending, the signal goes down with the parameter
+        return np.interp(Signal, self.Signals[k][::-1], self.Sweeps[k][::-1], left=np.nan, right=np.nan)
+
+    def Save(self, FileName):
+        np.savez_compressed(FileName, Labels=np.array(self.Labels), Sweeps=self.Sweeps,
+                            Curves=self.Curves.astype(np.float32), Texp=self.Texp, ExpIndex=self.ExpIndex,
+                            WindowSizes=[len(Window) for Window in self.Windows],
+                            Windows=np.concatenate(self.Windows))
+
+    @classmethod
+    def Load(cls, FileName):
+        with np.load(FileName) as Data:
+            Windows = np.split(Data['Windows'], np.cumsum(Data['WindowSizes'])[:-1])
+            return cls([str(Label) for Label in Data['Labels']], Data['Sweeps'], Data['Curves'], Windows, Data['Texp'], Data['ExpIndex'])
+
+
+#---------------------------------------------------------------------------------
+# Builds the thickness sweep table of every material of Par['Elmnts']
+# Texp - measured TOF (us, without the trigger delay) of the data the table will be used on
+# EarrIdeal - energy grid of the ideal transmission, S - cross sections (LoadCrossSectionsData)
+# Mode - 'Thickness' or 'Isotope', see TransmissionCalc.DensityParametrization
+# Nsweep - number of values of every sweep, from 0 to MaxFactor times the table value
+# WindowFraction - the window of a material is the TOF points where the sweep changes the transmission by
+#                  at least WindowFraction of its largest change
+# The model is the one of FitArealDensities (resolution matrix at the L and dT of Par), its TOF grid refined
+# for the table values and the thickest end of every sweep. EarrIdeal has to resolve the resonances at the
+# thickest end of the sweep too: Get_E_Array_Adaptive of a Par with MaxFactor times the thicknesses is a safe choice
+# ProgressCallback - optional function called as ProgressCallback(done, total) after every material
+# Returns a ThicknessSweepTable (WindowRanges gives the TOF range of every window);
+# raises ValueError when no experimental point is inside of the model range or a sweep changes nothing
+#---------------------------------------------------------------------------------
+def BuildThicknessSweepTable(Par, Texp, EarrIdeal, S, Mode='Thickness', Nsweep=256, MaxFactor=4.0,
+                             WindowFraction=0.5, BEAM_ARR_DIM=tr.BEAM_ARR_DIM, NsubCells=tr.NsubCells, ProgressCallback=None):
+    Elem = Par['Elmnts']
+    Labels, D, p0 = tr.DensityParametrization(Elem, Mode)
+    if np.any(p0 <= 0):
+        raise Exception("Every material needs a positive value in the table to set its sweep range, got {0}".format(p0))
+    SigmaMatrix = tr.BuildCrossSectionMatrix(S, list(Elem['Isotope Name']), EarrIdeal)
+    G = D @ SigmaMatrix
+    Thickest = p0 + (MaxFactor - 1) * np.diag(p0)
+    TrTrial = tr.CalcIdealTransmissionMatrix(G, np.vstack((np.outer(tr.TrialFactors, p0), Thickest)))
+    R, ExpMask = tr.GetResolutionMatrixCache().Get(Par, EarrIdeal, Texp, BEAM_ARR_DIM, NsubCells, TrTrial)
+    if R.shape[0] == 0:
+        raise ValueError("None of the experimental points is inside of the TOF range of the model")
+
+    Sweeps = np.empty((len(p0), Nsweep))
+    Curves = np.empty((len(p0), Nsweep, R.shape[0]), dtype=np.float32)
+    Windows = []
+    for k in range(len(p0)):
+        Sweeps[k] = np.linspace(0, MaxFactor * p0[k], Nsweep)
+        P = np.tile(p0, (Nsweep, 1))
+        P[:, k] = Sweeps[k]
+        # (points x Nsweep), one sparse product for the whole sweep
+        Curves[k] = (R @ tr.CalcIdealTransmissionMatrix(G, P).T).T
+        Change = Curves[k][0] - Curves[k][-1]
+        if not np.max(Change) > 0:
+            raise ValueError("The sweep of {0} does not change the transmission at any of the experimental points".format(Labels[k]))
+        Windows.append(np.flatnonzero(Change >= WindowFraction * np.max(Change)))
+        if ProgressCallback is not None:
+            ProgressCallback(k + 1, len(p0))
+
+    return ThicknessSweepTable(Labels, Sweeps, Curves, Windows, Texp[ExpMask], np.flatnonzero(ExpMask))
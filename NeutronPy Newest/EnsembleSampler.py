@@ -0,0 +1,172 @@
+#---------------------------------------------------------------------------------
+# Affine-invariant ensemble MCMC sampler (Goodman & Weare stretch move), written with NumPy only
+# The walkers are split in two halves which are moved in turn, each half against the other one, so the
+# log probability is always called for a whole half-ensemble at once: LogProb gets a (walkers x parameters)
+# array and returns one value per walker. For the transmission model this turns into one sparse
+# matrix-matrix product per half step (see SampleArealDensities).
+#---------------------------------------------------------------------------------
+from os import path
+import numpy as np
+import TransmissionCalc as tr
+
+
+class EnsembleSampler:
+    def __init__(self, LogProb, Nwalkers, Ndim, StretchA=2.0, Seed=None):
+        '''
+        LogProb - function of a (n x Ndim) array of positions returning n log probabilities (-np.inf outside the prior)
+        Nwalkers - even number of walkers, at least 2 * Ndim is recommended
+        StretchA - scale parameter of the stretch move
+        '''
+        if Nwalkers % 2 != 0 or Nwalkers < 4:
+            raise Exception("Number of walkers has to be even and at least 4, got {0}".format(Nwalkers))
+        self.LogProb = LogProb
+        self.Nwalkers = Nwalkers
+        self.Ndim = Ndim
+        self.StretchA = StretchA
+        self.rng = np.random.default_rng(Seed)
+
+    def Step(self, P, LP):
+        # one stretch move of both halves of the ensemble, P and LP are updated in place
+        Accepted = np.zeros(self.Nwalkers, dtype=bool)
+        Half = self.Nwalkers // 2
+        for First in (True, False):
+            Moving = slice(0, Half) if First else slice(Half, self.Nwalkers)
+            Others = P[Half:] if First else P[:Half]
+            a = self.StretchA
+            z = ((a - 1) * self.rng.random(Half) + 1) ** 2 / a
+            Partners = Others[self.rng.integers(0, len(Others), Half)]
+            Proposal = Partners + z[:, np.newaxis] * (P[Moving] - Partners)
+            LPnew = self.LogProb(Proposal)
+            logq = (self.Ndim - 1) * np.log(z) + LPnew - LP[Moving]
+            Accept = np.log(self.rng.random(Half)) < logq
+            P[Moving][Accept] = Proposal[Accept]
+            LP[Moving][Accept] = LPnew[Accept]
+            Accepted[Moving] = Accept
+        return Accepted
+
+    def Run(self, P0, Nsteps, ChainFile=None, Thin=1, ProgressCallback=None):
+        '''
+        Runs Nsteps steps from the initial positions P0 (Nwalkers x Ndim)
+        ChainFile - optional .npy file the chain is written into as it goes (memory-mapped, flushed every
+                    100 stored steps); the log probabilities go next to it into <name>_logprob.npy
+        Thin - only every Thin-th step is stored
+        Returns (Chain, LogProbs, AcceptanceFraction): (stored steps x Nwalkers x Ndim), (stored steps x Nwalkers)
+        and the fraction of accepted moves of every walker
+        '''
+        P = np.array(P0, dtype=float)
+        if P.shape != (self.Nwalkers, self.Ndim):
+            raise Exception("Initial positions have to be of shape ({0}, {1})".format(self.Nwalkers, self.Ndim))
+        LP = self.LogProb(P)
+        if not np.all(np.isfinite(LP)):
+            raise Exception("All walkers have to start where the log probability is finite")
+
+        Nstored = Nsteps // Thin
+        if ChainFile is None:
+            Chain = np.empty((Nstored, self.Nwalkers, self.Ndim))
+            LogProbs = np.empty((Nstored, self.Nwalkers))
+        else:
+            Chain = np.lib.format.open_memmap(ChainFile, mode='w+', dtype=np.float64, shape=(Nstored, self.Nwalkers, self.Ndim))
+            LogProbs = np.lib.format.open_memmap(path.splitext(ChainFile)[0] + '_logprob.npy', mode='w+',
+                                                 dtype=np.float64, shape=(Nstored, self.Nwalkers))
+
+        Accepted = np.zeros(self.Nwalkers)
+        for i in range(Nstored * Thin):
+            Accepted += self.Step(P, LP)
+            if (i + 1) % Thin == 0:
+                j = (i + 1) // Thin - 1
+                Chain[j] = P
+                LogProbs[j] = LP
+                if ChainFile is not None and (j + 1) % 100 == 0:
+                    Chain.flush()
+                    LogProbs.flush()
+            if ProgressCallback is not None and (i * 100 // Nsteps != (i + 1) * 100 // Nsteps):
+                ProgressCallback(i + 1, Nsteps)
+
+        if ChainFile is not None:
+            Chain.flush()
+            LogProbs.flush()
+        return Chain, LogProbs, Accepted / max(Nstored * Thin, 1)
+
+
+#---------------------------------------------------------------------------------
+# Posterior sampling of the areal densities
+# Same model and parameters as TransmissionCalc.FitArealDensities (Mode 'Thickness' or 'Isotope'), with
+# flat positive priors and Gaussian noise NoiseSigma on every transmission point (by default the rms
+# residual of the least squares fit). Walkers start in a small ball around the least squares solution.
+# L and dT are fixed at the values of Par unless Calibration is True; then the flight path (m) and the trigger
+# delay (us) are two more parameters with flat priors, so the density intervals include the calibration
+# uncertainty. The resolution matrix depends on L and dT, so in that case every walker is convolved on its own
+# (ConvolveWithKernels on the TOF grid refined at the fitted L, kept fixed in energy) instead of one sparse
+# product per half step, which is an order of magnitude slower. The experimental points are the ones of the
+# fit for every walker; walkers whose L, dT move them outside of the convolved range are outside of the prior.
+# Returns a dictionary with the 'Chain', 'LogProbs', 'AcceptanceFraction' of EnsembleSampler.Run,
+# the parameter 'Labels', the least squares 'Fit', the 'Median' and the 68% 'Interval' of every parameter
+# (from the second half of the chain)
+#---------------------------------------------------------------------------------
+def SampleArealDensities(Par, Texp, TrExp, EarrIdeal, S, Mode='Thickness', Nwalkers=32, Nsteps=2000, Thin=1,
+                         NoiseSigma=None, ChainFile=None, Seed=None, BEAM_ARR_DIM=tr.BEAM_ARR_DIM,
+                         NsubCells=tr.NsubCells, ProgressCallback=None, Calibration=False):
+    Fit = tr.FitArealDensities(Par, Texp, TrExp, EarrIdeal, S, Mode, BEAM_ARR_DIM, NsubCells)
+    Labels, D, p0 = tr.DensityParametrization(Par['Elmnts'], Mode)
+    SigmaMatrix = tr.BuildCrossSectionMatrix(S, list(Par['Elmnts']['Isotope Name']), EarrIdeal)
+    G = D @ SigmaMatrix
+    # the matrix of the fit, from the cache
+    TrTrial = tr.CalcIdealTransmissionMatrix(G, np.outer(tr.TrialFactors, p0))
+    R, ExpMask = tr.GetResolutionMatrixCache().Get(Par, EarrIdeal, Texp, BEAM_ARR_DIM, NsubCells, TrTrial)
+    TrExp1 = TrExp[ExpMask]
+    if NoiseSigma is None:
+        NoiseSigma = np.sqrt(Fit['ChiSq'] / max(len(TrExp1) - len(p0), 1))
+
+    def LogProb(P):
+        LP = np.full(len(P), -np.inf)
+        Inside = np.all(P >= 0, axis=1)
+        if Inside.any():
+            # theory of all the walkers inside the prior: (walkers x energies) -> (points x walkers)
+            TrTheor = R @ tr.CalcIdealTransmissionMatrix(G, P[Inside]).T
+            LP[Inside] = -0.5 * np.sum((TrTheor - TrExp1[:, np.newaxis]) ** 2, axis=0) / NoiseSigma ** 2
+        return LP
+
+    rng = np.random.default_rng(Seed)
+    Start = Fit['Parameters']
+    Scale = np.where(Fit['Errors'] > 0, Fit['Errors'], np.abs(Fit['Parameters']) * 1e-3 + 1e-12)
+
+    if Calibration:
+        Np = len(p0)
+        Labels = Labels + ['Flight path (m)', 'Trigger delay (us)']
+        Start = np.concatenate((Start, [Par['Flight path'], Par['Trigger delay']]))
+        Scale = np.concatenate((Scale, [Par['Flight path'] * 1e-5, 1e-2]))
+        # convolved transmission on the grid refined at the fitted L; in energy, so the kernels do not change with L
+        Earr2 = tr.Get_E_FromTOF(tr.RefineConvolutionTOF(Par, EarrIdeal, TrTrial, BEAM_ARR_DIM)[0], Par['Flight path'])
+        BeamProfile_T, BeamProfile_Amp = tr.BeamProfileKernels(Par['Proton pulse gap'], Earr2, BEAM_ARR_DIM)
+        Texp1 = Texp[ExpMask]
+        Tbin1 = tr.CalcTbinArray(Texp)[ExpMask]
+
+        def Theory(p, L, dT):
+            Tarr2 = tr.Get_TOF_FromE(Earr2, L)  # descending
+            Tr2 = tr.ConvolveWithKernels(tr.Get_TOF_FromE(EarrIdeal, L), tr.CalcIdealTransmissionMatrix(G, p),
+                                         Tarr2, BeamProfile_T, BeamProfile_Amp)
+            Times = tr.ExpSampleTimes(Texp1, Tbin1, dT, NsubCells)
+            if Times.min() < Tarr2[-1] or Times.max() > Tarr2[0]:
+                raise tr.OutsideOfTOFRange("Experimental points outside of the convolved transmission")
+            return np.interp(Times, Tarr2[::-1], Tr2[::-1]).mean(axis=1)
+
+        def LogProb(P):
+            LP = np.full(len(P), -np.inf)
+            for i in np.flatnonzero(np.all(P[:, :Np] >= 0, axis=1) & (P[:, Np] > 0)):
+                try:
+                    TrTheor = Theory(P[i, :Np], P[i, Np], P[i, Np + 1])
+                except ValueError:  # includes tr.OutsideOfTOFRange
+                    continue
+                LP[i] = -0.5 * np.sum((TrTheor - TrExp1) ** 2) / NoiseSigma ** 2
+            return LP
+
+    P0 = Start + Scale * rng.standard_normal((Nwalkers, len(Start)))
+    P0[:, :len(p0)] = np.abs(P0[:, :len(p0)])
+
+    Sampler = EnsembleSampler(LogProb, Nwalkers, len(Start), Seed=rng.integers(2**32))
+    Chain, LogProbs, AcceptanceFraction = Sampler.Run(P0, Nsteps, ChainFile, Thin, ProgressCallback)
+
+    Flat = np.asarray(Chain[len(Chain) // 2:]).reshape(-1, len(Start))
+    return {'Chain': Chain, 'LogProbs': LogProbs, 'AcceptanceFraction': AcceptanceFraction, 'Labels': Labels,
+            'Fit': Fit, 'NoiseSigma': NoiseSigma, 'Median': np.median(Flat, axis=0),
+            'Interval': np.percentile(Flat, [16, 84], axis=0).T}
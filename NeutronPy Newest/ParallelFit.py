@@ -0,0 +1,205 @@
+#---------------------------------------------------------------------------------
+# Fits of the transmission model spread over a process pool
+# Every worker process receives the measured spectrum and the ideal transmission once, through the pool
+# initializer; the cross section library and the beam profile tables are memory-mapped files, so all the
+# workers share the same pages read-only. Tasks themselves only carry a few numbers.
+# On Windows the pool starts new interpreters: call these functions from under if __name__ == '__main__'
+#---------------------------------------------------------------------------------
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import TransmissionCalc as tr
+from BeamProfileLibrary import GetBeamProfileTable
+from CrossSectionLibrary import GetCrossSectionLibrary
+
+# data of the current fit, set once per worker process by InitWorker
+_Shared = {}
+
+
+def InitWorker(Par, Texp, TrExp, EarrIdeal, TrIdeal, BEAM_ARR_DIM, NsubCells, Extra=None):
+    # Extra - dictionary of anything else a particular kind of task needs (e.g. bootstrap residuals)
+    _Shared.update({'Par': Par, 'Texp': Texp, 'TrExp': TrExp, 'EarrIdeal': EarrIdeal, 'TrIdeal': TrIdeal,
+                    'BEAM_ARR_DIM': BEAM_ARR_DIM, 'NsubCells': NsubCells})
+    if Extra is not None:
+        _Shared.update(Extra)
+
+
+#---------------------------------------------------------------------------------
+# Runs Task(*args) for every args of TaskArgs, in a pool of Workers processes (None - one per CPU)
+# or in this process when Workers == 1. Results come back in the order of TaskArgs
+#---------------------------------------------------------------------------------
+def RunTasks(Task, TaskArgs, SharedArgs, Workers=None, ProgressCallback=None):
+    Results = []
+    if Workers == 1:
+        InitWorker(*SharedArgs)
+        for i, args in enumerate(TaskArgs):
+            Results.append(Task(*args))
+            if ProgressCallback is not None:
+                ProgressCallback(i + 1, len(TaskArgs))
+        return Results
+
+    # the beam profile table and the cross section library are built and saved here once, the workers only load them
+    GetBeamProfileTable(SharedArgs[5])
+    GetCrossSectionLibrary()
+    with ProcessPoolExecutor(max_workers=Workers, initializer=InitWorker, initargs=SharedArgs) as Pool:
+        Futures = [Pool.submit(Task, *args) for args in TaskArgs]
+        for i, Future in enumerate(Futures):
+            Results.append(Future.result())
+            if ProgressCallback is not None:
+                ProgressCallback(i + 1, len(TaskArgs))
+    return Results
+
+
+#---------------------------------------------------------------------------------
+# One row of the landscape: convolution for the flight path L, then chi square for all the delays
+#---------------------------------------------------------------------------------
+def LandscapeRow(L, Delays):
+    Par = dict(_Shared['Par'])
+    Par['Flight path'] = L
+    try:
+        TrConv_T, Tmax = tr.ConvolveTrWithPulseProfile(Par, _Shared['EarrIdeal'], _Shared['TrIdeal'], _Shared['BEAM_ARR_DIM'])
+    except ValueError:  # includes TransmissionCalc.OutsideOfTOFRange
+        return np.full(len(Delays), np.inf)
+    return tr.CalcChiSqForDelays(Par, _Shared['Texp'], _Shared['TrExp'], TrConv_T, Tmax, Delays, _Shared['NsubCells'])
+
+
+#---------------------------------------------------------------------------------
+# Chi square of the model on the grid of flight paths Larr (m) and trigger delays dTarr (us)
+# Texp, TrExp - measured TOF (us, without the trigger delay) and transmission
+# EarrIdeal, TrIdeal - ideal transmission of the sample (TransmissionCalc.CalcIdealTransmission)
+# One task per flight path, the convolution is done once per row
+# Returns the (len(Larr) x len(dTarr)) chi square array, np.inf where the model does not cover the data
+#---------------------------------------------------------------------------------
+def CalcChiSqLandscape(Par, Texp, TrExp, EarrIdeal, TrIdeal, Larr, dTarr, Workers=None,
+                       BEAM_ARR_DIM=tr.BEAM_ARR_DIM, NsubCells=tr.NsubCells, ProgressCallback=None):
+    SharedArgs = (Par, Texp, TrExp, EarrIdeal, TrIdeal, BEAM_ARR_DIM, NsubCells)
+    Rows = RunTasks(LandscapeRow, [(L, np.asarray(dTarr, dtype=float)) for L in Larr], SharedArgs, Workers, ProgressCallback)
+    return np.array(Rows)
+
+
+#---------------------------------------------------------------------------------
+# Global search on the (L, dT) grid followed by the local fit (TransmissionCalc.FitPathCalibration)
+# started from the grid minimum, with the grid spacing as initial simplex steps
+# Returns the fit dictionary of FitPathCalibration with the 'Landscape', 'Larr', 'dTarr' added
+#---------------------------------------------------------------------------------
+def FitPathCalibrationGlobal(Par, Texp, TrExp, EarrIdeal, TrIdeal, Larr, dTarr, Workers=None,
+                             BEAM_ARR_DIM=tr.BEAM_ARR_DIM, NsubCells=tr.NsubCells, ProgressCallback=None,
+                             Callback=None, Cancelled=None):
+    Landscape = CalcChiSqLandscape(Par, Texp, TrExp, EarrIdeal, TrIdeal, Larr, dTarr, Workers,
+                                   BEAM_ARR_DIM, NsubCells, ProgressCallback)
+    if not np.isfinite(Landscape).any():
+        raise Exception("The model does not cover the measured spectrum anywhere on the (L, dT) grid")
+    iL, idT = np.unravel_index(np.argmin(Landscape), Landscape.shape)
+
+    Par1 = dict(Par)
+    Par1['Flight path'] = Larr[iL]
+    Par1['Trigger delay'] = dTarr[idT]
+    Step = (Larr[1] - Larr[0] if len(Larr) > 1 else 0.05, dTarr[1] - dTarr[0] if len(dTarr) > 1 else 0.5)
+    Fit = tr.FitPathCalibration(Par1, Texp, TrExp, EarrIdeal, TrIdeal, BEAM_ARR_DIM, NsubCells, Step,
+                                Callback=Callback, Cancelled=Cancelled)
+    Fit.update({'Landscape': Landscape, 'Larr': np.asarray(Larr), 'dTarr': np.asarray(dTarr)})
+    return Fit
+
+
+#---------------------------------------------------------------------------------
+# Local fit of (L, dT) started from (L0, dT0) on the shared data, TrExp replaces the shared spectrum if given
+# Returns the fit dictionary of FitPathCalibration
+#---------------------------------------------------------------------------------
+def FitTask(L0, dT0, Step, TrExp=None):
+    Par = dict(_Shared['Par'])
+    Par['Flight path'] = L0
+    Par['Trigger delay'] = dT0
+    return tr.FitPathCalibration(Par, _Shared['Texp'], _Shared['TrExp'] if TrExp is None else TrExp,
+                                 _Shared['EarrIdeal'], _Shared['TrIdeal'], _Shared['BEAM_ARR_DIM'], _Shared['NsubCells'], Step)
+
+
+#---------------------------------------------------------------------------------
+# Local fits from several starting points Starts = [(L0, dT0), ...], one task per start
+# Only (L, dT) needs several starts: a wrong L or dT shifts the resonances against the measured dips and the
+# chi square has a local minimum at every alignment. At fixed L and dT the transmission goes down monotonically
+# with every density, so TransmissionCalc.FitArealDensities converges from the table values and is run once
+# on the best calibration
+# Returns the list of fit dictionaries sorted by chi square, the best one first
+#---------------------------------------------------------------------------------
+def FitPathCalibrationMultiStart(Par, Texp, TrExp, EarrIdeal, TrIdeal, Starts, Step=(0.05, 0.5), Workers=None,
+                                 BEAM_ARR_DIM=tr.BEAM_ARR_DIM, NsubCells=tr.NsubCells, ProgressCallback=None):
+    SharedArgs = (Par, Texp, TrExp, EarrIdeal, TrIdeal, BEAM_ARR_DIM, NsubCells)
+    Fits = RunTasks(FitTask, [(L0, dT0, Step) for L0, dT0 in Starts], SharedArgs, Workers, ProgressCallback)
+    return sorted(Fits, key=lambda Fit: Fit['ChiSq'])
+
+
+#---------------------------------------------------------------------------------
+# One bootstrap replica: a new spectrum drawn with the random Seed, fitted from the best fit
+# Method 'Residuals' - best fit theory plus the fit residuals resampled with replacement
+# Method 'Poisson'   - every point redrawn from Poisson statistics of its Counts
+# With a density Mode the areal densities of the replica are fitted too, at its own L and dT
+# Returns (L, dT, ChiSq) of the replica, followed by its density parameters
+#---------------------------------------------------------------------------------
+def BootstrapTask(Seed):
+    rng = np.random.default_rng(Seed)
+    TrExp = np.array(_Shared['TrExp'], dtype=float)
+    if _Shared['Method'] == 'Residuals':
+        Mask = _Shared['ExpMask']
+        TrExp[Mask] = _Shared['TrTheor'] + rng.choice(_Shared['Residuals'], size=len(_Shared['Residuals']))
+    else:
+        Counts = _Shared['Counts']
+        TrExp = rng.poisson(np.clip(TrExp, 0, None) * Counts) / Counts
+
+    Fit = FitTask(_Shared['Par']['Flight path'], _Shared['Par']['Trigger delay'], _Shared['Step'], TrExp)
+    if _Shared['Mode'] is None:
+        return (Fit['Flight path'], Fit['Trigger delay'], Fit['ChiSq'])
+    Par = dict(_Shared['Par'])
+    Par['Flight path'] = Fit['Flight path']
+    Par['Trigger delay'] = Fit['Trigger delay']
+    Densities = tr.FitArealDensities(Par, _Shared['Texp'], TrExp, _Shared['EarrIdeal'], _Shared['S'], _Shared['Mode'],
+                                     _Shared['BEAM_ARR_DIM'], _Shared['NsubCells'])
+    return (Fit['Flight path'], Fit['Trigger delay'], Fit['ChiSq']) + tuple(Densities['Parameters'])
+
+
+#---------------------------------------------------------------------------------
+# Bootstrap uncertainties of the (L, dT) calibration
+# The spectrum is fitted once from Par, then Nsamples replicas of it (see BootstrapTask) are fitted again
+# on the process pool, starting from that best fit
+# Counts - counts behind every point of TrExp (open beam counts, array or scalar), needed for Method='Poisson'
+# Level - probability covered by the confidence intervals
+# S, Mode - cross sections (TransmissionCalc.LoadCrossSectionsData) and density parametrization
+#           (TransmissionCalc.DensityParametrization): every replica also gets its densities fitted at its L and dT,
+#           so their intervals include the calibration uncertainty. None (default) bootstraps L and dT only
+# Returns a dictionary with the best 'Fit', the replica 'Samples' (Nsamples x 2 array of L, dT, followed by the
+# density parameters with a Mode) and their 'ChiSq', 'Mean', 'Std', and the percentile 'Interval' (lower, upper)
+# of each parameter, keyed by parameter name (the density 'Labels' of DensityParametrization)
+#---------------------------------------------------------------------------------
+def BootstrapPathCalibration(Par, Texp, TrExp, EarrIdeal, TrIdeal, Nsamples=100, Method='Residuals', Counts=None,
+                             Level=0.68, Seed=0, Step=(0.05, 0.5), Workers=None,
+                             BEAM_ARR_DIM=tr.BEAM_ARR_DIM, NsubCells=tr.NsubCells, ProgressCallback=None,
+                             S=None, Mode=None):
+    if Method not in ('Residuals', 'Poisson'):
+        raise Exception("Unknown bootstrap method {0}, use 'Residuals' or 'Poisson'".format(Method))
+    if Method == 'Poisson' and Counts is None:
+        raise Exception("Poisson bootstrap needs the Counts behind the transmission values")
+    if Mode is not None and S is None:
+        raise Exception("Bootstrap of the densities needs the cross sections S")
+
+    Fit = tr.FitPathCalibration(Par, Texp, TrExp, EarrIdeal, TrIdeal, BEAM_ARR_DIM, NsubCells, Step)
+    Par1 = dict(Par)
+    Par1['Flight path'] = Fit['Flight path']
+    Par1['Trigger delay'] = Fit['Trigger delay']
+    TrConv_T, Tmax = tr.ConvolveTrWithPulseProfile(Par1, EarrIdeal, TrIdeal, BEAM_ARR_DIM)
+    Texp1, TrExp1, TrTheor = tr.CalcTheorForExpPoints(Par1, Texp, TrExp, TrConv_T, Tmax, NsubCells)
+    ExpMask = tr.SelectExpPoints(Par1, Texp, tr.CalcTbinArray(Texp), Tmax)
+
+    Extra = {'Method': Method, 'Step': Step, 'ExpMask': ExpMask, 'TrTheor': TrTheor, 'Residuals': TrExp1 - TrTheor,
+             'Counts': Counts, 'S': S, 'Mode': Mode}
+    SharedArgs = (Par1, Texp, TrExp, EarrIdeal, TrIdeal, BEAM_ARR_DIM, NsubCells, Extra)
+    # independent random streams for the replicas
+    Seeds = np.random.SeedSequence(Seed).generate_state(Nsamples)
+    Results = np.array(RunTasks(BootstrapTask, [(int(s),) for s in Seeds], SharedArgs, Workers, ProgressCallback))
+
+    Samples = np.delete(Results, 2, axis=1)
+    Tail = (1 - Level) / 2 * 100
+    Names = ['Flight path', 'Trigger delay']
+    if Mode is not None:
+        Names = Names + tr.DensityParametrization(Par['Elmnts'], Mode)[0]
+    return {'Fit': Fit, 'Samples': Samples, 'ChiSq': Results[:, 2],
+            'Mean': {Name: float(Samples[:, i].mean()) for i, Name in enumerate(Names)},
+            'Std': {Name: float(Samples[:, i].std(ddof=1)) for i, Name in enumerate(Names)},
+            'Interval': {Name: tuple(float(x) for x in np.percentile(Samples[:, i], [Tail, 100 - Tail])) for i, Name in enumerate(Names)}}
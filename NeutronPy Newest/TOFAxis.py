@@ -0,0 +1,124 @@
+#---------------------------------------------------------------------------------
+# Time of flight axis of a measurement
+# A TOFAxis holds the TOF of the slices as recorded (RawTOF, us), the trigger delay (us) and the flight
+# path (m), and derives everything else from them: the delayed TOF, energy, wavelength, time bin widths,
+# readout gaps and the properly spaced TOF grid for the theory. Nothing is calculated before it is asked
+# for and every derived array is calculated only once.
+# The axis is immutable (all arrays are read-only): a new delay or flight path gives a new axis through
+# Replace, which keeps whatever does not depend on the changed input (the bins and gaps only depend on
+# RawTOF), so nobody can shift the recorded TOF by the delay twice.
+#---------------------------------------------------------------------------------
+import numpy as np
+import TransmissionCalc as tr
+
+
+class TOFAxis:
+    __slots__ = ('_RawTOF', '_Delay', '_FlightPath', '_Cache')
+
+    def __init__(self, RawTOF, FlightPath, Delay=0.0):
+        '''
+        RawTOF - TOF of the slices as recorded (us), without the trigger delay
+        FlightPath - flight path (m), Delay - trigger delay (us)
+        '''
+        RawTOF = np.array(RawTOF, dtype=float)
+        RawTOF.setflags(write=False)
+        object.__setattr__(self, '_RawTOF', RawTOF)
+        object.__setattr__(self, '_FlightPath', float(FlightPath))
+        object.__setattr__(self, '_Delay', float(Delay))
+        object.__setattr__(self, '_Cache', {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("TOFAxis is immutable, use Replace to change {0}".format(name))
+
+    def __len__(self):
+        return len(self._RawTOF)
+
+    def __repr__(self):
+        return 'TOFAxis({0} points, L = {1} m, dT = {2} us)'.format(len(self), self._FlightPath, self._Delay)
+
+    def _Cached(self, name, Calc):
+        if name not in self._Cache:
+            Value = Calc()
+            if isinstance(Value, np.ndarray):
+                Value.setflags(write=False)
+            self._Cache[name] = Value
+        return self._Cache[name]
+
+    def Replace(self, FlightPath=None, Delay=None):
+        '''
+        Axis with a new flight path and/or delay; returns self when nothing changes
+        Derived arrays which do not depend on the changed inputs are shared with the new axis
+        '''
+        FlightPath = self._FlightPath if FlightPath is None else float(FlightPath)
+        Delay = self._Delay if Delay is None else float(Delay)
+        if FlightPath == self._FlightPath and Delay == self._Delay:
+            return self
+        Axis = TOFAxis.__new__(TOFAxis)
+        object.__setattr__(Axis, '_RawTOF', self._RawTOF)
+        object.__setattr__(Axis, '_FlightPath', FlightPath)
+        object.__setattr__(Axis, '_Delay', Delay)
+        Keep = ('Segments', 'Tbin', 'Gaps')
+        if Delay == self._Delay:
+            Keep = Keep + ('TOF',)
+        object.__setattr__(Axis, '_Cache', {name: self._Cache[name] for name in Keep if name in self._Cache})
+        return Axis
+
+    @property
+    def RawTOF(self):
+        return self._RawTOF
+
+    @property
+    def FlightPath(self):
+        return self._FlightPath
+
+    @property
+    def Delay(self):
+        return self._Delay
+
+    @property
+    def TOF(self):
+        # TOF of the slices shifted by the trigger delay (us)
+        return self._Cached('TOF', lambda: self._RawTOF + self._Delay)
+
+    @property
+    def Energy(self):
+        # neutron energy (eV) of the slices
+        return self._Cached('Energy', lambda: tr.Get_E_FromTOF(self.TOF, self._FlightPath))
+
+    @property
+    def Wavelength(self):
+        # neutron wavelength (Angstrom) of the slices, the same conversion as Get_E_FromTOF
+        return self._Cached('Wavelength', lambda: self.TOF * 3.956e-3 / self._FlightPath)
+
+    @property
+    def Segments(self):
+        # (Starts, Widths, Index) of the segments of constant time bin (SegmentTOFArray)
+        def Calc():
+            Segments = tr.SegmentTOFArray(self._RawTOF)
+            for Array in Segments:
+                Array.setflags(write=False)
+            return Segments
+        return self._Cached('Segments', Calc)
+
+    @property
+    def Tbin(self):
+        # time bin width (us) of every slice, readout gaps taken care of (CalcTbinArray)
+        return self._Cached('Tbin', lambda: tr.CalcTbinArray(self._RawTOF))
+
+    @property
+    def Gaps(self):
+        # indices of the slices which start after a readout gap or a change of the time bin
+        return self._Cached('Gaps', lambda: self.Segments[0][1:])
+
+    def TheoryGrid(self, Emin=None, Emax=None):
+        '''
+        Properly spaced TOF grid (us) for theory evaluation (Get_T_Array_Properly_Spaced) at this flight path,
+        by default over the energy range of the slices
+        '''
+        Emin = np.min(self.Energy) if Emin is None else Emin
+        Emax = np.max(self.Energy) if Emax is None else Emax
+        return self._Cached(('TheoryGrid', Emin, Emax), lambda: tr.Get_T_Array_Properly_Spaced(Emin, Emax, self._FlightPath))
+
+    def Slice(self, start, stop):
+        # axis of the slices [start, stop), for a z range of the image cube
+        return TOFAxis(self._RawTOF[start:stop], self._FlightPath, self._Delay)
@@ -1,10 +1,30 @@
 #---------------------------------------------------------------------------------
+# Computational core of the transmission model. Nothing in here touches pyplot or a GUI,
+# so it runs the same in the Qt workers, process pools and batch scripts.
+# All the plots live in TransmissionPlot.py; long loops report through an optional ProgressCallback(done, total)
+#---------------------------------------------------------------------------------
 import pandas as pd
-import matplotlib.pyplot as plt
+from collections import OrderedDict
 from scipy.interpolate import interp1d
+from scipy import sparse
 import numpy as np
-#import BeamProfile1 as bm
-from tqdm import tqdm_notebook
+from AntonCode import BeamProfile1 as bm
+from CrossSectionLibrary import GetCrossSectionLibrary, GetResampledCrossSections, ResampledCrossSections
+from BeamProfileLibrary import GetBeamProfileTable
+from scipy.optimize import least_squares, minimize
+
+#----------------------------------------------------------------------
+# parameters of the numerical methods used in the model, defaults for the functions below
+#----------------------------------------------------------------------
+BEAM_ARR_DIM       = 16   # size of the array for the pulse shape of the beam, use 128 as a default
+NsubCells          = 3    # number of points in each time bin of exp. data used for Theoretical calc (averaging over the time bin)
+TrialFactors       = (1/16, 1/4, 1, 4)  # densities (relative to the table) of the trial transmissions the resolution matrix grid is refined for
+
+
+# raised when L, dT (or the energy range) move the calculation outside of the TOF range where the model is defined
+# a ValueError, so fitting and grid searches can give such points an infinite chi square and go on
+class OutsideOfTOFRange(ValueError):
+    pass
 
 
 #---------------------------------------------------------------------------------
@@ -12,52 +32,20 @@ from tqdm import tqdm_notebook
 # Cuts it to [Emin, Emax] interval, measured in eV.
 # IsotopeName - name for the file such as Ta-181, C-nat, etc
 # Returns interpolated function, which can be used to calculate Cross section at any value E (in eV)
+# (TransmissionPlot.PlotCrossSection shows the table against its interpolation)
 #---------------------------------------------------------------------------------
 def LoadSingleCrossSection(IsotopeName, Emin, Emax):
 
-    S1 = pd.read_table('CrossSections_BeamProfiles\\'+IsotopeName+'.txt')
-    #print(S1.head())
-
-    # find the index of first row, where E exceeds Emin
-    ind1 = next(x for x, val in enumerate(S1[S1.columns[0]]) if val > Emin*1e-6)
-    #print('Ind1 =',ind1)
-    # find the index of first row, where E exceeds Emax
-    ind2 = next(x for x, val in enumerate(S1[S1.columns[0]]) if val > Emax*1e-6)
-    #print('Ind2 =',ind2)
-    # select only needed part of table
-    S1 = S1.iloc[ind1-1:ind2+1]
-
-    #that is non-inclusive version of selection, do not use it
-    # select only values which are in the range of Energy used in calculations
-    #S1 = S1.loc[(S1[S1.columns[0]] >= Emin*1e-6) & (S1[S1.columns[0]] <= Emax*1e-6) ]  #original file data is in MeV
-
-    # drop duplicate rows if such exist
-    S1 = S1.drop_duplicates(subset=S1.columns[0])
-
-    # create numpy arrays
-    Earr = S1[S1.columns[0]].to_numpy()*1e6
-    Sarr = S1[S1.columns[1]].to_numpy()
+    # tables come from the compiled binary library (see CrossSectionLibrary.py), already in eV,
+    # sorted and without duplicate rows; the text files are only parsed again when they change
+    # select only needed part of table: binary search for the rows around Emin and Emax
+    Earr, Sarr = GetCrossSectionLibrary().GetWindow(IsotopeName, Emin, Emax)
 
     #interpolate the cross section to allow for any E value
     #CrossSection =  interp1d(Earr, Sarr, kind='cubic',fill_value='extrapolate')
     #CrossSection =  interp1d(Earr, Sarr, kind='linear',fill_value='extrapolate')
     CrossSection =  interp1d(Earr, Sarr, kind='linear')
 
-    Sarr2 = CrossSection(Earr)
-
-    plt.figure(figsize=(6, 2.5))
-    plt.plot(Earr, Sarr, label=IsotopeName, color='b', marker='.')
-    plt.plot(Earr, Sarr2, label='Interpolated', color='r')
-    plt.grid(True)
-    plt.xlabel("Neutron energy (eV)")
-    plt.ylabel("Cross section (barns)")
-    plt.xscale('log')
-    plt.yscale('log')
-    #plt.xlim([4, 4.5])
-    #plt.ylim([-5, 10])
-    plt.legend()
-    plt.show()
-
     return {IsotopeName: CrossSection}
 
 
@@ -71,12 +59,20 @@ def LoadCrossSectionsData(Par):
     # changed Emin, Emax to provide for padding needed for convolution with beam profile
 
     S = {}  # Dictionary of interpolated cross sections (functions) for all the materials, key is Isotope Name
-    for i in range(0, Par['Elmnts'].shape[0]):
-        rowSeries = Par['Elmnts'].iloc[i]  # this is one line from the param file with elemental data
-        S.update(LoadSingleCrossSection(rowSeries[0], Par['Minimum E'], Par['Maximum E']))
+    # all isotopes are cut to the same window in one go
+    Tables = CutCrossSections(Par['Elmnts']['Isotope Name'], Par['Minimum E'], Par['Maximum E'])
+    for IsotopeName, (Earr, Sarr) in Tables.items():
+        S[IsotopeName] = interp1d(Earr, Sarr, kind='linear')
 
     return S
 
+# ----------------------------------------------------------------------------------
+# Cuts the cross sections of all IsotopeNames to the same [Emin, Emax] window (eV) in one call
+# Returns a dictionary of (Earr, Sarr) arrays (key=IsotopeName), views into the binary library
+# ----------------------------------------------------------------------------------
+def CutCrossSections(IsotopeNames, Emin, Emax):
+    return GetCrossSectionLibrary().GetWindows(IsotopeNames, Emin, Emax)
+
 #---------------------------------------------------------------------------------------------------
 # converts TOF into energy in eV, TOF in us, L in meters
 #---------------------------------------------------------------------------------------------------
@@ -156,71 +152,115 @@ def Get_E_Array_Properly_Spaced(Emin, Emax) :
     return Earr
 
 #---------------------------------------------------------------------------------------------------
-# creates array of T values with proper steps for the rane in between Emin and Emax (eV)
+# creates an energy array adapted to the transmission of the sample, to be used instead of
+# Get_E_Array_Properly_Spaced. Par - parameters with 'Minimum E', 'Maximum E' and the 'Elmnts' table
+# The transmission is exact at the energies of the cross section tables, so these are the starting points;
+# intervals are then halved until the transmission is linear over them to Tolerance, and points which
+# linear interpolation reproduces to Tolerance are dropped again (SimplifyCurve).
+# Linearity is measured in 1/sqrt(E), i.e. linear in TOF for any flight path, as the convolution interpolates
+# Returns the array of energies (eV), dense across the resonances and sparse elsewhere
 #---------------------------------------------------------------------------------------------------
-# def Get_T_Array_Properly_Spaced(Emin, Emax, L) :
+def Get_E_Array_Adaptive(Par, Tolerance=1e-4) :
+    Emin = Par['Minimum E']
+    Emax = Par['Maximum E']
+    if Emin < 0.0001:
+        raise Exception("Emin is too small!!!!\n Input value was {0} lower than Emin = {1}\n Exit here".format(Emin, 0.0001))
+    if Emax > 20e6:  # 20 MeV is max value in most cross section data
+        raise Exception("Emax is too large!!!!\n Input value was {0} larger than Emax = {1}\n Exit here".format(Emax, 20e6))
+
+    IsotopeNames, Densities = CalcArealDensities(Par['Elmnts'])
+    Tables = CutCrossSections(IsotopeNames, Emin, Emax)
+
+    def Transmission(E):
+        ExpTerm = np.zeros(len(E))
+        for IsotopeName, n in zip(IsotopeNames, Densities):
+            Etable, Stable = Tables[IsotopeName]
+            ExpTerm += n * np.interp(E, Etable, Stable)
+        return np.exp(-ExpTerm)
+
+    Earr = np.unique(np.concatenate([Etable for Etable, Stable in Tables.values()] + [[Emin, Emax]]))
+    Earr = Earr[(Earr >= Emin) & (Earr <= Emax)]
+    Tr = Transmission(Earr)
+
+    # refine: halve (in 1/sqrt(E)) the intervals whose middle point is off the straight line
+    for i in range(30):
+        u = 1 / np.sqrt(Earr)
+        Emid = ((u[:-1] + u[1:]) / 2) ** -2
+        Trmid = Transmission(Emid)
+        Bad = np.abs(Trmid - (Tr[:-1] + Tr[1:]) / 2) > Tolerance / 2
+        if not Bad.any():
+            break
+        Earr = np.concatenate((Earr, Emid[Bad]))
+        Tr = np.concatenate((Tr, Trmid[Bad]))
+        order = np.argsort(Earr)
+        Earr = Earr[order]
+        Tr = Tr[order]
+
+    # coarsen: keep only the points needed for linear interpolation to Tolerance
+    Keep = SimplifyCurve(1 / np.sqrt(Earr), Tr, Tolerance)
+    Earr = Earr[Keep]
+    print('Adaptive energy array with', len(Earr), 'points between', Earr[0], 'eV and', Earr[-1], 'eV')
 
-#     Tmin = Get_TOF_FromE(Emax, L)
-#     Tmax = Get_TOF_FromE(Emin, L)
-    
-#     Erange = np.array( [0.0001, 0.001, 0.01, 0.1,  1,    10,   100,  1e3, 1e4, 1e5, 1e6] )
-#     # delme section----------------
-#     #Esteps = np.array( [5e-5,   5e-4,  5e-3, 5e-3, 1e-2, 1e-2, 1e-2, 0.1, 1,   10,  100] )
-#     #Trange = Get_TOF_FromE(Erange[::-1], L)
-#     #Tsteps = Trange - Get_TOF_FromE(Erange[::-1]+Esteps[::-1], L) 
-#     #print('Tsteps', Tsteps)
-#     #print('Trange', Trange)
-#     # end delme section----------------
-
-#     # set Tseps here. Above code calculates these from Esteps
-#     Tsteps = np.array( [5e-3, 0.01, 0.05, 0.002, 0.005, 0.05, 0.5, 10, 100, 500, 1000] )
-#     # convert these values relative to L=14.6 m, which was used for calibration
-#     Tsteps = Tsteps * L / 14.6
-
-#     MaxInd = len(Trange) - 1
-#     ind = MaxInd
-#     for i in range(0, MaxInd) :
-#         if Tmin >= Trange[i] and Tmin < Trange[i+1] :
-#             ind = i
-
-#     if ind == MaxInd:
-#         steps = int((Tmax-Tmin)/Tsteps[ind])
-#         Tarr = np.linspace(Tmin, Tmax, num=steps)
-#         #Tarr = np.arange(start=Tmin, stop=Tmax, step=Tsteps[ind])
-#     else :
-#         right = min(Tmax,Trange[ind+1])
-#         left = Tmin
-#         steps = int((right-left)/Tsteps[ind])
-#         Tarr = np.linspace(left, right, num=steps)
-#         #Tarr = np.arange(start=Tmin, stop=min(Tmax,Trange[ind+1]), step=Tsteps[ind])
-#         for i in range(ind+1, MaxInd) :
-#             right = min(Tmax, Trange[i + 1])
-#             left = Trange[i]
-#             if right > left :
-#                 steps = int((right - left) / Tsteps[i])
-#                 T1 = np.linspace(left, right, num=steps)
-#                 #T1 = np.arange(start=Trange[i], stop=min(Tmax,Trange[i+1]), step=Tsteps[i])
-#                 Tarr = np.append(Tarr, T1)
-#         if Tmax > Trange[MaxInd] :
-#             right = Tmax
-#             left = Trange[MaxInd]
-#             steps = int((right - left) / Tsteps[MaxInd])
-#             T1 = np.linspace(left, right, num=steps)
-#             #T1 = np.arange(start=Trange[MaxInd], stop=Tmax, step=Tsteps[MaxInd])
-#             Tarr = np.append(Tarr, T1)
-
-#     Tarr = np.unique(Tarr)  #remve duplicates, if they exist
-
-
-    ##plt.plot(Tarr[1:], np.diff(Tarr), color='g', marker='.')
-    #plt.plot(Tarr, Tarr, color='g', marker='.')
-    #plt.grid(True)
-    #plt.xscale('log')
-    ##plt.yscale('log')
-    ##plt.xlim([70, 70.1])
+    return Earr
+
+
+#---------------------------------------------------------------------------------------------------
+# Selects the points of the curve Y(X) (X sorted) which are needed to reproduce it by linear interpolation
+# with an error below Tolerance (Douglas-Peucker, every segment split at its worst point, all segments at once)
+# Y can also be (curves x len(X)), then the points are the ones needed by every curve
+# Returns the boolean mask of the points kept, the first and the last point are always kept
+#---------------------------------------------------------------------------------------------------
+def SimplifyCurve(X, Y, Tolerance):
+    N = len(X)
+    Y = np.atleast_2d(Y)
+    Keep = np.zeros(N, dtype=bool)
+    Keep[[0, -1]] = True
+    while True:
+        Kept = np.flatnonzero(Keep)
+        Seg = np.clip(np.searchsorted(Kept, np.arange(N), side='right') - 1, 0, len(Kept) - 2)
+        a = Kept[Seg]
+        b = Kept[Seg + 1]
+        Err = np.abs(Y - (Y[:, a] + (Y[:, b] - Y[:, a]) * (X - X[a]) / (X[b] - X[a]))).max(axis=0)
+        Err[Keep] = 0
+        SegMax = np.maximum.reduceat(Err, Kept[:-1])
+        New = (Err > Tolerance) & (Err == SegMax[Seg])
+        if not New.any():
+            return Keep
+        Keep |= New
+
+
+#---------------------------------------------------------------------------------------------------
+# creates array of T values (us) with proper steps for the range in between Emin and Emax (eV), L in meters
+# Same idea as Get_E_Array_Properly_Spaced, but the steps are set in TOF: every interval of Trange
+# (the TOF of the Erange energies) gets its own step, below Trange[0] the first one and above
+# Trange[-1] the last one. Returns the ascending TOF array
+#---------------------------------------------------------------------------------------------------
+def Get_T_Array_Properly_Spaced(Emin, Emax, L) :
+    Erange = np.array( [0.0001, 0.001, 0.01, 0.1,  1,    10,   100,  1e3, 1e4, 1e5, 1e6] )
+
+    if Emin < Erange[0]:
+        raise Exception("Emin is too small!!!!\n Input value was {0} lower than Emin = {1}\n Exit here".format(Emin, Erange[0]))
+    if Emax > 20e6:  # 20 MeV is max value in most cross section data
+        raise Exception("Emax is too large!!!!\n Input value was {0} larger than Emax = {1}\n Exit here".format(Emax, 20e6))
+
+    Tmin = Get_TOF_FromE(Emax, L)
+    Tmax = Get_TOF_FromE(Emin, L)
+
+    # Erange in reverse order, so Trange is ascending
+    Trange = Get_TOF_FromE(Erange[::-1], L)
+    # set Tsteps here, one per interval [Trange[i], Trange[i+1]] and the last one above Trange[-1]
+    Tsteps = np.array( [5e-3, 0.01, 0.05, 0.002, 0.005, 0.05, 0.5, 10, 100, 500, 1000] )
+    # convert these values relative to L=14.6 m, which was used for calibration
+    Tsteps = Tsteps * L / 14.6
+
+    # interval edges clipped to [Tmin, Tmax], the part below Trange[0] goes with the first step
+    Edges = np.clip(np.concatenate(([Tmin], Trange[1:], [Tmax])), Tmin, Tmax)
+    Tarr = [np.linspace(left, right, num=max(int((right - left) / step), 2))
+            for left, right, step in zip(Edges[:-1], Edges[1:], Tsteps) if right > left]
+    Tarr = np.unique(np.concatenate(Tarr))  # remove duplicates at the interval edges
 
     print('Created time array with',len(Tarr),'Time cells')
-    
+
     return Tarr
 
 
@@ -229,10 +269,11 @@ def Get_E_Array_Properly_Spaced(Emin, Emax) :
 #---------------------------------------------------------------------------------------------------
 def LoadParameters(filename="IsotopesToFit.txt"):
     Parameters = {'Proton pulse gap': 0, 'Flight path': 0, 'Trigger delay': 0, 'Time bin': 0, 'Minimum E': 0,
-                  'Maximum E': 0, 'CROSS_SECT_SKIP_POINTS': 10}
+                  'Maximum E': 0}
 
     FILE = open(filename)
 
+    # the 7th line of older files, CROSS_SECT_SKIP_POINTS, is not used any more: the grids are adaptive
     for i in range(7):
         s = FILE.readline()
         if s[0:1] != '//' and s[0] != '#' :
@@ -249,8 +290,6 @@ def LoadParameters(filename="IsotopesToFit.txt"):
                 Parameters['Minimum E'] = float(value)
             elif name.find('Maximum E') != -1:
                 Parameters['Maximum E'] = float(value)
-            elif name.find('CROSS_SECT_SKIP_POINTS') != -1:
-                Parameters['CROSS_SECT_SKIP_POINTS'] = int(value)
 
     #print(Parameters)
 
@@ -289,78 +328,120 @@ def LoadParameters(filename="IsotopesToFit.txt"):
     return Parameters
 
 
+# ----------------------------------------------------------------------------------
+# Areal density of every row of the elemental composition table Elem (atoms/barn)
+# ExpTerm = Rho * d * w * A * S2 / (w * m * A) / 1.6605389e4, where the mass m is summed over the group
+# of the isotope, so for row i: n_i = Abundance * AtomicFraction * Thickness * Density / 1.6605389e4 / Mass(group)
+# Returns the list of isotope names and the array of their areal densities, in the row order of Elem
+# ----------------------------------------------------------------------------------
+def CalcArealDensities(Elem):
+    Densities = ArealDensitiesPerThickness(Elem) * Elem['Thickness (um)'].to_numpy(dtype=float)
+    return list(Elem['Isotope Name']), Densities
+
+
+# ----------------------------------------------------------------------------------
+# Areal density of every row of Elem for a thickness of 1 um of its group, in the row order of Elem
+# ----------------------------------------------------------------------------------
+def ArealDensitiesPerThickness(Elem):
+    Mass = (Elem['AtomicFraction'] * Elem['AtomicMass']).groupby(Elem['GrupN']).transform('sum')
+    Densities = Elem['Abundance'] * Elem['AtomicFraction'] * Elem['Density (g/cm3)'] / 1.6605389e4 / Mass
+    return Densities.to_numpy(dtype=float)
+
+
+# ----------------------------------------------------------------------------------
+# Stacks the cross sections of IsotopeNames resampled on Earr into an (isotopes x energies) matrix
+# S - dictionary of interpolated cross sections, as returned by LoadCrossSectionsData
+# Rows come from the resampling cache, so building the matrix again on the same grid is only a copy
+# ----------------------------------------------------------------------------------
+def BuildCrossSectionMatrix(S, IsotopeNames, Earr):
+    Resampled = GetResampledCrossSections()
+    SigmaMatrix = np.empty((len(IsotopeNames), len(Earr)))
+    for i, IsotopeName in enumerate(IsotopeNames):
+        SigmaMatrix[i] = Resampled.Get(IsotopeName, Earr, S[IsotopeName])
+    return SigmaMatrix
+
+
+# ----------------------------------------------------------------------------------
+# Ideal transmission exp(-n . Sigma) for one or many compositions at once
+# SigmaMatrix - (isotopes x energies) from BuildCrossSectionMatrix
+# Densities - areal densities, shape (isotopes,) for one composition or (compositions x isotopes)
+#             for a batch (thickness sweep, per-pixel densities, ...)
+# Returns transmission of shape (energies,) or (compositions x energies)
+# Memory goes as compositions x energies, split very large batches into chunks
+# ----------------------------------------------------------------------------------
+def CalcIdealTransmissionMatrix(SigmaMatrix, Densities):
+    ExpTerm = np.asarray(Densities, dtype=float) @ SigmaMatrix
+    return np.exp(-ExpTerm, out=ExpTerm)
+
+
 # ----------------------------------------------------------------------------------
 # This function calculates Theoretical transmission on a propoerly spaced Earr mesh
 # S - dictionary of cross sections (key=IsotopeName as in data file name). Cross sect. is interpolated function!
 # Par - parameters read from the Parameter file (including path length, etc. and the elemental composition table)
 # Earr - existing array of E values on which Tr will be calculated
-# Returns the calculated transmission for the entire set of elements
+# Cross sections resampled on Earr are cached (CrossSectionLibrary.ResampledCrossSections), so calling this
+# again on the same grid does no interpolation at all
+# Returns the calculated transmission for the entire set of elements (see TransmissionPlot.PlotIdealTransmission)
 # ----------------------------------------------------------------------------------
-def CalcIdealTransmission(S, Par, Earr, Plot=False):
-    # ExpTerm = Rho * d * w * A * S2 / (w * m * A) / 1.6605389e4
-    # calculate exponential term for transmission, group by group
-    Elem = Par['Elmnts']
-    ExpTerm = np.zeros(len(Earr))  # create array with 0 values for Exponential Term
-
-    for GrpN in range(0, max(Elem['GrupN']) + 1):  # iterate over group numbers here
-        GrpSubset = Elem.loc[Elem['GrupN'] == GrpN]  # select subset of rows with GrpN
-        if len(GrpSubset) > 0:
-            A = np.zeros(len(Earr))  # empty array for that group
-            Mass = 0
-            for i in range(len(GrpSubset)):  # iterate within single group here
-                row = GrpSubset.iloc[i]
-                A += row['Abundance'] * row['AtomicFraction'] * S[row['Isotope Name']](Earr) * row['Thickness (um)'] * row['Density (g/cm3)'] / 1.6605389e4
-                Mass += row['AtomicFraction'] * row['AtomicMass']
-                print(row['Isotope Name'])
-            print('Mass=',Mass)
-            ExpTerm += A / Mass
-            print('-----------------')
-
-    Tr1 = np.exp(-ExpTerm)
-
-    if Plot :
-        plt.figure(figsize=(6,5))
-        plt.subplot(211)
-        plt.plot(Earr, Tr1, label='Ideal theory', color='b')
-        plt.xlabel("Energy (eV)")
-        plt.xscale('log')
-        plt.ylabel("Theor. transm.")
-        plt.grid(True)
-        #-------------
-        plt.subplot(212)
-        plt.plot(Get_TOF_FromE(Earr, Par['Flight path']), Tr1, label='Ideal theory', color='g')
-        plt.xlabel("TOF (us)")
-        plt.xscale('log')
-        plt.ylabel("Theor. transm.")
-        plt.grid(True)
-        # plt.yscale('log')
-        # plt.xlim([500,1200])
-        plt.subplots_adjust(top=1, bottom=0.0, left=0.0, right=1, hspace=0.3, wspace=0.1)
-
-        plt.show()
+def CalcIdealTransmission(S, Par, Earr):
+    IsotopeNames, Densities = CalcArealDensities(Par['Elmnts'])
+    SigmaMatrix = BuildCrossSectionMatrix(S, IsotopeNames, Earr)
+    Tr1 = CalcIdealTransmissionMatrix(SigmaMatrix, Densities)
 
     return Tr1
 
 
 # -------------------------------------------------------------------------------
-# Convolve idealtransmission with the neutron pulse time profile
-# EarrIdeal - array of energy values for which Tr needs to be convolved
-# TrIdeal   - function interpolated for the ideal theoretical transmission
-# Returns the function interpolated for convlolved transmission on interval [Emin,Emax]
+# Beam profiles of all the energies Earr at once, one row per energy
+# Returns (BeamProfile_T, BeamProfile_Amp), both of shape (len(Earr), BEAM_ARR_DIM):
+# the times relative to T0 (us) and the normalized amplitudes of every profile
+# Profiles are interpolated from the precomputed table of BeamProfileLibrary, they are only
+# calculated directly for energies outside of it
 # -------------------------------------------------------------------------------
-def ConvolveTrWithPulseProfile(Par, EarrIdeal, TrIdeal, BEAM_ARR_DIM, Plot=False, FileOutput=False):
-    # create the time array corresponding to energy array of theoretical cross ection
-    Tarr1 = Get_TOF_FromE(EarrIdeal, Par['Flight path'])
+def BeamProfileKernels(ProtonPulseGap, Earr, BEAM_ARR_DIM):
+    Table = GetBeamProfileTable(BEAM_ARR_DIM)
+    if Table.Covers(Earr):
+        return Table.Kernels(ProtonPulseGap, Earr)
+    return bm.BeamProfileArraysCalculated(ProtonPulseGap, Earr, BEAM_ARR_DIM)
 
-    # interpolate transmission over new Tarr
-    # Tr = interp1d(Tarr1, TrIdeal, kind='linear', fill_value='extrapolate')
-    Tr1 = interp1d(Tarr1, TrIdeal, kind='linear')
 
-    # create working arrays to be used in convolution, only needed here
-    BeamProfile_T = np.zeros(BEAM_ARR_DIM)  # just make an empty array to be filled up
-    BeamProfile_Amp = np.zeros(BEAM_ARR_DIM)  # just make an empty array to be filled up
-    TrTemp = np.zeros(BEAM_ARR_DIM)  # just make an empty array to be filled up
+# -------------------------------------------------------------------------------
+# Convolution of the transmission TrIdeal(Tarr1) with precomputed beam profiles
+# Tarr1, TrIdeal - TOF (us, any order) and ideal transmission
+# Tarr2 - TOF values (us) at which convolved transmission is needed, one per kernel row
+# BeamProfile_T, BeamProfile_Amp - kernels as returned by BeamProfileKernels
+# Every kernel is shifted to its TOF, the ideal transmission is interpolated on the whole
+# (points x BEAM_ARR_DIM) table in one call and weighted by the kernel amplitudes.
+# Rows are done in blocks of ChunkSize to keep the temporary table small.
+# Returns the convolved transmission at Tarr2
+# -------------------------------------------------------------------------------
+def ConvolveWithKernels(Tarr1, TrIdeal, Tarr2, BeamProfile_T, BeamProfile_Amp, ProgressCallback=None, ChunkSize=8192):
+    # np.interp needs ascending abscissa, TOF from an ascending energy grid is descending
+    order = np.argsort(Tarr1)
+    Tsorted = Tarr1[order]
+    TrSorted = TrIdeal[order]
+
+    Tr2 = np.empty(len(Tarr2))
+    for i0 in range(0, len(Tarr2), ChunkSize):
+        i1 = min(i0 + ChunkSize, len(Tarr2))
+        # times as BmProfile shifted by Tarr2[i] for every row
+        Tshifted = BeamProfile_T[i0:i1] + Tarr2[i0:i1, np.newaxis]
+        if Tshifted.min() < Tsorted[0] or Tshifted.max() > Tsorted[-1]:
+            raise OutsideOfTOFRange("Beam profile reaches outside of the ideal transmission TOF range")
+        TrTemp = np.interp(Tshifted, Tsorted, TrSorted)
+        Tr2[i0:i1] = np.einsum('ij,ij->i', BeamProfile_Amp[i0:i1], TrTemp)
+        if ProgressCallback is not None:
+            ProgressCallback(i1, len(Tarr2))
+    return Tr2
+
 
+# -------------------------------------------------------------------------------
+# Energies at which the convolved transmission is calculated, the part of EarrIdeal far enough
+# from Emin for the whole beam profile to fit in. All the points are kept: the beam profile is a sum of
+# BEAM_ARR_DIM shifted copies, it does not smooth out the structure of the ideal transmission
+# Returns Earr2; the TOF of its first point is the longest TOF (Tmax) where the convolution is valid
+# -------------------------------------------------------------------------------
+def ConvolutionEnergies(Par, EarrIdeal):
     # select only fraction of Earr between Emin and Emax, otherwise interpolation does not work for BeamProfile width added on the right side
     #Earr2 = EarrIdeal[np.where((EarrIdeal >= Par['Minimum E']) & (EarrIdeal <= Par['Maximum E']))]
     # leave only those elements which have enough data for convolution  - cut the left side of the array
@@ -368,22 +449,75 @@ def ConvolveTrWithPulseProfile(Par, EarrIdeal, TrIdeal, BEAM_ARR_DIM, Plot=False
     Tmax = Get_TOF_FromE(min(EarrIdeal), Par['Flight path']) - bm.BeamProfileWidth(min(EarrIdeal))*1.05  # 1.05 is the safety margin
     Emin = Get_E_FromTOF(Tmax, Par['Flight path'])
     Earr2 = EarrIdeal[np.where((EarrIdeal >= Emin))]
-    Earr2 = Earr2[0::Par['CROSS_SECT_SKIP_POINTS']]  # take each N-th element in the Energy properly spaced array to speed up calculation
+    if Tmax <= 0 or len(Earr2) == 0:
+        raise OutsideOfTOFRange("The beam profile is wider than the whole TOF range of the model at L = {0} m".format(Par['Flight path']))
     #include last point Emax in Earr2
     if Earr2[-1] < EarrIdeal[-1]: Earr2 = np.append(Earr2, max(EarrIdeal))
+    return Earr2
+
 
-    Tr2 = np.zeros(len(Earr2))  # just make an empty array to be filled up
+# -------------------------------------------------------------------------------
+# TOF grid of the convolved transmission, refined for TrIdeal
+# Starts from the TOF of ConvolutionEnergies and halves the intervals whose middle point is off the straight line
+# by more than Tolerance/2, then SimplifyCurve drops the points not needed. The beam profile is a sum of shifted
+# copies, so the convolved curve has resonances where EarrIdeal has no points and needs its own grid.
+# TrIdeal - ideal transmission on EarrIdeal, or (trials x len(EarrIdeal)) for a grid good for all of them
+# Tolerance = None uses the TOF of ConvolutionEnergies as they are
+# Returns (Tarr2, Tr2): the TOF (descending, Tarr2[0] is Tmax) and the convolved transmission(s) on it
+# -------------------------------------------------------------------------------
+def RefineConvolutionTOF(Par, EarrIdeal, TrIdeal, BEAM_ARR_DIM, Tolerance=1e-4, ProgressCallback=None):
+    # create the time array corresponding to energy array of theoretical cross ection
+    Tarr1 = Get_TOF_FromE(EarrIdeal, Par['Flight path'])
+    TrIdeal = np.atleast_2d(TrIdeal)
+
+    Earr2 = ConvolutionEnergies(Par, EarrIdeal)
     Tarr2 = Get_TOF_FromE(Earr2, Par['Flight path']) # pay attention here that Tarr2 is in reverse order, descending
 
     print('Will calculate', len(Earr2), 'points in time between', Earr2[0], 'eV and', Earr2[-1], 'eV')
 
-    for i in tqdm_notebook(range(len(Earr2)), total=len(Earr2), desc="Convolving with beam profile", bar_format="{l_bar}{bar} [ time left: {remaining} ]") :
-#        for i in range(len(Earr2)):
-        E = Earr2[i]
-        bm.BeamProfileArrayCalculated(Par['Proton pulse gap'], E, BeamProfile_T, BeamProfile_Amp, BEAM_ARR_DIM)
-        TrTemp = Tr1(BeamProfile_T + Tarr2[i])  # these are arrays, not scalars, times as BmProfile shifted by Tarr4[i]
-        Tr2[i] = np.sum(np.multiply(BeamProfile_Amp, TrTemp))
-        len(Earr2)
+    def Convolve(Tarr, Callback=None):
+        BeamProfile_T, BeamProfile_Amp = BeamProfileKernels(Par['Proton pulse gap'], Get_E_FromTOF(Tarr, Par['Flight path']), BEAM_ARR_DIM)
+        return np.array([ConvolveWithKernels(Tarr1, Tr, Tarr, BeamProfile_T, BeamProfile_Amp, Callback) for Tr in TrIdeal])
+
+    Tr2 = Convolve(Tarr2, ProgressCallback)
+    if Tolerance is not None:
+        # only the intervals split in the previous pass are checked again; the onset of the second pulse
+        # makes the convolved curve jump, so the number of passes is limited
+        Check = np.ones(len(Tarr2) - 1, dtype=bool)
+        for i in range(16):
+            Tmid = ((Tarr2[:-1] + Tarr2[1:]) / 2)[Check]
+            Trmid = Convolve(Tmid)
+            Bad = np.any(np.abs(Trmid - ((Tr2[:, :-1] + Tr2[:, 1:]) / 2)[:, Check]) > Tolerance / 2, axis=0)
+            if not Bad.any():
+                break
+            Split = np.flatnonzero(Check)[Bad]
+            Tarr2 = np.insert(Tarr2, Split + 1, Tmid[Bad])
+            Tr2 = np.insert(Tr2, Split + 1, Trmid[:, Bad], axis=1)
+            # both halves of a split interval are new intervals
+            Check = np.zeros(len(Tarr2) - 1, dtype=bool)
+            New = Split + np.arange(len(Split))
+            Check[New] = True
+            Check[New + 1] = True
+        Keep = SimplifyCurve(Tarr2, Tr2, Tolerance)
+        Tarr2 = Tarr2[Keep]
+        Tr2 = Tr2[:, Keep]
+
+    return Tarr2, Tr2
+
+
+# -------------------------------------------------------------------------------
+# Convolve idealtransmission with the neutron pulse time profile
+# EarrIdeal - array of energy values for which Tr needs to be convolved
+# TrIdeal   - function interpolated for the ideal theoretical transmission
+# ProgressCallback - optional function called as ProgressCallback(done, total) while convolving
+# Tolerance - the convolved transmission is refined and then thinned out so that linear interpolation in TOF
+#             reproduces it to Tolerance (RefineConvolutionTOF). None uses Earr2 as it is
+# Returns the function interpolated for convlolved transmission on interval [Emin,Emax]
+# (its .x and .y are the TOF and transmission arrays, see TransmissionPlot.PlotConvolvedTransmission)
+# -------------------------------------------------------------------------------
+def ConvolveTrWithPulseProfile(Par, EarrIdeal, TrIdeal, BEAM_ARR_DIM, FileOutput=False, ProgressCallback=None, Tolerance=1e-4):
+    Tarr2, Tr2 = RefineConvolutionTOF(Par, EarrIdeal, TrIdeal, BEAM_ARR_DIM, Tolerance, ProgressCallback)
+    Tr2 = Tr2[0]
 
     # interpolate convolved transmission
     # TrConvolved = interp1d(Tarr2, Tr2, kind='linear', fill_value='extrapolate')
@@ -391,27 +525,6 @@ def ConvolveTrWithPulseProfile(Par, EarrIdeal, TrIdeal, BEAM_ARR_DIM, Plot=False
 
     #print('DONE with calucluations!\n-----------')
 
-    if Plot :
-        plt.figure(figsize=(6,5))
-        plt.subplot(211)
-        plt.plot(Get_E_FromTOF(Tarr2, Par['Flight path']), Tr2, label='Exper. predicted', color='b')
-        plt.xlabel("Energy (eV)")
-        plt.xscale('log')
-        plt.ylabel("Theor. transm.")
-        plt.grid(True)
-        #-------------
-        plt.subplot(212)
-        plt.plot(Tarr2, Tr2, label='Exper. predicted', color='g')
-        plt.xlabel("TOF (us)")
-        plt.xscale('log')
-        plt.ylabel("Theor. transm.")
-        plt.grid(True)
-        # plt.yscale('log')
-        # plt.xlim([500,1200])
-        plt.subplots_adjust(top=1, bottom=0.0, left=0.0, right=1, hspace=0.3, wspace=0.1)
-
-        plt.show()
-
     if FileOutput :
         FileArr = np.array([EarrIdeal, TrIdeal])
         FileArr = FileArr.T
@@ -436,6 +549,184 @@ def ReadExpTransmission(FileName) :
     return T, Tr
 
 
+# -------------------------------------------------------------------------------
+# Selects the experimental points inside the TOF range covered by the convolved transmission
+# Tbin - time bins of Texp (CalcTbinArray), Tmax - longest TOF of the convolved transmission
+# Returns the boolean mask of the usable points of Texp
+# -------------------------------------------------------------------------------
+def SelectExpPoints(Par, Texp, Tbin, Tmax):
+    dT = Par['Trigger delay']
+    # select only exp. points which are above the Emin(Tmax) value and below Emax
+    # T max was reduced by convolution from corresponding Emin value!!!
+    Tmin   = Get_TOF_FromE(Par['Maximum E'], Par['Flight path'])
+    #Tmax   = Get_TOF_FromE(Par['Minimum E'], Par['Flight path'])
+    Tmin1 = max(Tmin,(Tmin - dT))
+    Tmax1 = min(Tmax,(Tmax - Tbin[-1] - dT)) # use last Tbin here, the longest TOF to be used in that estimate
+    #print('Emin',Get_E_FromTOF(Tmax1, Par['Flight path']), 'Emax=', Get_E_FromTOF(Tmin1, Par['Flight path']))
+    return (Texp > Tmin1) & (Texp < Tmax1)
+
+
+# -------------------------------------------------------------------------------
+# Times at which the theoretical transmission is averaged for every selected experimental point
+# Texp1 - selected experimental TOF values, Tbin1 - their time bins, dT - trigger delay
+# Returns (len(Texp1) x NsubCells) array: NsubCells equally spaced times from the left edge of each bin
+# -------------------------------------------------------------------------------
+def ExpSampleTimes(Texp1, Tbin1, dT, NsubCells):
+    return (Texp1 + dT)[:, np.newaxis] + Tbin1[:, np.newaxis] * np.arange(NsubCells) / NsubCells
+
+
+# -------------------------------------------------------------------------------
+# Linear interpolation on the points Xarr (any order) written as a sparse matrix
+# Returns the (len(Xnew) x len(Xarr)) matrix W such that W @ Yarr is the interpolation of Yarr at Xnew
+# Weights - optional array of the shape of Xnew multiplying every row entry, rows of Xnew with more than
+#           one dimension are summed into one matrix row (e.g. a convolution kernel, or a bin average)
+# -------------------------------------------------------------------------------
+def InterpolationMatrix(Xarr, Xnew, Weights=None):
+    order = np.argsort(Xarr)
+    Xsorted = Xarr[order]
+    Xnew = np.asarray(Xnew, dtype=float)
+    if Xnew.size and (Xnew.min() < Xsorted[0] or Xnew.max() > Xsorted[-1]):
+        raise OutsideOfTOFRange("Cannot interpolate outside of the TOF range, from {0} to {1} us".format(Xsorted[0], Xsorted[-1]))
+
+    Xnew2 = Xnew.reshape(len(Xnew), int(np.prod(Xnew.shape[1:])))
+    if Weights is None:
+        Weights = np.ones(Xnew2.shape)
+    Weights = np.broadcast_to(Weights, Xnew.shape).reshape(Xnew2.shape)
+
+    k = np.clip(np.searchsorted(Xsorted, Xnew2, side='right') - 1, 0, len(Xsorted) - 2)
+    f = (Xnew2 - Xsorted[k]) / (Xsorted[k + 1] - Xsorted[k])
+    Rows = np.repeat(np.arange(len(Xnew2)), Xnew2.shape[1])
+    Rows = np.concatenate((Rows, Rows))
+    Cols = np.concatenate((order[k].ravel(), order[k + 1].ravel()))
+    Vals = np.concatenate(((Weights * (1 - f)).ravel(), (Weights * f).ravel()))
+    # duplicate (row, col) entries are summed by the conversion
+    return sparse.csr_matrix((Vals, (Rows, Cols)), shape=(len(Xnew2), len(Xarr)))
+
+
+# -------------------------------------------------------------------------------
+# Resolution matrix of the beamline: the linear map from the ideal transmission on EarrIdeal to the
+# theoretical transmission of the experimental TOF bins, i.e. beam profile convolution, interpolation
+# and averaging over NsubCells sub-cells of every time bin in one sparse matrix
+# It only depends on L, dT, the proton pulse gap, BEAM_ARR_DIM and the TOF binning, not on the materials:
+#     TrTheor = R @ TrIdeal           one composition, TrIdeal of shape (len(EarrIdeal),)
+#     TrTheor = R @ TrIdeal.T         many compositions, TrIdeal of shape (compositions x len(EarrIdeal))
+# TrTrial, Tolerance - the convolution is done onto the TOF grid refined for the trial ideal transmission(s)
+#                      (RefineConvolutionTOF), the grid ConvolveTrWithPulseProfile uses, see BuildConvolutionMatrix
+# Returns (R, ExpMask); ExpMask selects the experimental points the rows of R correspond to
+# -------------------------------------------------------------------------------
+def BuildResolutionMatrix(Par, EarrIdeal, Texp, BEAM_ARR_DIM, NsubCells, TrTrial=None, Tolerance=1e-4):
+    Convolution, Tarr2 = BuildConvolutionMatrix(Par, EarrIdeal, BEAM_ARR_DIM, TrTrial, Tolerance)
+    Average, ExpMask = BuildAverageMatrix(Par, Tarr2, Texp, NsubCells)
+    return Average @ Convolution, ExpMask
+
+
+# -------------------------------------------------------------------------------
+# First factor of the resolution matrix: beam profile convolution from EarrIdeal onto the TOF values Tarr2
+# Depends on L, not on dT. The convolved transmission has structure between the points of an adaptive EarrIdeal
+# (Get_E_Array_Adaptive), so with TrTrial (ideal transmission on EarrIdeal, or trials x len(EarrIdeal)) Tarr2 is
+# the grid refined for it to Tolerance by RefineConvolutionTOF. The grid only depends on where the resonances
+# are, so a trial at the expected densities (and one at the thickest) serves all the compositions around them.
+# Without TrTrial Tarr2 is the TOF of ConvolutionEnergies, which is only accurate for a grid dense in TOF
+# everywhere such as Get_E_Array_Properly_Spaced
+# Returns (Convolution, Tarr2)
+# -------------------------------------------------------------------------------
+def BuildConvolutionMatrix(Par, EarrIdeal, BEAM_ARR_DIM, TrTrial=None, Tolerance=1e-4):
+    L = Par['Flight path']
+    Tarr1 = Get_TOF_FromE(EarrIdeal, L)
+    if TrTrial is None:
+        Tarr2 = Get_TOF_FromE(ConvolutionEnergies(Par, EarrIdeal), L)
+    else:
+        Tarr2 = RefineConvolutionTOF(Par, EarrIdeal, TrTrial, BEAM_ARR_DIM, Tolerance)[0]
+
+    # convolution: row j is the beam profile of Tarr2[j] laid on the ideal TOF grid
+    BeamProfile_T, BeamProfile_Amp = BeamProfileKernels(Par['Proton pulse gap'], Get_E_FromTOF(Tarr2, L), BEAM_ARR_DIM)
+    return InterpolationMatrix(Tarr1, BeamProfile_T + Tarr2[:, np.newaxis], BeamProfile_Amp), Tarr2
+
+
+# -------------------------------------------------------------------------------
+# Second factor of the resolution matrix: interpolation of the convolved transmission (on Tarr2)
+# averaged over the sub-cells of every selected time bin. Depends on dT and the binning
+# Returns (Average, ExpMask)
+# -------------------------------------------------------------------------------
+def BuildAverageMatrix(Par, Tarr2, Texp, NsubCells):
+    Tbin = CalcTbinArray(Texp)
+    ExpMask = SelectExpPoints(Par, Texp, Tbin, Tarr2[0])
+    Texp1 = Texp[ExpMask]
+    Average = InterpolationMatrix(Tarr2, ExpSampleTimes(Texp1, Tbin[ExpMask], Par['Trigger delay'], NsubCells), 1 / NsubCells)
+    return Average, ExpMask
+
+
+# -------------------------------------------------------------------------------
+# Keeps the last resolution matrix and only builds a new one when the flight path, trigger delay,
+# beam settings, energy grid, trial transmissions or TOF binning change. When only dT (or the binning)
+# changes the convolution factor and its refined TOF grid are kept and only the sparse averaging factor is rebuilt
+# -------------------------------------------------------------------------------
+class ResolutionMatrixCache:
+    def __init__(self):
+        self.Key = None
+        self.Matrix = None
+        self.ExpMask = None
+        self.ConvolutionKey = None
+        self.Convolution = None
+        self.Tarr2 = None
+
+    def Get(self, Par, EarrIdeal, Texp, BEAM_ARR_DIM, NsubCells, TrTrial=None, Tolerance=1e-4):
+        ConvolutionKey = (Par['Flight path'], Par['Proton pulse gap'], BEAM_ARR_DIM, ResampledCrossSections.GridHash(EarrIdeal),
+                          None if TrTrial is None else ResampledCrossSections.GridHash(TrTrial), Tolerance)
+        Key = ConvolutionKey + (Par['Trigger delay'], NsubCells, ResampledCrossSections.GridHash(Texp))
+        if Key == self.Key:
+            return self.Matrix, self.ExpMask
+        if ConvolutionKey != self.ConvolutionKey:
+            self.Convolution, self.Tarr2 = BuildConvolutionMatrix(Par, EarrIdeal, BEAM_ARR_DIM, TrTrial, Tolerance)
+            self.ConvolutionKey = ConvolutionKey
+        Average, self.ExpMask = BuildAverageMatrix(Par, self.Tarr2, Texp, NsubCells)
+        self.Matrix = Average @ self.Convolution
+        self.Key = Key
+        return self.Matrix, self.ExpMask
+
+
+# one cache per process, shared by FitArealDensities, EnsembleSampler.SampleArealDensities and
+# DensityLookup.BuildThicknessSweepTable, so a sampling run after a fit of the same data builds nothing
+_ResolutionMatrices = None
+
+def GetResolutionMatrixCache():
+    global _ResolutionMatrices
+    if _ResolutionMatrices is None:
+        _ResolutionMatrices = ResolutionMatrixCache()
+    return _ResolutionMatrices
+
+
+# -------------------------------------------------------------------------------
+# Convolved transmissions (ConvolveTrWithPulseProfile) of the last few flight paths
+# The convolution does not depend on the trigger delay: evaluations which only shift dT reuse the
+# convolved interpolant and only redo the cheap averaging over the experimental bins
+# -------------------------------------------------------------------------------
+class ConvolvedTransmissionCache:
+    def __init__(self, MaxEntries=8):
+        self.MaxEntries = MaxEntries
+        self.Entries = OrderedDict()  # key -> (TrConvolved, Tmax)
+
+    def Get(self, Par, EarrIdeal, TrIdeal, BEAM_ARR_DIM):
+        Key = (Par['Flight path'], Par['Proton pulse gap'], BEAM_ARR_DIM,
+               ResampledCrossSections.GridHash(EarrIdeal), ResampledCrossSections.GridHash(TrIdeal))
+        if Key in self.Entries:
+            self.Entries.move_to_end(Key)
+        else:
+            self.Entries[Key] = ConvolveTrWithPulseProfile(Par, EarrIdeal, TrIdeal, BEAM_ARR_DIM)
+            if len(self.Entries) > self.MaxEntries:
+                self.Entries.popitem(last=False)
+        return self.Entries[Key]
+
+
+_ConvolvedTransmissions = None
+
+def GetConvolvedTransmissionCache():
+    global _ConvolvedTransmissions
+    if _ConvolvedTransmissions is None:
+        _ConvolvedTransmissions = ConvolvedTransmissionCache()
+    return _ConvolvedTransmissions
+
+
 # -------------------------------------------------------------------------------
 # Calculate theoretical transmission for Experimental TOF values
 # -----INPUT
@@ -444,65 +735,63 @@ def ReadExpTransmission(FileName) :
 # TrExp - measured transmission values
 # TrConvld - Theoretical transmission convolved with beam profile
 # NsubCells - how many subcells to use in averagin of theoretical transm for TOF bin in experiment
-# Plot - optional, whether to plot the graph or not
 # -----RETURNS
-# square of differences between Exp and Theoretical values
+# Texp1, TrExp1 - the experimental points inside the usable TOF range
+# TrTheor - theoretical transmission averaged over the time bin of each of these points
 # -------------------------------------------------------------------------------
-def CalcTransmForExpPoints(Par, Texp, TrExp, TrConvld,  Tmax, NsubCells, Plot=False):
+def CalcTheorForExpPoints(Par, Texp, TrExp, TrConvld, Tmax, NsubCells):
     #Tbin = Par['Time bin']
     Tbin = CalcTbinArray(Texp)
     dT = Par['Trigger delay']
 
-    # select only exp. points which are above the Emin(Tmax) value and below Emax
-    # T max was reduced by convolution from corresponding Emin value!!!
-    Tmin   = Get_TOF_FromE(Par['Maximum E'], Par['Flight path'])
-    #Tmax   = Get_TOF_FromE(Par['Minimum E'], Par['Flight path'])
-    Tmin1 = max(Tmin,(Tmin - dT))
-    Tmax1 = min(Tmax,(Tmax - Tbin[-1] - dT)) # use last Tbin here, the longest TOF to be used in that estimate
-    #print('Emin',Get_E_FromTOF(Tmax1, Par['Flight path']), 'Emax=', Get_E_FromTOF(Tmin1, Par['Flight path']))
-    Texp1  = Texp  [np.where(((Texp > Tmin1) & (Texp < Tmax1)))]
-    TrExp1 = TrExp [np.where(((Texp > Tmin1) & (Texp < Tmax1)))]
+    ExpMask = SelectExpPoints(Par, Texp, Tbin, Tmax)
+    Texp1  = Texp  [ExpMask]
+    TrExp1 = TrExp [ExpMask]
 
     # calculate the values of Theoretical transmission averaged over the time bin used in experiment
-    TrTheor = np.zeros(len(Texp1))
-    # set TtempArr to first Tbin value, then will be chekcing if it needs to be recalculated
-    TbinCurrent = Tbin[0]
-    TtempArr = np.arange(NsubCells) * Tbin[0]/ NsubCells
-    for i in range(len(Texp1)):
-        #check if Tbin has changed, need to recalculate TtempArr
-        if TbinCurrent != Tbin[i] :
-            TbinCurrent = Tbin[i]
-            TtempArr = np.arange(NsubCells) * Tbin[i] / NsubCells
-        #Calculate transmission in all points in TtempArr shifted by dT and Texp[i]
-        TrTempArr = TrConvld(TtempArr + Texp1[i] + dT)
-        TrTheor[i] = np.average(TrTempArr)
+    # all the sub-cell times of all the points in one (points x NsubCells) array, one interpolant call
+    Tsub = ExpSampleTimes(Texp1, Tbin[ExpMask], dT, NsubCells)
+    TrTheor = np.mean(TrConvld(Tsub), axis=1)
+
+    return Texp1, TrExp1, TrTheor
+
+
+# -------------------------------------------------------------------------------
+# Calculate theoretical transmission for Experimental TOF values, same inputs as CalcTheorForExpPoints
+# -----RETURNS
+# square of differences between Exp and Theoretical values
+# (TransmissionPlot.PlotExpFit shows measured against fitted points)
+# -------------------------------------------------------------------------------
+def CalcTransmForExpPoints(Par, Texp, TrExp, TrConvld,  Tmax, NsubCells):
+    Texp1, TrExp1, TrTheor = CalcTheorForExpPoints(Par, Texp, TrExp, TrConvld, Tmax, NsubCells)
 
     ChiSq = np.sum((TrTheor - TrExp1) ** 2)
     #ChiSq = -np.sum( (TrTheor * TrExp1) )
     print('Chi square=', ChiSq,'\n**********************************\n')
 
-    if Plot:
-        plt.figure(figsize=(14,3.5))
-        plt.subplot(121)
-        plt.scatter(Texp1, TrExp1, label='Measured', color='g', marker='.')
-        plt.plot(Texp1, TrTheor, label='Fitted', color='m')
-        plt.legend()
-        plt.grid(True)
-        plt.xlabel("Time (us)")
-        plt.xscale('log')
-        plt.ylabel("Transmission")
-        # plt.xlim([50,200])
-        #--------------------------------
-        plt.subplot(122)
-        Earr = Get_E_FromTOF(Texp1+dT, Par['Flight path'])
-        plt.scatter(Earr, TrExp1, label='Measured', color='g', marker='.')
-        plt.plot(Earr, TrTheor, label='Fitted', color='m')
-        plt.legend()
-        plt.grid(True)
-        plt.xlabel("Energy (eV)")
-        plt.xscale('log')
-        plt.ylabel("Transmission")
+    return ChiSq
+
 
+# -------------------------------------------------------------------------------
+# Chi square of the convolved transmission TrConvld (ConvolveTrWithPulseProfile) for a whole array of
+# trigger delays Delays (us) at the flight path of Par; the TOF binning is only analysed once
+# Delays which move the experimental points outside of the convolved range get np.inf
+# Returns the array of chi square values, one per delay
+# -------------------------------------------------------------------------------
+def CalcChiSqForDelays(Par, Texp, TrExp, TrConvld, Tmax, Delays, NsubCells=NsubCells):
+    Tbin = CalcTbinArray(Texp)
+    ChiSq = np.full(len(Delays), np.inf)
+    for i, dT in enumerate(Delays):
+        Par1 = dict(Par)
+        Par1['Trigger delay'] = dT
+        ExpMask = SelectExpPoints(Par1, Texp, Tbin, Tmax)
+        Texp1 = Texp[ExpMask]
+        Tsub = ExpSampleTimes(Texp1, Tbin[ExpMask], dT, NsubCells)
+        try:
+            TrTheor = np.mean(TrConvld(Tsub), axis=1)
+        except ValueError:
+            continue
+        ChiSq[i] = np.sum((TrTheor - TrExp[ExpMask]) ** 2)
     return ChiSq
 
 
@@ -511,50 +800,197 @@ def CalcTransmForExpPoints(Par, Texp, TrExp, TrConvld,  Tmax, NsubCells, Plot=Fa
 # FitPar - list of two parameters L and dT in FitPar[0] and FitPar[1]
 # Texp, TrExp_T - experimental data cross section
 # EarrIdeal, TrIdeal_E - energy array and ideal theoretical cross section function
-# Par - parameters of the model
+# Par - parameters of the model, not modified (the fitted L and dT go into a copy)
+# Convolved - cache of the convolved transmissions, by default the one of the process (GetConvolvedTransmissionCache),
+#             so evaluations which only move dT, or come back to an L, do not convolve again
+# FitPathCalibration does the whole fit with its own cache and reports progress, prefer it to minimizing this
 # -------------------------------------------------------------------------------
-def FuncToMinimize_PathCalibration(FitPar, Texp, TrExp_T, EarrIdeal, TrIdeal_E, Par):
+def FuncToMinimize_PathCalibration(FitPar, Texp, TrExp_T, EarrIdeal, TrIdeal_E, Par, BEAM_ARR_DIM=BEAM_ARR_DIM, NsubCells=NsubCells,
+                                   Convolved=None):
+    Par = dict(Par)
     Par['Flight path'] = FitPar[0]
     Par['Trigger delay'] = FitPar[1]
     print('L=', FitPar[0], 'dT=', FitPar[1])
     # ----------------------------------------------------------------------------------
     # Convolve ideal Theoretical transmission with beam pulse profile
-    # this depends on L and dT parameters, needs to be within minimizer
-    TrConv_T, Tmax = tr.ConvolveTrWithPulseProfile(Par, EarrIdeal, TrIdeal_E, BEAM_ARR_DIM)
+    # this depends on L only, the cache keeps it for the dT steps of the minimizer
+    if Convolved is None:
+        Convolved = GetConvolvedTransmissionCache()
+    TrConv_T, Tmax = Convolved.Get(Par, EarrIdeal, TrIdeal_E, BEAM_ARR_DIM)
     # Calculate the difference from experimental points
-    ChiSq = tr.CalcTransmForExpPoints(Par, Texp, TrExp_T, TrConv_T, Tmax, NsubCells)
+    ChiSq = CalcTransmForExpPoints(Par, Texp, TrExp_T, TrConv_T, Tmax, NsubCells)
 
     return ChiSq
 
 
+class FitCancelled(Exception):
+    pass
+
+
+# -------------------------------------------------------------------------------
+# Calibration of the flight path L and trigger delay dT against a measured spectrum
+# Nelder-Mead simplex started from Par['Flight path'], Par['Trigger delay'], with initial steps Step (m, us)
+# Texp, TrExp - measured TOF (us, without the trigger delay) and transmission
+# EarrIdeal, TrIdeal - ideal transmission of the sample (CalcIdealTransmission), calculated once by the caller
+# Callback - optional function called with a dictionary every time the fit improves:
+#            'Flight path', 'Trigger delay', 'ChiSq', 'Evaluations', and the selected points 'Texp', 'TrExp'
+#            with the theory 'TrTheor' for them
+# Cancelled - optional function checked before every evaluation, the fit stops when it returns True
+# Returns a dictionary with the best 'Flight path', 'Trigger delay', 'ChiSq', the number of 'Evaluations',
+# 'Cancelled', 'Success' (the simplex converged) and 'InitialChiSq' (at the starting L, dT)
+# -------------------------------------------------------------------------------
+def FitPathCalibration(Par, Texp, TrExp, EarrIdeal, TrIdeal, BEAM_ARR_DIM=BEAM_ARR_DIM, NsubCells=NsubCells,
+                       Step=(0.05, 0.5), MaxIter=200, Callback=None, Cancelled=None):
+    Best = {'Flight path': Par['Flight path'], 'Trigger delay': Par['Trigger delay'], 'ChiSq': np.inf,
+            'Evaluations': 0, 'Cancelled': False, 'Success': False, 'InitialChiSq': np.inf}
+
+    # steps which only move dT skip the convolution
+    Convolved = ConvolvedTransmissionCache()
+
+    def Evaluate(FitPar):
+        if Cancelled is not None and Cancelled():
+            raise FitCancelled()
+        Par1 = dict(Par)
+        Par1['Flight path'] = FitPar[0]
+        Par1['Trigger delay'] = FitPar[1]
+        Best['Evaluations'] += 1
+        try:
+            TrConv_T, Tmax = Convolved.Get(Par1, EarrIdeal, TrIdeal, BEAM_ARR_DIM)
+            Texp1, TrExp1, TrTheor = CalcTheorForExpPoints(Par1, Texp, TrExp, TrConv_T, Tmax, NsubCells)
+        except ValueError:
+            return np.inf  # L, dT moved the experimental points outside of the calculated range
+        ChiSq = np.sum((TrTheor - TrExp1) ** 2)
+        if Best['Evaluations'] == 1:
+            Best['InitialChiSq'] = float(ChiSq)  # the first vertex of the simplex is the starting point
+        if ChiSq < Best['ChiSq']:
+            Best.update({'Flight path': float(FitPar[0]), 'Trigger delay': float(FitPar[1]), 'ChiSq': float(ChiSq)})
+            if Callback is not None:
+                Callback(dict(Best, Texp=Texp1, TrExp=TrExp1, TrTheor=TrTheor))
+        return ChiSq
+
+    L0 = Par['Flight path']
+    dT0 = Par['Trigger delay']
+    Simplex = [[L0, dT0], [L0 + Step[0], dT0], [L0, dT0 + Step[1]]]
+    try:
+        Result = minimize(Evaluate, [L0, dT0], method='Nelder-Mead', options={'initial_simplex': Simplex, 'maxiter': MaxIter})
+        Best['Success'] = bool(Result.success) and np.isfinite(Best['ChiSq'])
+    except FitCancelled:
+        Best['Cancelled'] = True
+
+    return Best
+
+
+# -------------------------------------------------------------------------------
+# Fit parameters of the areal densities: the densities are n = p @ D for parameters p
+# Mode = 'Thickness' - one parameter per group (GrupN), its thickness in um; the composition stays fixed
+# Mode = 'Isotope'   - one parameter per row of Elem, its areal density (atoms/barn)
+# Returns (Labels, D, p0): parameter names, the (parameters x isotopes) matrix D and the values from Elem
+# -------------------------------------------------------------------------------
+def DensityParametrization(Elem, Mode='Thickness'):
+    if Mode == 'Thickness':
+        Groups = np.unique(Elem['GrupN'].to_numpy())
+        InGroup = Elem['GrupN'].to_numpy()[np.newaxis, :] == Groups[:, np.newaxis]
+        D = InGroup * ArealDensitiesPerThickness(Elem)[np.newaxis, :]
+        p0 = np.array([Elem['Thickness (um)'].to_numpy(dtype=float)[Row][0] for Row in InGroup])
+        Labels = ['Thickness (um) of group {0}'.format(g) for g in Groups]
+    elif Mode == 'Isotope':
+        Labels, p0 = CalcArealDensities(Elem)
+        D = np.identity(len(p0))
+    else:
+        raise Exception("Unknown areal density parametrization {0}, use 'Thickness' or 'Isotope'".format(Mode))
+    return Labels, D, p0
+
+
+# -------------------------------------------------------------------------------
+# Least squares fit of the areal densities at fixed L and dT
+# S - cross sections (LoadCrossSectionsData), EarrIdeal - energy grid of the ideal transmission
+# Texp, TrExp - measured TOF (us, without the trigger delay) and transmission
+# Mode - what is fitted, see DensityParametrization
+# The model is TrTheor = R @ exp(-(p @ D) @ Sigma) with R the resolution matrix (GetResolutionMatrixCache),
+# so its Jacobian is analytic: d TrTheor / d p_k = -R @ ((D @ Sigma)[k] * TrIdeal), all the columns
+# from one sparse matrix product per iteration. R is refined for the trial densities TrialFactors times
+# the table values, which keeps it as accurate as ConvolveTrWithPulseProfile over that range
+# Returns a dictionary with the fitted 'Parameters', their 'Labels' and 'Errors' (from the Jacobian),
+# the areal 'Densities' of the rows of Par['Elmnts'], 'ChiSq', and the points 'Texp', 'TrExp', 'TrTheor'
+# -------------------------------------------------------------------------------
+def FitArealDensities(Par, Texp, TrExp, EarrIdeal, S, Mode='Thickness', BEAM_ARR_DIM=BEAM_ARR_DIM, NsubCells=NsubCells):
+    Elem = Par['Elmnts']
+    Labels, D, p0 = DensityParametrization(Elem, Mode)
+    SigmaMatrix = BuildCrossSectionMatrix(S, list(Elem['Isotope Name']), EarrIdeal)
+    G = D @ SigmaMatrix  # (parameters x energies), d ExpTerm / d p
+    TrTrial = CalcIdealTransmissionMatrix(G, np.outer(TrialFactors, p0))
+    R, ExpMask = GetResolutionMatrixCache().Get(Par, EarrIdeal, Texp, BEAM_ARR_DIM, NsubCells, TrTrial)
+    TrExp1 = TrExp[ExpMask]
+
+    def Residuals(p):
+        return R @ CalcIdealTransmissionMatrix(G, p) - TrExp1
+
+    def Jacobian(p):
+        TrIdeal = CalcIdealTransmissionMatrix(G, p)
+        return -(R @ (G * TrIdeal).T)
+
+    Fit = least_squares(Residuals, p0, jac=Jacobian, bounds=(0, np.inf), x_scale='jac')
+
+    ChiSq = np.sum(Fit.fun ** 2)
+    # parameter errors from the Jacobian, the residual variance standing for the measurement noise
+    Dof = max(len(TrExp1) - len(p0), 1)
+    JTJ = Fit.jac.T @ Fit.jac
+    Errors = np.sqrt(np.diag(np.linalg.pinv(JTJ)) * ChiSq / Dof)
+
+    return {'Parameters': Fit.x, 'Labels': Labels, 'Errors': Errors, 'Densities': Fit.x @ D, 'ChiSq': ChiSq,
+            'Texp': Texp[ExpMask], 'TrExp': TrExp1, 'TrTheor': Fit.fun + TrExp1}
+
+
+# -------------------------------------------------------------------------------
+# Splits the experimental TOF array into segments of constant time bin, all at once
+# A spacing between two neighbouring points is a bin width if it is within RelTol of the spacing before or
+# after it, otherwise it is a readout gap (or a shutter gap). A segment starts after every gap and wherever
+# the bin width changes. RelTol = 0.05 because Spectra.txt files have a limited number of digits and the bins
+# vary slightly, e.g. 10.24 us binning at 10 ms has 10000.2, then 10001.3, etc
+# Input: Texp - TOF array from experimental data file (ascending)
+# Returns (Starts, Widths, Index): the index of the first point of every segment, the mean bin width of every
+# segment and the segment of every point of Texp, so the bin width of point i is Widths[Index[i]]
+# -------------------------------------------------------------------------------
+def SegmentTOFArray(Texp, RelTol=0.05):
+    TexpDif = np.diff(Texp)
+    if len(TexpDif) < 2 or np.any(TexpDif <= 0):
+        raise Exception("Cannot calculate Tbn array, TOF array has to be ascending with at least 3 points!!!!\n Exit here")
+
+    # spacing i against spacing i+1
+    Same = np.abs(TexpDif[1:] - TexpDif[:-1]) <= RelTol * np.minimum(TexpDif[1:], TexpDif[:-1])
+    SameAsPrev = np.concatenate(([False], Same))
+    SameAsNext = np.concatenate((Same, [False]))
+    IsBin = SameAsPrev | SameAsNext
+
+    # point i starts a segment if the bin to its right is a bin width different from the spacing before it
+    NewSegment = np.zeros(len(Texp), dtype=bool)
+    NewSegment[0] = True
+    NewSegment[1:-1] = IsBin[1:] & ~SameAsPrev[1:]
+    Starts = np.flatnonzero(NewSegment)
+    Index = np.cumsum(NewSegment) - 1
+
+    # mean of the bin spacings of every segment; a segment without any (a lone point between two gaps)
+    # gets the spacing to its right
+    Counts = np.bincount(Index[:-1][IsBin], minlength=len(Starts))
+    Sums = np.bincount(Index[:-1][IsBin], weights=TexpDif[IsBin], minlength=len(Starts))
+    Widths = np.where(Counts > 0, Sums / np.maximum(Counts, 1), TexpDif[np.minimum(Starts, len(TexpDif) - 1)])
+    return Starts, Widths, Index
+
+
 # -------------------------------------------------------------------------------
 # Calculate array of Tbn values from the experimental TOF array.
 # The left boundary is saved in Pixelman code, Tbin starts from TOF value to the right (adding time)
+# Readout gaps are taken care of by SegmentTOFArray, every point gets the bin width of its segment
 # Input: Texp - TOF array from experimental data file
 # Returns: Tbin Array
 # -------------------------------------------------------------------------------
 def CalcTbinArray(Texp):
-    # Calculate Tbin array automatically
-    # need to take care of the readout gaps
-    TexpDif1 = np.diff(Texp)
-    TexpDif2 = np.diff(TexpDif1)
-
-    # check that there are not too many jumps in Tbin values (due to gaps), otherwise something is not right here
-    if len(np.where(TexpDif2>TexpDif1[1:]*0.05)) > 100 : # compared to *0.05 - Spectra.txt file has limited number of digits and often Tbins vary slightly, e.g. 10.24 us binning at 10 ms has 10000.2, then 10001.3, etc
-        raise Exception("Cannot calculate Tbn array, something is wrong with TOF array!!!!\n Too many large jumps in TOF array\n Exit here")
-    print('Found gaps in TOF array at indices',np.where(TexpDif2>TexpDif1[1:]*0.05))
-
-    Tbin = np.zeros(len(Texp))
-    # first cell is set to second Diff cell
-    Tbin[0] = TexpDif1[0]
-    # rest of Tbins are the differences from the cell to the previos one
-    Tbin[1:] = TexpDif1
-    # now correct those large jumps in TexpDiff1 (e.g. gaps for readout) - set them to proper values
-    for i in np.where(TexpDif2>TexpDif1[1:]*0.05):
-        Tbin[i+2] = TexpDif1[i+2]
-
-    #plt.plot(Texp, Tbin, label='Fitted', color='m')
-    #plt.xlim([0,100])
-    #plt.ylim([0,0.1])
-
-    return Tbin
+    Starts, Widths, Index = SegmentTOFArray(Texp)
+
+    # check that the segments are not too short, otherwise something is not right with the TOF array
+    if len(Starts) > len(Texp) / 3:
+        raise Exception("Cannot calculate Tbn array, something is wrong with TOF array!!!!\n {0} segments of constant binning in {1} points\n Exit here".format(len(Starts), len(Texp)))
+    if len(Starts) > 1:
+        print('Found', len(Starts) - 1, 'gaps in TOF array, segments start at indices', Starts[1:])
+
+    return Widths[Index]
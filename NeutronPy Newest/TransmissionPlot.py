@@ -0,0 +1,153 @@
+#---------------------------------------------------------------------------------
+# Presentation layer of the transmission model: the pyplot figures which used to be drawn
+# from inside TransmissionCalc. Only for notebooks and scripts, the computation never imports this.
+#---------------------------------------------------------------------------------
+import matplotlib.pyplot as plt
+import numpy as np
+import TransmissionCalc as tr
+
+
+#---------------------------------------------------------------------------------
+# Cross section table of one isotope against its interpolation
+# CrossSection - the interpolated function returned by LoadSingleCrossSection
+#---------------------------------------------------------------------------------
+def PlotCrossSection(IsotopeName, CrossSection):
+    Earr = CrossSection.x
+    Sarr = CrossSection.y
+    Sarr2 = CrossSection(Earr)
+
+    plt.figure(figsize=(6, 2.5))
+    plt.plot(Earr, Sarr, label=IsotopeName, color='b', marker='.')
+    plt.plot(Earr, Sarr2, label='Interpolated', color='r')
+    plt.grid(True)
+    plt.xlabel("Neutron energy (eV)")
+    plt.ylabel("Cross section (barns)")
+    plt.xscale('log')
+    plt.yscale('log')
+    #plt.xlim([4, 4.5])
+    #plt.ylim([-5, 10])
+    plt.legend()
+    plt.show()
+
+
+#---------------------------------------------------------------------------------
+# Ideal transmission Tr1 calculated on Earr by CalcIdealTransmission, vs energy and vs TOF
+#---------------------------------------------------------------------------------
+def PlotIdealTransmission(Par, Earr, Tr1):
+    plt.figure(figsize=(6,5))
+    plt.subplot(211)
+    plt.plot(Earr, Tr1, label='Ideal theory', color='b')
+    plt.xlabel("Energy (eV)")
+    plt.xscale('log')
+    plt.ylabel("Theor. transm.")
+    plt.grid(True)
+    #-------------
+    plt.subplot(212)
+    plt.plot(tr.Get_TOF_FromE(Earr, Par['Flight path']), Tr1, label='Ideal theory', color='g')
+    plt.xlabel("TOF (us)")
+    plt.xscale('log')
+    plt.ylabel("Theor. transm.")
+    plt.grid(True)
+    # plt.yscale('log')
+    # plt.xlim([500,1200])
+    plt.subplots_adjust(top=1, bottom=0.0, left=0.0, right=1, hspace=0.3, wspace=0.1)
+
+    plt.show()
+
+
+#---------------------------------------------------------------------------------
+# Transmission convolved with the beam profile
+# TrConvolved - the interpolated function returned by ConvolveTrWithPulseProfile
+#---------------------------------------------------------------------------------
+def PlotConvolvedTransmission(Par, TrConvolved):
+    Tarr2 = TrConvolved.x
+    Tr2 = TrConvolved.y
+
+    plt.figure(figsize=(6,5))
+    plt.subplot(211)
+    plt.plot(tr.Get_E_FromTOF(Tarr2, Par['Flight path']), Tr2, label='Exper. predicted', color='b')
+    plt.xlabel("Energy (eV)")
+    plt.xscale('log')
+    plt.ylabel("Theor. transm.")
+    plt.grid(True)
+    #-------------
+    plt.subplot(212)
+    plt.plot(Tarr2, Tr2, label='Exper. predicted', color='g')
+    plt.xlabel("TOF (us)")
+    plt.xscale('log')
+    plt.ylabel("Theor. transm.")
+    plt.grid(True)
+    # plt.yscale('log')
+    # plt.xlim([500,1200])
+    plt.subplots_adjust(top=1, bottom=0.0, left=0.0, right=1, hspace=0.3, wspace=0.1)
+
+    plt.show()
+
+
+#---------------------------------------------------------------------------------
+# Measured against fitted transmission, vs TOF and vs energy
+# same inputs as TransmissionCalc.CalcTransmForExpPoints
+#---------------------------------------------------------------------------------
+def PlotExpFit(Par, Texp, TrExp, TrConvld, Tmax, NsubCells):
+    Texp1, TrExp1, TrTheor = tr.CalcTheorForExpPoints(Par, Texp, TrExp, TrConvld, Tmax, NsubCells)
+    dT = Par['Trigger delay']
+
+    plt.figure(figsize=(14,3.5))
+    plt.subplot(121)
+    plt.scatter(Texp1, TrExp1, label='Measured', color='g', marker='.')
+    plt.plot(Texp1, TrTheor, label='Fitted', color='m')
+    plt.legend()
+    plt.grid(True)
+    plt.xlabel("Time (us)")
+    plt.xscale('log')
+    plt.ylabel("Transmission")
+    # plt.xlim([50,200])
+    #--------------------------------
+    plt.subplot(122)
+    Earr = tr.Get_E_FromTOF(Texp1+dT, Par['Flight path'])
+    plt.scatter(Earr, TrExp1, label='Measured', color='g', marker='.')
+    plt.plot(Earr, TrTheor, label='Fitted', color='m')
+    plt.legend()
+    plt.grid(True)
+    plt.xlabel("Energy (eV)")
+    plt.xscale('log')
+    plt.ylabel("Transmission")
+    plt.show()
+
+
+#---------------------------------------------------------------------------------
+# Chi square landscape over flight path and trigger delay (ParallelFit.CalcChiSqLandscape)
+# Fit - optional fit dictionary (ParallelFit.FitPathCalibrationGlobal), its result is marked on the map
+#---------------------------------------------------------------------------------
+def PlotChiSqLandscape(Larr, dTarr, Landscape, Fit=None):
+    plt.figure(figsize=(6,5))
+    Masked = np.ma.masked_invalid(Landscape)
+    plt.pcolormesh(dTarr, Larr, np.log10(Masked), shading='nearest', cmap='viridis')
+    plt.colorbar(label='log10(Chi square)')
+    iL, idT = np.unravel_index(np.argmin(Masked), Masked.shape)
+    plt.scatter([dTarr[idT]], [Larr[iL]], color='w', marker='+', label='Grid minimum')
+    if Fit is not None:
+        plt.scatter([Fit['Trigger delay']], [Fit['Flight path']], color='r', marker='x', label='Fitted')
+    plt.xlabel("Trigger delay (us)")
+    plt.ylabel("Flight path (m)")
+    plt.legend()
+    plt.show()
+
+
+#---------------------------------------------------------------------------------
+# Distributions of the bootstrap replicas of the (L, dT) calibration (ParallelFit.BootstrapPathCalibration)
+#---------------------------------------------------------------------------------
+def PlotBootstrap(Bootstrap):
+    Names = ['Flight path', 'Trigger delay']
+    Units = ['m', 'us']
+    plt.figure(figsize=(10,3.5))
+    for i in range(2):
+        plt.subplot(1, 2, i + 1)
+        plt.hist(Bootstrap['Samples'][:, i], bins=30, color='g')
+        plt.axvline(Bootstrap['Fit'][Names[i]], color='m', label='Fitted')
+        for Limit in Bootstrap['Interval'][Names[i]]:
+            plt.axvline(Limit, color='k', linestyle='--')
+        plt.xlabel("{0} ({1})".format(Names[i], Units[i]))
+        plt.ylabel("Replicas")
+        plt.legend()
+    plt.show()
@@ -53,9 +53,6 @@ class Beamline(QtWidgets.QWidget):
         self.label_11 = QtWidgets.QLabel(self.groupBox_3)
         self.label_11.setGeometry(QtCore.QRect(10, 290, 101, 16))
         self.label_11.setObjectName("label_11")
-        self.label_12 = QtWidgets.QLabel(self.groupBox_3)
-        self.label_12.setGeometry(QtCore.QRect(10, 340, 101, 16))
-        self.label_12.setObjectName("label_12")
         self.label_13 = QtWidgets.QLabel(self.groupBox_3)
         self.label_13.setGeometry(QtCore.QRect(180, 240, 101, 16))
         self.label_13.setObjectName("label_13")
@@ -88,10 +85,6 @@ class Beamline(QtWidgets.QWidget):
         self.timeBin.setGeometry(QtCore.QRect(120, 290, 51, 22))
         self.timeBin.setText("0")
         self.timeBin.setObjectName("timeBin")
-        self.skipPoints = QtWidgets.QLineEdit(self.groupBox_3)
-        self.skipPoints.setGeometry(QtCore.QRect(120, 340, 51, 22))
-        self.skipPoints.setText("0")
-        self.skipPoints.setObjectName("skipPoints")
 
         #Load beamline characteristics from file
         #self.loadbeam_button = QToolButton(self)
@@ -119,9 +112,8 @@ class Beamline(QtWidgets.QWidget):
             maximumEnergyRange = float(self.maxE.text())
             protonPulseGap = float(self.proton.text())
             timeBin = float(self.timeBin.text())
-            skipPoints = float(self.skipPoints.text())
-            #print([flightPath, delayOnTrigger, [minimumEnergyRange, maximumEnergyRange], protonPulseGap, timeBin, skipPoints])
-            return [flightPath, delayOnTrigger, [minimumEnergyRange, maximumEnergyRange], protonPulseGap, timeBin, skipPoints]
+            #print([flightPath, delayOnTrigger, [minimumEnergyRange, maximumEnergyRange], protonPulseGap, timeBin])
+            return [flightPath, delayOnTrigger, [minimumEnergyRange, maximumEnergyRange], protonPulseGap, timeBin]
         except ValueError:
             print('One of your inputs is not a number')
 
@@ -133,8 +125,7 @@ class Beamline(QtWidgets.QWidget):
             maximumEnergyRange = float(self.maxE.text())
             protonPulseGap = float(self.proton.text())
             timeBin = float(self.timeBin.text())
-            skipPoints = float(self.skipPoints.text())
-            return [flightPath, delayOnTrigger, minimumEnergyRange, maximumEnergyRange, protonPulseGap, timeBin, skipPoints]
+            return [flightPath, delayOnTrigger, minimumEnergyRange, maximumEnergyRange, protonPulseGap, timeBin]
         except ValueError:
             print('One of your inputs is not a number')
 
@@ -145,7 +136,7 @@ class Beamline(QtWidgets.QWidget):
         self.maxE.setText(str(pandasFrame.iloc[5, 3]))
         self.proton.setText(str(pandasFrame.iloc[5, 4]))
         self.timeBin.setText(str(pandasFrame.iloc[5, 5]))
-        self.skipPoints.setText(str(pandasFrame.iloc[5, 6]))
+        #column 6 of older files is the skip points of the old convolution grid, not used any more
 
 
     #populate the labels created previously with text
@@ -163,7 +154,6 @@ class Beamline(QtWidgets.QWidget):
         #self.label_9.setText(_translate("deliverable", "None Selected"))
         self.label_10.setText(_translate("deliverable", "Proton Pulse Gap"))
         self.label_11.setText(_translate("deliverable", "Time Bin"))
-        self.label_12.setText(_translate("deliverable", "Skip Points"))
         self.label_13.setText(_translate("deliverable", "microseconds"))
         self.label_14.setText(_translate("deliverable", "microseconds"))
         
@@ -0,0 +1,95 @@
+#ImagePyramid is the multi-resolution (mipmap) version of a single slice of the image cube.
+#Level 0 is the full resolution 8-bit image, every next level is half the size of the previous one.
+#Levels and tiles are only computed the first time the viewer asks for them, so a slice that is only
+#ever looked at zoomed out never has its full resolution tiles turned into pixmaps.
+
+import math
+from collections import OrderedDict
+import numpy as np
+from PyQt5.QtGui import QImage, QPixmap
+
+class ImagePyramid:
+    def __init__(self, image_data, tile_size = 256):
+        '''
+        image_data is the 2D uint8 array of the slice (already normalized for contrast)
+        tile_size is the width and height (in level pixels) of the square tiles handed to the viewer
+        '''
+        self.tile_size = tile_size
+        self.height, self.width = image_data.shape
+        self.levels = [np.ascontiguousarray(image_data)]
+        self.tiles = {} #(level, row, col) -> QPixmap
+
+        #Stop halving once the whole image fits in a single tile
+        self.max_level = 0
+        while max(self.height, self.width) > tile_size * 2 ** self.max_level:
+            self.max_level += 1
+
+    def level_for_scale(self, scale):
+        #scale is the number of screen pixels per full resolution pixel (the m11 of the view transform)
+        #Pick the coarsest level which still has at least one level pixel per screen pixel
+        if scale <= 0 or scale >= 1:
+            return 0
+        return min(int(math.floor(math.log2(1 / scale))), self.max_level)
+
+    def level(self, n):
+        #Builds the missing levels by averaging 2x2 blocks of the previous one
+        while len(self.levels) <= n:
+            prev = self.levels[-1]
+            h, w = prev.shape
+            #pad odd edges by repeating the last row/column so the block average stays defined
+            padded = np.pad(prev, ((0, h % 2), (0, w % 2)), mode = 'edge').astype(np.uint16)
+            half = (padded[0::2, 0::2] + padded[1::2, 0::2] + padded[0::2, 1::2] + padded[1::2, 1::2]) // 4
+            self.levels.append(np.ascontiguousarray(half.astype(np.uint8)))
+        return self.levels[n]
+
+    def tile_grid(self, n):
+        #Number of tile rows and columns at level n
+        h, w = self.level(n).shape
+        return (h + self.tile_size - 1) // self.tile_size, (w + self.tile_size - 1) // self.tile_size
+
+    def visible_tiles(self, n, x0, y0, x1, y1):
+        '''
+        Returns the (row, col) of the level n tiles covering the scene rectangle [x0, x1] x [y0, y1],
+        scene coordinates being full resolution pixel coordinates
+        '''
+        rows, cols = self.tile_grid(n)
+        span = self.tile_size * 2 ** n #size of one tile in full resolution pixels
+        col0 = max(int(x0 // span), 0)
+        col1 = min(int(x1 // span), cols - 1)
+        row0 = max(int(y0 // span), 0)
+        row1 = min(int(y1 // span), rows - 1)
+        return [(r, c) for r in range(row0, row1 + 1) for c in range(col0, col1 + 1)]
+
+    def tile(self, n, row, col):
+        #QPixmap of one tile, converted from the level array only on first request
+        key = (n, row, col)
+        if key not in self.tiles:
+            data = self.level(n)
+            t = self.tile_size
+            block = np.ascontiguousarray(data[row * t:(row + 1) * t, col * t:(col + 1) * t])
+            h, w = block.shape
+            qimage = QImage(block.data, w, h, w, QImage.Format_Grayscale8)
+            #QPixmap.fromImage copies the pixels, so block can go out of scope afterwards
+            self.tiles[key] = QPixmap.fromImage(qimage)
+        return self.tiles[key]
+
+
+class PyramidCache:
+    #Keeps the pyramids of the last few slices around so scrolling back and forth does not rebuild them
+    def __init__(self, max_slices = 8):
+        self.max_slices = max_slices
+        self.pyramids = OrderedDict()
+
+    def get(self, key, build):
+        #key identifies the slice (e.g. slice number and contrast), build() creates the uint8 image on a miss
+        if key in self.pyramids:
+            self.pyramids.move_to_end(key)
+            return self.pyramids[key]
+        pyramid = ImagePyramid(build())
+        self.pyramids[key] = pyramid
+        if len(self.pyramids) > self.max_slices:
+            self.pyramids.popitem(last = False)
+        return pyramid
+
+    def clear(self):
+        self.pyramids.clear()
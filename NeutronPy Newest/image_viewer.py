@@ -12,9 +12,10 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 from progress_bar import Progress
+from image_pyramid import PyramidCache
 
 from beamline import Beamline
-from TransmissionCalc import Get_E_FromTOF
+from TOFAxis import TOFAxis
 
 class selector(QRubberBand):
     def __init__(self, *arg, **kwargs):
@@ -75,8 +76,12 @@ class image_viewer(QGraphicsView):
         self.zoom = 0
         self.max_zoom = 7
         self.scene = QGraphicsScene(self)
-        self.photo = QGraphicsPixmapItem()
+        #The photo is an invisible full resolution sized rectangle, the tiles of the image pyramid are its children
+        self.photo = QGraphicsRectItem()
+        self.photo.setPen(QPen(Qt.NoPen))
         self.scene.addItem(self.photo)
+        self.pyramid = None
+        self.tile_items = {} #(level, row, col) -> QGraphicsPixmapItem currently in the scene
         self.setScene(self.scene)
         self.setBackgroundBrush(QBrush(QColor(30, 30, 30)))
 
@@ -89,18 +94,44 @@ class image_viewer(QGraphicsView):
 
 
     def show_photo(self):
-        rect = QtCore.QRectF(self.photo.pixmap().rect())
+        rect = self.photo.rect()
         self.setSceneRect(rect)
 
-    def set_photo(self, pixmap=None):
+    def set_photo(self, pyramid=None):
         self.zoom = 0
         if self.rect_exists:
             self.update_rect()
-        if pixmap and not pixmap.isNull():
+        if pyramid is not None:
             self.empty = False
             self.setDragMode(QGraphicsView.ScrollHandDrag)
-            self.photo.setPixmap(pixmap)
+            self.pyramid = pyramid
+            self.photo.setRect(QtCore.QRectF(0, 0, pyramid.width, pyramid.height))
+            #tiles of the previous slice are dropped, refresh_tiles adds the ones needed for this slice
+            for item in self.tile_items.values():
+                self.scene.removeItem(item)
+            self.tile_items = {}
             self.show_photo()
+            self.refresh_tiles()
+
+    def refresh_tiles(self):
+        #Shows only the tiles of the pyramid level matching the current zoom which intersect the viewport
+        if self.pyramid is None:
+            return
+        level = self.pyramid.level_for_scale(self.transform().m11())
+        visible = self.mapToScene(self.viewport().rect()).boundingRect()
+        needed = set((level, r, c) for r, c in self.pyramid.visible_tiles(level, visible.left(), visible.top(), visible.right(), visible.bottom()))
+
+        for key in list(self.tile_items):
+            if key not in needed:
+                self.scene.removeItem(self.tile_items.pop(key))
+        span = self.pyramid.tile_size * 2 ** level
+        for key in needed:
+            if key not in self.tile_items:
+                n, r, c = key
+                item = QGraphicsPixmapItem(self.pyramid.tile(n, r, c), self.photo)
+                item.setPos(c * span, r * span)
+                item.setScale(2 ** n)
+                self.tile_items[key] = item
 
     def update_rect(self):
         top_left = self.mapFromScene(self.rect_scene.topLeft())
@@ -110,9 +141,10 @@ class image_viewer(QGraphicsView):
     def fit_to_window(self):
         self.zoom = 0
         viewrect = self.viewport().rect()
-        imagerect = self.transform().mapRect(self.photo.pixmap().rect())
+        imagerect = self.transform().mapRect(self.photo.rect())
         factor = min(viewrect.width() / imagerect.width(), viewrect.height() / imagerect.height())
         self.scale(factor, factor)
+        self.refresh_tiles()
 
     def wheelEvent(self, event):
         if (not self.rect_change):
@@ -132,6 +164,7 @@ class image_viewer(QGraphicsView):
             if (self.zoom == 0):
                 self.fit_to_window()
 
+            self.refresh_tiles()
             self.update_rect()
 
     def mousePressEvent(self, event):
@@ -161,11 +194,21 @@ class image_viewer(QGraphicsView):
     def resizeEvent(self, event):
         self.update_rect()
         QGraphicsView.resizeEvent(self, event)
+        self.refresh_tiles()
+
+    def scrollContentsBy(self, dx, dy):
+        #Panning (drag or scroll bars) uncovers new parts of the scene
+        QGraphicsView.scrollContentsBy(self, dx, dy)
+        self.refresh_tiles()
 
     # def showFileName(self, sampleFileName, openBeamDirectory = "None"):
     #     self.scene.addWidget(QLabel(sampleFileName + "          Open Beam:"  + openBeamDirectory))
 
 class ImageViewerWindow(QWidget):
+    #Emitted for every sample slice as it is read from disk: (slice number, TOF, image data)
+    #Anything that wants to follow incoming data live (e.g. the spectrum monitor) connects to it
+    sliceLoaded = pyqtSignal(int, float, object)
+
     def __init__(self, beamline):
         super().__init__()
 
@@ -178,6 +221,7 @@ class ImageViewerWindow(QWidget):
         self.threadpool = QThreadPool()
 
         self.viewer = image_viewer()
+        self.pyramids = PyramidCache()
         self.files = None
         self.dir = "."
 
@@ -327,6 +371,7 @@ class ImageViewerWindow(QWidget):
 
         if path.isdir(self.dir): 
             self.files = listdir(self.dir)
+            self.pyramids.clear()
 
             pathArr = self.dir.split('/')
             self.sampledirnamelabel.setText(pathArr[-1])
@@ -348,6 +393,7 @@ class ImageViewerWindow(QWidget):
 
             #instantiate the TOF and image cube!
             self.TOF = []
+            self._tofAxis = None
             self.image_cube = []
             self.Ntrigs = []
 
@@ -371,6 +417,7 @@ class ImageViewerWindow(QWidget):
                         self.image_cube.append(hdul[0].data)
                         self.TOF.append(hdul[0].header["TOF"])
                         self.Ntrigs.append(hdul[0].header["N_TRIGS"])
+                        self.sliceLoaded.emit(fileNum, float(hdul[0].header["TOF"]), self.image_cube[-1])
                         del hdul[0].data
                         if (fileNum - 1) * 100 // fileLen  != fileNum * 100 // fileLen:
                             progress_callback.emit(fileNum / fileLen * 100, 1, 0)
@@ -468,19 +515,21 @@ class ImageViewerWindow(QWidget):
         if self.files != None:
             filename = self.dir + '/' + self.files[value]
 
-            hdul = fits.open(filename)
+            def build_image():
+                hdul = fits.open(filename)
 
-            image_data = hdul[0].data
-            image_data = image_data / image_data.max()
-            image_data = (image_data - np.min(image_data)) / (np.max(image_data) - np.min(image_data)) * (255 - self.slider.value())
-            image_data = image_data.astype(np.uint8)
+                image_data = hdul[0].data
+                image_data = image_data / image_data.max()
+                image_data = (image_data - np.min(image_data)) / (np.max(image_data) - np.min(image_data)) * (255 - self.slider.value())
+                image_data = image_data.astype(np.uint8)
 
-            hdul.close()
+                hdul.close()
+                return image_data
 
-            h,w = image_data.shape
-            qimage = QImage(image_data.data, h, w, QImage.Format_Grayscale8)
+            #The pyramid levels and tiles are built lazily by the viewer, only for what is actually on screen
+            pyramid = self.pyramids.get((value, self.slider.value()), build_image)
 
-            self.viewer.set_photo(QPixmap(qimage))
+            self.viewer.set_photo(pyramid)
 
             self.viewer.fit_to_window()
 
@@ -528,60 +577,59 @@ class ImageViewerWindow(QWidget):
         return [self.z_start.value(), self.z_end.value()]
 
 
-    #Save Input function for main.py integration
-    def saveInput(self): #returns = [[xmin, xmax], [ymin, ymax], [z_start, z_end], z, backcoef, self.sumImageCube, self.TOF]
-        try:
-            #backcoef
-            #backcoef = self.update_backcoef()
+    #Reads the rectangle, z range and beamline parameters off the widgets
+    #Has to run on the GUI thread; the expensive part (sumROI) can then run on a worker with these values
+    def readInput(self): #returns = [[xmin, xmax], [ymin, ymax], [z_start, z_end], z, flightpath, delayontrigger]
+        z = float(self.scroll_bar.value())
+        z_start, z_end = self.update_zrange()
+        xmin, xmax, ymin, ymax = self.update_rect()
 
-            #z : SliceNum
-            z = float(self.scroll_bar.value())
-
-            #z range
-            z_start, z_end = self.update_zrange()
-            
-            #xmin, xmax are the x coordinates of the rectangle user selected; same goes for y
-            xmin, xmax, ymin, ymax = self.update_rect()
-
-            #update beamline params
-            self.flightpath = self.beamline.saveInput()[0]
-            self.delayontrigger = self.beamline.saveInput()[1]
-
-            #account TOF with the delay on trigger
-            self.TOF = np.array(self.TOF)
-            self.TOF += self.delayontrigger
-
-            #load the E array from the TOF values
-            self.E = Get_E_FromTOF(self.TOF, self.flightpath)
-
-            def naive_sum_data(): 
-                try: #When we have both open beam data set and sample data image cube
-                    backcoef = np.array(self.openbeam_Ntrigs) / np.array(self.Ntrigs)
-                    backcoef = np.array(backcoef)
-                    self.sumImageCube = [backcoef[sliceNum] * np.sum((self.image_cube[sliceNum])[ymin:ymax, xmin:xmax]) / np.sum((self.openbeam_image_cube[sliceNum])[ymin:ymax, xmin:xmax]) for sliceNum in range(z_start, z_end + 1)]
-                    #TODO: This runs into runtime warning of dividing by zero - fix that! Also add operations with normalization coef
-                    assert self.TOF == self.openbeam_TOF, "The TOFs between the openbeam and the sample data is inconsistent! "
-                    
-                except: #When we don't have an open beam data set
-                    #sumImageCube is the sum of all the pixel values of the rectangle you selected for all the slices in the image_cube you created when selecting the directory
-                    self.sumImageCube = [np.sum((self.image_cube[sliceNum])[ymin:ymax, xmin:xmax]) for sliceNum in range(z_start, z_end + 1)]
-                    
-                    
-                    #NOTE: uncomment these blocks for other needed operations other than sum
-                    #self.sumImageCube = np.array([np.sum((self.image_cube[sliceNum])[ymin:ymax, xmin:xmax]) for sliceNum in range(0, len(self.image_cube))])
-            
-            naive_sum_data()
-            
-            #These print statements are here for whenever you want to see if the inputs are actually updating when you click on the plots in spectrum
-            #Can comment out if needed
-            #print("backcoef: " + str(backcoef))
-            print("xmin: " + str(xmin) + " xmax: " + str(xmax))
-            print("ymin: " + str(ymin) + " ymax: " + str(ymax))
-            print("z start: " + str(z_start) + " z end: " + str(z_end))
-            print("z: " + str(z))
-            return [[xmin, xmax], [ymin, ymax], [z_start, z_end], z, [], self.sumImageCube, self.TOF, self.E]
-        except ValueError:
-            print('One of your inputs is not a number')
+        self.flightpath = self.beamline.saveInput()[0]
+        self.delayontrigger = self.beamline.saveInput()[1]
+        return [[xmin, xmax], [ymin, ymax], [z_start, z_end], z, self.flightpath, self.delayontrigger]
+
+    #True when an open beam matching the sample slices is loaded, i.e. sumROI returns transmission and not counts
+    def hasOpenBeam(self):
+        openbeam = getattr(self, 'openbeam_image_cube', None)
+        return openbeam is not None and len(openbeam) == len(getattr(self, 'image_cube', []))
+
+    #Sums the selected rectangle of every slice in [z_start, z_end], normalized by the open beam when one is loaded
+    #Only reads the image cubes (never the widgets) so it is safe to call from a worker thread
+    def sumROI(self, xmin, xmax, ymin, ymax, z_start, z_end):
+        sample = [np.sum((self.image_cube[sliceNum])[ymin:ymax, xmin:xmax]) for sliceNum in range(z_start, z_end + 1)]
+        sample = np.array(sample, dtype = float)
+
+        if self.hasOpenBeam():
+            openbeam = self.openbeam_image_cube
+            backcoef = np.array(self.openbeam_Ntrigs[z_start:z_end + 1]) / np.array(self.Ntrigs[z_start:z_end + 1])
+            beam = np.array([np.sum((openbeam[sliceNum])[ymin:ymax, xmin:xmax]) for sliceNum in range(z_start, z_end + 1)], dtype = float)
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                return backcoef * sample / beam
+        return sample
+
+    #TOFAxis of the loaded slices for the given beamline parameters, GUI thread only
+    #The axis is only rebuilt when slices were added (still loading), a new delay or flight path reuses the rest of it
+    #Workers are handed the returned axis, which is immutable and already has its TOF and energy calculated,
+    #so self._tofAxis is only ever assigned here. self.TOF itself always stays the TOF as recorded
+    def tofAxis(self, flightpath, delayontrigger):
+        axis = getattr(self, '_tofAxis', None)
+        if axis is None or len(axis) != len(self.TOF):
+            axis = TOFAxis(self.TOF, flightpath, delayontrigger)
+        else:
+            axis = axis.Replace(FlightPath = flightpath, Delay = delayontrigger)
+        axis.Energy #calculated now, not lazily on a worker
+        self._tofAxis = axis
+        return axis
+
+    #Save Input function for main.py integration, GUI thread only
+    #Same inputs as readInput plus the ROI spectrum: one sumROI over [z_start, z_end] and the TOF / energy of these slices
+    def saveInput(self): #returns = [[xmin, xmax], [ymin, ymax], [z_start, z_end], z, [], self.sumImageCube, TOF, E]
+        (xmin, xmax), (ymin, ymax), (z_start, z_end), z, flightpath, delayontrigger = self.readInput()
+        axis = self.tofAxis(flightpath, delayontrigger)
+        self.E = axis.Energy
+        self.sumImageCube = self.sumROI(xmin, xmax, ymin, ymax, z_start, z_end)
+        return [[xmin, xmax], [ymin, ymax], [z_start, z_end], z, [], self.sumImageCube,
+                axis.TOF[z_start:z_end + 1], axis.Energy[z_start:z_end + 1]]
 
 
 
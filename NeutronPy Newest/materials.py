@@ -237,7 +237,7 @@ class Materials(QtWidgets.QWidget):
                     if j == 0 :
                         value = text
                     else:
-                        value = 'NaN'
+                        value = np.nan #a 'NaN' string cannot go into a column which already holds numbers
                 new_frame.loc[i, j] = value
         print(new_frame)
         return new_frame
@@ -9,6 +9,8 @@ from image_viewer import ImageViewerWindow
 from materials import Materials
 import numpy as np
 from error_page import Error
+from spectrum_plot import SpectrumPlot
+import TransmissionCalc as tr
 
 #Graphing modules
 from matplotlib.figure import Figure
@@ -24,17 +26,26 @@ else:
 
 
 
-class plotLoader(QRunnable):
-    #Separate Thread to handle mutliprocesses 
-    #This one, in particular, deals with assisting the plotting that happens on Button 1 (left)
+##SpectrumComputeSignal and SpectrumComputer split every spectrum button into a compute and a present step
+##The compute function runs on the thread pool (ROI sums, theory arrays...) and never touches matplotlib,
+##its result is delivered through the result signal to a slot on the GUI thread which only updates the artists
+class SpectrumComputeSignal(QObject):
+    finished = pyqtSignal()
+    error = pyqtSignal(tuple)
+    result = pyqtSignal(object)
+
+class SpectrumComputer(QRunnable):
+    #Separate Thread to handle the heavy computation behind the spectrum plots
     def __init__(self, fn, *args, **kwargs):
-        super(plotLoader, self).__init__()
+        super(SpectrumComputer, self).__init__()
         # Store constructor arguments (re-used for processing)
         #args and kwargs could be the parameters for different functionalities
         self.fn = fn
         self.args = args
         self.kwargs = kwargs
 
+        self.signals = SpectrumComputeSignal()
+
     @pyqtSlot()
     def run(self):
         try:
@@ -43,8 +54,72 @@ class plotLoader(QRunnable):
             #Handles exception if there's an issue with loading data
             traceback.print_exc()
             exctype, value = sys.exc_info()[:2]
+            self.signals.error.emit((exctype, value, traceback.format_exc()))
+        else:
+            self.signals.result.emit(result)
+        finally:
+            self.signals.finished.emit()
+
 
 
+##CalibrationFitter runs the L / dT calibration fit; it can be stopped from the GUI and streams every
+##improvement of the fit through the progress signal, so the plot follows the fit while it runs
+class CalibrationFitSignal(SpectrumComputeSignal):
+    progress = pyqtSignal(object)
+
+class CalibrationFitter(SpectrumComputer):
+    def __init__(self, fn, *args, **kwargs):
+        super(CalibrationFitter, self).__init__(fn, *args, **kwargs)
+        self.signals = CalibrationFitSignal()
+        self.cancelled = False
+        #fn gets these two as keyword arguments, see TransmissionCalc.FitPathCalibration
+        self.kwargs['Callback'] = self.signals.progress.emit
+        self.kwargs['Cancelled'] = lambda: self.cancelled
+
+    def cancel(self):
+        #Read by the worker before every evaluation of the fit
+        self.cancelled = True
+
+
+##SpectrumRingBuffer holds the running ROI sums of the live monitor
+##All arrays are allocated once when the monitor starts; pushing a slice only writes into them
+##The ROI, z range and trigger delay are copied in when the monitor starts, so other buttons
+##reading new parameters into Spectrum cannot change what a running monitor sums
+class SpectrumRingBuffer:
+    def __init__(self, capacity, beam = None, beamTriggers = None, roi = None, z_start = 0, delay = 0.0):
+        '''
+        capacity is the number of TOF slices followed (z_end - z_start + 1)
+        beam are the open beam ROI sums of these slices; without it the monitor shows raw counts
+        beamTriggers are the open beam N_TRIGS of these slices, every sum is taken per trigger like in sumROI
+        roi = (xmin, xmax, ymin, ymax) summed, z_start the first slice followed, delay the trigger delay (us)
+        '''
+        self.capacity = capacity
+        self.roi = roi
+        self.z_start = z_start
+        self.z_end = z_start + capacity - 1
+        self.delay = delay
+        self.normalized = beam is not None
+        self.tof = np.full(capacity, np.nan)
+        self.counts = np.zeros(capacity)
+        self.hits = np.zeros(capacity) #how many times each slice has been received
+        self.beam = np.ones(capacity) if beam is None else np.asarray(beam, dtype = float)
+        if beamTriggers is not None:
+            self.beam = self.beam / np.asarray(beamTriggers, dtype = float)
+        self.display = np.full(capacity, np.nan) #what gets plotted, updated in place on every push
+        self.dirty = False
+
+    def push(self, index, tof, value, triggers = 1):
+        #Adds one slice to the running sum; repeated acquisitions of the same slice are averaged
+        #triggers is the N_TRIGS of the slice, the open beam normalization (backcoef) of sumROI
+        if not 0 <= index < self.capacity:
+            raise IndexError("slice {0} is outside of the {1} slices of the monitor".format(index, self.capacity))
+        i = index
+        self.tof[i] = tof
+        self.counts[i] += value / triggers
+        self.hits[i] += 1
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            self.display[i] = self.counts[i] / self.hits[i] / self.beam[i]
+        self.dirty = True
 
 
 class Spectrum(QtWidgets.QWidget):
@@ -90,9 +165,11 @@ class Spectrum(QtWidgets.QWidget):
         btn2.clicked.connect(self.AntonCode)
         grid.addWidget(btn2, 5, 1)
 
-        btn3 = QtWidgets.QPushButton('Converging Fit', self)
-        btn3.clicked.connect(self.ConvergeFit)
-        grid.addWidget(btn3, 5, 2)
+        self.fitButton = QtWidgets.QPushButton('Converging Fit', self)
+        self.fitButton.clicked.connect(self.ConvergeFit)
+        grid.addWidget(self.fitButton, 5, 2)
+        self.fitWorker = None #the running calibration fit, pressing the button again stops it
+        self.idealCache = None #(materials and energy range, EarrIdeal, TrIdeal) of the last theory calculated
 
         btn4 = QtWidgets.QPushButton('Load Parameters', self)
         btn4.clicked.connect(self.load_csv)
@@ -102,27 +179,69 @@ class Spectrum(QtWidgets.QWidget):
         btn5.clicked.connect(self.save_csv)
         grid.addWidget(btn5, 6, 1)
 
+        self.monitorButton = QtWidgets.QPushButton('Live Monitor', self)
+        self.monitorButton.setCheckable(True)
+        self.monitorButton.toggled.connect(self.LiveMonitor)
+        grid.addWidget(self.monitorButton, 6, 2)
+
+        #The monitor redraws at a fixed rate, independent of how fast the slices come in
+        self.monitorBuffer = None
+        self.monitorConnected = False
+        self.monitorTimer = QTimer(self)
+        self.monitorTimer.setInterval(100)
+        self.monitorTimer.timeout.connect(self.updateMonitor)
+
         self.figure = Figure()
         self.canvas = FigureCanvas(self.figure)
         grid.addWidget(self.canvas, 3, 0, 1, 3)
+
+        #Persistent axes and lines, the buttons only update their data
+        self.plot = SpectrumPlot(self.canvas)
         
         self.toolbar = QtWidgets.QToolBar()
         self.toolbar.addWidget(NavigationToolbar(self.canvas, self))
         grid.setMenuBar(self.toolbar)
         #self.show() #- UNCOMMENT THIS LINE FOR SELF DEBUGGING
 
+    def compute(self, fn, present, *args):
+        '''
+        Runs fn(*args) on the thread pool and hands its result to present on the GUI thread
+        Signals emitted from the worker are queued onto the thread Spectrum lives in,
+        so present is the only place where matplotlib gets called
+        '''
+        worker = SpectrumComputer(fn, *args)
+        worker.signals.result.connect(present)
+        worker.signals.error.connect(self.computeError)
+        self.threadpool.start(worker)
+        return worker
+
+    def computeError(self, error):
+        exctype, value, trace = error
+        self.error = Error("Could not compute the spectrum: " + str(value))
+        self.error.show()
+
+    def computeROI(self, xmin, xmax, ymin, ymax, z_start, z_end, tofAxis):
+        #Worker side: ROI sums of every slice in the z range and the matching TOF / energy axes
+        #tofAxis was built on the GUI thread (getUpdatedParameters) and is only read here
+        sum_image_data = self.imageviewer.sumROI(xmin, xmax, ymin, ymax, z_start, z_end)
+        TOF = tofAxis.TOF[z_start:z_end + 1]
+        E = tofAxis.Energy[z_start:z_end + 1]
+        assert len(TOF) == len(sum_image_data), "the length of the TOF / Energy array and sum_image_data is inconsistent"
+        return {'sum_image_data': sum_image_data, 'TOF': TOF, 'E': E}
+
+    def roiArgs(self):
+        return (self.xmin, self.xmax, self.ymin, self.ymax, self.z_start, self.z_end, self.tofAxis)
+
     def crossSectionalData(self):
-        def crossSectionPlot(canvas, sumdata):
-            #Plotting initialization
-            self.figure.clear()
-            ax3 = canvas.figure.subplots()
-            #The plotting function itself
-            assert len(self.TOF) == len(self.sum_image_data), "the length of the TOF / Energy array and sum_image_data is inconsistent"
-            x = self.TOF
-            y = self.sum_image_data
-            ax3.plot(x, y, 'r.-')
-            ax3.set_title('Cross Section (Energy vs Barns)')
-            canvas.draw_idle()
+        def crossSectionPlot(result):
+            #The plotting function itself, runs on the GUI thread
+            self.sum_image_data = result['sum_image_data']
+            self.TOF = result['TOF']
+            self.E = result['E']
+            self.plot.set_line('crossSection', self.TOF, self.sum_image_data, 'r.-')
+            self.plot.show_only(['crossSection'])
+            self.plot.set_labels('Cross Section (Energy vs Barns)', '', '')
+            self.plot.update(rescale = True)
 
         try:
             '''
@@ -130,39 +249,40 @@ class Spectrum(QtWidgets.QWidget):
             and imageviewer
             '''
             self.getUpdatedParameters()
+            if getattr(self.imageviewer, 'image_cube', None) is None:
+                raise ValueError("no image cube")
             '''
             Multi-threading functionality
             '''
-            crossThread = plotLoader(crossSectionPlot, self.canvas, self.sum_image_data)
-            self.threadpool.start(crossThread)
+            self.compute(self.computeROI, crossSectionPlot, *self.roiArgs())
         except:
             self.error = Error("Sample Data Not Yet Selected for Plotting")
             self.error.show()
 
 
     def AntonCode(self):
-        def AntonPlot(canvas):
+        def AntonCompute():
             '''
-            Plotting initialization
+            The computation behind the plot (QuickFit), runs on the worker
             '''
-            self.figure.clear()
-            ax1 = canvas.figure.subplots()
+            #TODO: Implemenet Anton's codebase onto the graph using sum_image_data
+            x1 = np.arange(200)
+            y1 = np.full(len(x1), 2)
+            x1_1 = np.arange(200)
+            y1_1 = np.sin(x1_1)
+            return (x1, y1, x1_1, y1_1)
 
+        def AntonPlot(result):
             '''
-            The plotting function(s) itself (QuickFit)
+            The plotting function(s) itself, runs on the GUI thread
             As we are plotting multiple functions in one graph
-            '''    
-            #TODO: Implemenet Anton's codebase onto the graph using sum_image_data
-            x1 = [i for i in range(200)]
-            y1 = [2 for i in x1]
-            x1_1 = [i for i in range(200)]
-            y1_1 = np.sin(x1_1)
-            ax1.plot(x1, y1, 'b.-')
-            ax1.plot(x1_1, y1_1)
-            ax1.set_title("Experimental Spectrum")
-            ax1.set_xlabel("Energy / Time") #Energy, Time, or Wavelength - depending on how the user picks it
-            ax1.set_ylabel("Transmission")
-            canvas.draw_idle()
+            '''
+            x1, y1, x1_1, y1_1 = result
+            self.plot.set_line('experimental', x1, y1, 'b.-')
+            self.plot.set_line('theory', x1_1, y1_1)
+            self.plot.show_only(['experimental', 'theory'])
+            self.plot.set_labels("Experimental Spectrum", "Energy / Time", "Transmission") #Energy, Time, or Wavelength - depending on how the user picks it
+            self.plot.update(rescale = True)
         try:
             '''
             Obtaining the updated parameter inputs from beamline, materials, 
@@ -172,55 +292,186 @@ class Spectrum(QtWidgets.QWidget):
             '''
             Multi-threading functionality
             '''
-            antonThread = plotLoader(AntonPlot, self.canvas)
-            self.threadpool.start(antonThread)
+            self.compute(AntonCompute, AntonPlot)
         except:
-            antonThread = plotLoader(AntonPlot, self.canvas)
-            self.threadpool.start(antonThread)
+            self.compute(AntonCompute, AntonPlot)
 
             self.error = Error("Sample Data Not Yet Selected for Plotting")
             self.error.show()
 
     def ConvergeFit(self):
-        def ConvergePlot(canvas):
-            '''
-            Plotting initialization - there will be 2 graphs on the window
-            '''
-            self.figure.clear()
-            ax1 = canvas.figure.subplots()
-
-            '''
-            The plotting function(s) itself (QuickFit)
-            As we are plotting multiple functions in one graph
-            '''    
-            #TODO: Implemenet Anton's codebase onto the graph using sum_image_data
-            x1 = [i for i in range(200)]
-            y1 = [2 for i in x1]
-            x1_1 = [i for i in range(200)]
-            y1_1 = np.cos(x1_1)
-            ax1.plot(x1, y1, 'b.-')
-            ax1.plot(x1_1, y1_1)
-            ax1.set_title("Experimental Spectrum")
-            ax1.set_xlabel("Energy / Time") #Energy, Time, or Wavelength - depending on how the user picks it
-            ax1.set_ylabel("Transmission")
-            canvas.draw_idle()
+        '''
+        Calibrates the flight path and the delay on trigger against the spectrum of the selected region
+        The fit runs on the thread pool; the plot is updated every time it improves
+        '''
+        if self.fitWorker is not None:
+            self.fitWorker.cancel()
+            return
         try:
             '''
             Obtaining the updated parameter inputs from beamline, materials, 
             and imageviewer
             '''
             self.getUpdatedParameters()
-            '''
-            Multi-threading functionality
-            '''
-            convergeThread = plotLoader(ConvergePlot, self.canvas)
-            self.threadpool.start(convergeThread)
+            if getattr(self.imageviewer, 'image_cube', None) is None:
+                raise ValueError("no image cube")
+            Par = self.modelParameters()
+        except Exception as e:
+            self.error = Error("Cannot start the fit: select sample data, beamline parameters and materials first (" + str(e) + ")")
+            self.error.show()
+            return
+        #without an open beam the ROI sums are counts, they cannot be fitted with a transmission model
+        if not self.imageviewer.hasOpenBeam():
+            self.error = Error("Cannot start the fit: load the open beam data, the spectrum has to be a transmission")
+            self.error.show()
+            return
+
+        '''
+        Multi-threading functionality
+        '''
+        self.fitWorker = CalibrationFitter(self.computeCalibration, Par, self.roiArgs())
+        self.fitWorker.signals.progress.connect(self.calibrationProgress)
+        self.fitWorker.signals.result.connect(self.calibrationResult)
+        self.fitWorker.signals.error.connect(self.computeError)
+        self.fitWorker.signals.finished.connect(self.calibrationFinished)
+        self.fitButton.setText('Stop Fit')
+        self.threadpool.start(self.fitWorker)
+
+    def computeCalibration(self, Par, roiArgs, Callback = None, Cancelled = None):
+        #Worker side: measured spectrum of the ROI, ideal theory (cached) and the fit itself
+        xmin, xmax, ymin, ymax, z_start, z_end, tofAxis = roiArgs
+        TrExp = self.imageviewer.sumROI(xmin, xmax, ymin, ymax, z_start, z_end)
+        #the model adds the trigger delay itself, so it gets the TOF as recorded
+        Texp = tofAxis.RawTOF[z_start:z_end + 1]
+        good = np.isfinite(TrExp)
+
+        EarrIdeal, TrIdeal = self.idealTransmission(Par)
+        return tr.FitPathCalibration(Par, Texp[good], TrExp[good], EarrIdeal, TrIdeal, Callback = Callback, Cancelled = Cancelled)
+
+    def idealTransmission(self, Par):
+        #The ideal transmission only depends on the materials and the energy range, not on L and dT
+        key = (Par['Elmnts'].to_csv(), Par['Minimum E'], Par['Maximum E'])
+        if self.idealCache is None or self.idealCache[0] != key:
+            S = tr.LoadCrossSectionsData(Par)
+            EarrIdeal = tr.Get_E_Array_Adaptive(Par)
+            self.idealCache = (key, EarrIdeal, tr.CalcIdealTransmission(S, Par, EarrIdeal))
+        return self.idealCache[1], self.idealCache[2]
+
+    def calibrationProgress(self, fit):
+        #GUI side: the measured points and the current best theory
+        self.plot.set_line('experimental', fit['Texp'], fit['TrExp'], 'b.')
+        self.plot.set_line('fit', fit['Texp'], fit['TrTheor'], 'm-')
+        self.plot.show_only(['experimental', 'fit'])
+        self.plot.set_labels("L = {0:.5f} m, dT = {1:.4f} us, chi2 = {2:.5g} ({3} evaluations)".format(
+            fit['Flight path'], fit['Trigger delay'], fit['ChiSq'], fit['Evaluations']), "TOF (us)", "Transmission")
+        #the title is blitted with the lines, a full draw only happens when the points leave the view
+        self.plot.update()
+
+    def calibrationResult(self, fit):
+        if fit['Cancelled']:
+            return
+        #only a converged fit which improved on the current calibration replaces it
+        if not fit['Success'] or not fit['ChiSq'] < fit['InitialChiSq']:
+            self.error = Error("The fit did not converge to a better calibration (chi2 {0:.5g}, was {1:.5g}), L and dT are left unchanged".format(
+                fit['ChiSq'], fit['InitialChiSq']))
+            self.error.show()
+            return
+        self.beamline.length.setText(str(fit['Flight path']))
+        self.beamline.delay.setText(str(fit['Trigger delay']))
+
+    def calibrationFinished(self):
+        self.fitWorker = None
+        self.fitButton.setText('Converging Fit')
+
+    def modelParameters(self):
+        '''
+        Parameters of the transmission model in the format of TransmissionCalc.LoadParameters,
+        made from the beamline and materials inputs read by getUpdatedParameters
+        '''
+        flightPath, delayOnTrigger, energyRange, protonPulseGap, timeBin = self.beamlineInput
+        Par = {'Proton pulse gap': protonPulseGap, 'Flight path': flightPath, 'Trigger delay': delayOnTrigger,
+               'Time bin': timeBin, 'Minimum E': energyRange[0], 'Maximum E': energyRange[1]}
+
+        #materials table columns: Element Name, Abundance, Atomic Mass, Atomic Fraction, Density, Thickness, Component
+        Elements = []
+        for i in range(len(self.materialsInput)):
+            row = self.materialsInput.loc[i]
+            name = str(row[0]).strip().replace('.txt', '')
+            if name == '' or name == 'nan':
+                continue
+            Elements.append([name, row[1], row[3], row[4], row[2], row[5], row[6]])
+        ElemPar = pd.DataFrame(Elements, columns = ['Isotope Name', 'Abundance', 'AtomicFraction', 'Density (g/cm3)',
+                                                    'AtomicMass', 'Thickness (um)', 'GrupN'])
+        for column in ElemPar.columns[1:]:
+            ElemPar[column] = ElemPar[column].astype(float)
+        if len(ElemPar) == 0 or ElemPar.isnull().values.any():
+            raise ValueError("the materials table is empty or incomplete")
+        ElemPar['GrupN'] = ElemPar['GrupN'].astype(int)
+        ElemPar.sort_values(by = ['GrupN', 'Isotope Name'], inplace = True)
+        Par['Elmnts'] = ElemPar
+        return Par
+
+    def LiveMonitor(self, checked):
+        '''
+        Live spectrum of the selected rectangle, built up from the slices as they are loaded
+        The ROI and z range are read once when the monitor is switched on
+        '''
+        if not checked:
+            self.monitorTimer.stop()
+            #the button is also switched off when the monitor could not start, then nothing was connected
+            if self.monitorConnected:
+                self.imageviewer.sliceLoaded.disconnect(self.onSliceLoaded)
+                self.monitorConnected = False
+            return
+        try:
+            self.getUpdatedParameters()
         except:
-            convergeThread = plotLoader(ConvergePlot, self.canvas)
-            self.threadpool.start(convergeThread)
-            
-            self.error = Error("Sample Data Not Yet Selected for Plotting")
+            #no LiveMonitor(False) for a monitor which never started
+            self.monitorButton.blockSignals(True)
+            self.monitorButton.setChecked(False)
+            self.monitorButton.blockSignals(False)
+            self.error = Error("Select a region and beamline parameters before monitoring")
             self.error.show()
+            return
+
+        beam = None
+        beamTriggers = None
+        openbeam = getattr(self.imageviewer, 'openbeam_image_cube', None)
+        if openbeam is not None and len(openbeam) > self.z_end:
+            beam = [np.sum((openbeam[sliceNum])[self.ymin:self.ymax, self.xmin:self.xmax]) for sliceNum in range(self.z_start, self.z_end + 1)]
+            beamTriggers = self.imageviewer.openbeam_Ntrigs[self.z_start:self.z_end + 1]
+        self.monitorBuffer = SpectrumRingBuffer(self.z_end - self.z_start + 1, beam, beamTriggers,
+                                                (self.xmin, self.xmax, self.ymin, self.ymax), self.z_start, self.delayOnTrigger)
+
+        self.plot.set_line('monitor', self.monitorBuffer.tof, self.monitorBuffer.display, 'g.-')
+        self.plot.show_only(['monitor'])
+        self.plot.set_labels('Live Spectrum', 'TOF (us)', 'Counts' if beam is None else 'Transmission')
+        self.plot.update(rescale = True)
+
+        self.imageviewer.sliceLoaded.connect(self.onSliceLoaded)
+        self.monitorConnected = True
+        self.monitorTimer.start()
+
+    @pyqtSlot(int, float, object)
+    def onSliceLoaded(self, sliceNum, tof, image):
+        #Only the ROI sum of the new slice is computed here, drawing is left to the timer
+        #The ROI, z range and delay are the ones of the buffer, i.e. of when the monitor was started
+        buffer = self.monitorBuffer
+        if buffer is None or not (buffer.z_start <= sliceNum <= buffer.z_end):
+            return
+        xmin, xmax, ymin, ymax = buffer.roi
+        value = np.sum(image[ymin:ymax, xmin:xmax])
+        #with an open beam the sums are per trigger, as in sumROI (backcoef = openbeam_Ntrigs / Ntrigs)
+        triggers = self.imageviewer.Ntrigs[sliceNum] if buffer.normalized else 1
+        buffer.push(sliceNum - buffer.z_start, tof + buffer.delay, value, triggers)
+
+    def updateMonitor(self):
+        if self.monitorBuffer is None or not self.monitorBuffer.dirty:
+            return
+        self.monitorBuffer.dirty = False
+        #same preallocated arrays every time, the plot blits unless the data left the view
+        self.plot.set_line('monitor', self.monitorBuffer.tof, self.monitorBuffer.display)
+        self.plot.update()
 
     def center(self):
         qr = self.frameGeometry()
@@ -237,7 +488,8 @@ class Spectrum(QtWidgets.QWidget):
         '''
 
         '''IMAGEVIEWER INPUT'''
-        self.imageviewerInput = self.imageviewer.saveInput() #imageviwerInput = [[xmin, xmax], [ymin, ymax], [z_start, z_end], z, backcoef, self.sumImageCube]
+        #Only the widget values are read here (GUI thread); the ROI sums are done by computeROI on the thread pool
+        self.imageviewerInput = self.imageviewer.readInput() #imageviwerInput = [[xmin, xmax], [ymin, ymax], [z_start, z_end], z, flightpath, delayontrigger]
 
         self.xmin = self.imageviewerInput[0][0]
         self.xmax = self.imageviewerInput[0][1]
@@ -246,10 +498,6 @@ class Spectrum(QtWidgets.QWidget):
         self.z_start = self.imageviewerInput[2][0]
         self.z_end = self.imageviewerInput[2][1]
         self.z = self.imageviewerInput[3]
-        self.backcoef = self.imageviewerInput[4]
-        self.sum_image_data = self.imageviewerInput[5]
-        self.TOF = self.imageviewerInput[6]
-        self.E = self.imageviewerInput[7]
 
 
 
@@ -259,7 +507,12 @@ class Spectrum(QtWidgets.QWidget):
         self.flightPath =  self.beamlineInput[0] #1 Flight Path: L (meters)
         self.delayOnTrigger = self.beamlineInput[1] #2 Delay on trigger: dT (miliseconds)
         self.energyRange = self.beamlineInput[2] #3 Minimum and Maximum Energy Range (eV)
-        
+
+        #TOF axis of the loaded slices, built here on the GUI thread and handed to the workers through roiArgs
+        self.tofAxis = None
+        if getattr(self.imageviewer, 'TOF', None) is not None:
+            self.tofAxis = self.imageviewer.tofAxis(self.flightPath, self.delayOnTrigger)
+
 
 
         '''MATERIALS INPUT'''
@@ -302,7 +555,6 @@ class Spectrum(QtWidgets.QWidget):
         pandasFrame.loc[5, 3] = beamlineArray[3]
         pandasFrame.loc[5, 4] = beamlineArray[4]
         pandasFrame.loc[5, 5] = beamlineArray[5]
-        pandasFrame.loc[5, 6] = beamlineArray[6]
         pandasFrame.to_csv(fileName, index = False)
 
     def load_csv(self):
@@ -0,0 +1,174 @@
+#SpectrumPlot is the plotting layer used by Spectrum
+#Instead of clearing the figure and re-creating subplots on every button press, it keeps one set of axes
+#and one Line2D per named curve around. New data goes in with set_data and the lines and the title are blitted,
+#a full redraw of the canvas (ticks, labels...) only happens when the axis limits or the axis labels actually change.
+#Long curves are drawn decimated to the current view (see minmax_decimate), roughly two points per screen pixel.
+
+import numpy as np
+from matplotlib.transforms import Bbox
+
+#---------------------------------------------------------------------------------
+# Min/max level-of-detail decimation of a curve for the x view [xmin, xmax]
+# The points inside the view are split into n_bins consecutive chunks and only the
+# minimum and the maximum of every chunk are kept (in their original order), so narrow
+# resonance dips survive no matter how many points are dropped.
+# x has to be monotonic; returns the decimated x, y arrays
+#---------------------------------------------------------------------------------
+def minmax_decimate(x, y, xmin, xmax, n_bins):
+    x = np.asarray(x, dtype = float)
+    y = np.asarray(y, dtype = float)
+    if len(x) > 1 and x[0] > x[-1]: #e.g. energy computed from TOF is descending
+        x = x[::-1]
+        y = y[::-1]
+
+    #keep one point on each side of the view so the line runs up to the axes edges
+    i0 = max(np.searchsorted(x, xmin, side = 'left') - 1, 0)
+    i1 = min(np.searchsorted(x, xmax, side = 'right') + 1, len(x))
+    x = x[i0:i1]
+    y = y[i0:i1]
+
+    n_bins = max(int(n_bins), 1)
+    if len(x) <= 2 * n_bins:
+        return x, y
+
+    chunk = -(-len(x) // n_bins) #ceil division
+    n_bins = -(-len(x) // chunk)
+    pad = n_bins * chunk - len(x)
+    #pad the last chunk with its own last value, that never changes its min or max
+    blocks = np.pad(y, (0, pad), mode = 'edge').reshape(n_bins, chunk)
+    offsets = np.arange(n_bins) * chunk
+    imin = np.minimum(np.nanargmin(np.nan_to_num(blocks, nan = np.inf), axis = 1) + offsets, len(x) - 1)
+    imax = np.minimum(np.nanargmax(np.nan_to_num(blocks, nan = -np.inf), axis = 1) + offsets, len(x) - 1)
+    keep = np.sort(np.stack([imin, imax], axis = 1), axis = 1).ravel()
+    #always keep the end points
+    keep = np.unique(np.concatenate(([0], keep, [len(x) - 1])))
+    return x[keep], y[keep]
+
+class SpectrumPlot:
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.figure = canvas.figure
+        self.ax = self.figure.subplots()
+        self.lines = {} #name -> Line2D, created once and then only updated
+        self.data = {} #name -> full resolution (x, y); the Line2D only holds the decimated view of it
+        self.background = None
+        self.blit_box = None
+        #the title changes with every fit step, it is blitted with the lines instead of forcing a full draw
+        self.ax.title.set_animated(True)
+
+        #every full draw (resize, toolbar zoom, rescale) invalidates the saved background
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        #decimation only has to be redone when the view changes (zoom / pan)
+        self.ax.callbacks.connect('xlim_changed', self.on_xlim_changed)
+
+    def set_labels(self, title = None, xlabel = None, ylabel = None):
+        if title is not None:
+            self.ax.set_title(title)
+        if xlabel is not None and xlabel != self.ax.get_xlabel():
+            self.ax.set_xlabel(xlabel)
+            self.background = None #outside of what is blitted
+        if ylabel is not None and ylabel != self.ax.get_ylabel():
+            self.ax.set_ylabel(ylabel)
+            self.background = None
+
+    def set_line(self, name, x, y, fmt = '-', **kwargs):
+        '''
+        Updates the curve called name with new x, y data; the Line2D is only created the first time
+        fmt and kwargs are the usual matplotlib plot style arguments and are only used on creation
+        '''
+        self.data[name] = (x, y)
+        xd, yd = self.decimated(name)
+        if name in self.lines:
+            line = self.lines[name]
+            line.set_data(xd, yd)
+            line.set_visible(True)
+        else:
+            line, = self.ax.plot(xd, yd, fmt, animated = True, **kwargs)
+            self.lines[name] = line
+        return line
+
+    def decimated(self, name, xlim = None):
+        #The part of curve name visible in xlim (default: current view), decimated to the axes width in pixels
+        x, y = self.data[name]
+        x = np.asarray(x, dtype = float)
+        y = np.asarray(y, dtype = float)
+        if len(x) < 2 or np.isnan(x).any() or np.any(np.diff(x) > 0) and np.any(np.diff(x) < 0):
+            return x, y #not monotonic or with gaps, nothing sensible to decimate
+        if xlim is None:
+            xlim = self.ax.get_xlim()
+        return minmax_decimate(x, y, min(xlim), max(xlim), self.ax.bbox.width)
+
+    def on_xlim_changed(self, ax):
+        for name, line in self.lines.items():
+            line.set_data(*self.decimated(name))
+
+    def show_only(self, names):
+        #Hides the curves of the other plotting modes without deleting their artists
+        for name, line in self.lines.items():
+            line.set_visible(name in names)
+
+    def needs_rescale(self, shrink = False):
+        '''
+        True if some visible data falls outside of the current view
+        shrink = True also when the visible data fills less than half of the view along x or y
+        '''
+        bounds = []
+        for name, line in self.lines.items():
+            if not line.get_visible():
+                continue
+            x = np.asarray(self.data[name][0], dtype = float)
+            y = np.asarray(self.data[name][1], dtype = float)
+            good = np.isfinite(x) & np.isfinite(y)
+            if good.any():
+                bounds.append((x[good].min(), x[good].max(), y[good].min(), y[good].max()))
+        if not bounds:
+            return False
+        bounds = np.array(bounds)
+        x0, x1, y0, y1 = bounds[:, 0].min(), bounds[:, 1].max(), bounds[:, 2].min(), bounds[:, 3].max()
+        xmin, xmax = sorted(self.ax.get_xlim())
+        ymin, ymax = sorted(self.ax.get_ylim())
+        if x0 < xmin or x1 > xmax or y0 < ymin or y1 > ymax:
+            return True
+        return shrink and (x1 - x0 < 0.5 * (xmax - xmin) or y1 - y0 < 0.5 * (ymax - ymin))
+
+    def update(self, rescale = None):
+        '''
+        Pushes the new line data onto the screen
+        The axis limits (and so a full redraw) only change when the data left the current view; with
+        rescale = True (e.g. a new dataset) also when the data became much smaller than the view.
+        Otherwise only the lines and the title are blitted.
+        '''
+        if self.background is None or self.needs_rescale(shrink = bool(rescale)):
+            #relim has to see the whole curves, the new view then re-decimates through on_xlim_changed
+            for name, line in self.lines.items():
+                x = np.asarray(self.data[name][0], dtype = float)
+                if np.isfinite(x).any():
+                    line.set_data(*self.decimated(name, (np.nanmin(x), np.nanmax(x))))
+            self.ax.relim(visible_only = True)
+            self.ax.autoscale_view()
+            #the full draw triggers on_draw, which saves the background and blits the lines
+            self.canvas.draw_idle()
+        else:
+            self.blit()
+
+    def blit(self):
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_lines()
+        self.canvas.blit(self.blit_box)
+
+    def draw_lines(self):
+        for line in self.lines.values():
+            if line.get_visible():
+                self.ax.draw_artist(line)
+        self.ax.draw_artist(self.ax.title)
+
+    def on_draw(self, event):
+        #The animated lines and title are not part of a normal draw, so this is the clean background to restore from
+        #the axes plus the strip above them, where the title goes
+        box = self.ax.bbox
+        self.blit_box = Bbox.from_extents(box.x0, box.y0, box.x1, self.figure.bbox.y1)
+        self.background = self.canvas.copy_from_bbox(self.blit_box)
+        self.draw_lines()
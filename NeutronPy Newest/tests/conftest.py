@@ -0,0 +1,5 @@
+# The modules of NeutronPy Newest import each other by plain name, as when run from that directory
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
@@ -0,0 +1,35 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import BeamProfileLibrary as bpl
+
+# a small table, quick to calculate
+GRID = dict(Emin=1.0, Emax=100.0, PointsPerDecade=50)
+
+
+def BuildTable(CacheDir):
+    return np.array(bpl.BeamProfileTable(16, CacheDir=CacheDir, **GRID).Amp)
+
+
+def test_table_is_saved_and_loaded(tmp_path):
+    Built = bpl.BeamProfileTable(16, CacheDir=str(tmp_path), **GRID)
+    assert os.listdir(tmp_path) == ['BeamProfiles_' + Built.Key() + '.npy']
+    Loaded = bpl.BeamProfileTable(16, CacheDir=str(tmp_path), **GRID)
+    assert isinstance(Loaded.Amp, np.memmap)
+    np.testing.assert_array_equal(Loaded.Amp, Built.Amp)
+    T, Amp = Loaded.Kernels(0.6, [2.0, 50.0])
+    np.testing.assert_allclose(Amp.sum(axis=1), 1.0)
+
+
+def test_concurrent_creation(tmp_path):
+    # pool workers all building the same table on first use must not break each other
+    Reference = BuildTable(None)
+    for trial in range(3):
+        CacheDir = str(tmp_path / str(trial))
+        with ProcessPoolExecutor(max_workers=8) as Pool:
+            Tables = list(Pool.map(BuildTable, [CacheDir] * 8))
+        for Table in Tables:
+            np.testing.assert_array_equal(Table, Reference)
+        # only the table is left, no temporary files
+        assert len(os.listdir(CacheDir)) == 1
+        np.testing.assert_array_equal(BuildTable(CacheDir), Reference)
@@ -0,0 +1,74 @@
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+import numpy as np
+import CrossSectionLibrary as csl
+
+
+def test_na23_header_with_space_is_a_cross_section():
+    # Na-23.txt has "E (MeV)" as the first column header
+    assert csl.IsCrossSectionFile(path.join(csl.CROSS_SECTION_DIR, 'Na-23.txt'))
+    assert not csl.IsCrossSectionFile(path.join(csl.CROSS_SECTION_DIR, 'BeamProfile_10eV.txt'))
+
+
+def test_na23_is_compiled_into_the_library(tmp_path):
+    SourceDir = tmp_path / 'sources'
+    SourceDir.mkdir()
+    for FileName in ['Na-23.txt', 'Ta-181.txt', 'BeamProfile_10eV.txt']:
+        shutil.copy(path.join(csl.CROSS_SECTION_DIR, FileName), SourceDir)
+    Library = csl.CrossSectionLibrary(str(tmp_path / 'Library.npy'), str(SourceDir))
+    assert sorted(Library.Names()) == ['Na-23', 'Ta-181']
+    Earr, Sarr = Library.Get('Na-23')
+    assert len(Earr) > 0 and len(Earr) == len(Sarr)
+
+
+def CopySources(tmp_path, FileNames):
+    SourceDir = tmp_path / 'sources'
+    SourceDir.mkdir()
+    for FileName in FileNames:
+        shutil.copy(path.join(csl.CROSS_SECTION_DIR, FileName), SourceDir)
+    return SourceDir
+
+
+def test_clean_open_reads_nothing_and_prints_nothing(tmp_path, capsys):
+    SourceDir = CopySources(tmp_path, ['Na-23.txt', 'BeamProfile_10eV.txt'])
+    LibraryFile = str(tmp_path / 'Library.npy')
+    csl.CrossSectionLibrary(LibraryFile, str(SourceDir))
+    assert 'Skipping BeamProfile_10eV.txt' in capsys.readouterr().out
+    csl.CrossSectionLibrary(LibraryFile, str(SourceDir))
+    assert capsys.readouterr().out == ''
+
+
+def test_changed_source_is_recompiled(tmp_path):
+    SourceDir = CopySources(tmp_path, ['Na-23.txt', 'Ta-181.txt'])
+    LibraryFile = str(tmp_path / 'Library.npy')
+    Earr, Sarr = csl.CrossSectionLibrary(LibraryFile, str(SourceDir)).Get('Na-23')
+    Na23 = (np.array(Earr), np.array(Sarr))
+
+    # Ta-181 is cut to its first rows, Na-23 has to come out of the old library unchanged
+    TaFile = SourceDir / 'Ta-181.txt'
+    Lines = TaFile.read_text().splitlines(True)
+    TaFile.write_text(''.join(Lines[:11]))
+    Library = csl.CrossSectionLibrary(LibraryFile, str(SourceDir))
+    assert len(Library.Get('Ta-181')[0]) <= 10
+    np.testing.assert_array_equal(Library.Get('Na-23')[0], Na23[0])
+    np.testing.assert_array_equal(Library.Get('Na-23')[1], Na23[1])
+
+    # a removed source leaves the library too
+    os.remove(str(TaFile))
+    assert csl.CrossSectionLibrary(LibraryFile, str(SourceDir)).Names() == ['Na-23']
+
+
+def OpenLibrary(Args):
+    return csl.CrossSectionLibrary(*Args).Names()
+
+
+def test_concurrent_compile(tmp_path):
+    # processes opening an out of date library at the same time all compile it, none may fail
+    SourceDir = CopySources(tmp_path, ['Na-23.txt', 'Ta-181.txt'])
+    LibraryFile = str(tmp_path / 'Library.npy')
+    with ProcessPoolExecutor(max_workers=8) as Pool:
+        Names = list(Pool.map(OpenLibrary, [(LibraryFile, str(SourceDir))] * 8))
+    assert all(sorted(n) == ['Na-23', 'Ta-181'] for n in Names)
+    assert sorted(os.listdir(tmp_path)) == ['Library.json', 'Library.npy', 'sources']
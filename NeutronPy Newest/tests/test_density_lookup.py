@@ -0,0 +1,53 @@
+from os import path
+import numpy as np
+import pytest
+import TransmissionCalc as tr
+import DensityLookup as dl
+
+PARAMETERS = path.join(path.dirname(path.dirname(path.realpath(__file__))), 'AntonCode', 'IsotopesToFit.txt')
+
+
+@pytest.fixture(scope='module')
+def Setup():
+    Par = tr.LoadParameters(PARAMETERS)
+    S = tr.LoadCrossSectionsData(Par)
+    Earr = tr.Get_E_Array_Adaptive(Par)
+    Texp = np.arange(40, 1000, 0.48)
+    Table = dl.BuildThicknessSweepTable(Par, Texp, Earr, S, Nsweep=64)
+    return Par, S, Earr, Texp, Table
+
+
+def test_inversion_recovers_the_thickness(Setup):
+    Par, S, Earr, Texp, Table = Setup
+    Labels, D, p0 = tr.DensityParametrization(Par['Elmnts'])
+    G = D @ tr.BuildCrossSectionMatrix(S, list(Par['Elmnts']['Isotope Name']), Earr)
+    R, ExpMask = tr.GetResolutionMatrixCache().Get(Par, Earr, Texp, tr.BEAM_ARR_DIM, tr.NsubCells,
+                                                   tr.CalcIdealTransmissionMatrix(G, np.outer(tr.TrialFactors, p0)))
+    # a 2 x 3 image cube with a different thickness in every pixel, the full TOF array of the data first
+    Thickness = np.array([[0.5, 1.0, 1.5], [2.0, 2.5, 3.0]]) * p0[0]
+    Cube = np.ones((len(Texp),) + Thickness.shape)
+    Cube[ExpMask] = (R @ tr.CalcIdealTransmissionMatrix(G, Thickness.reshape(-1, 1)).T).reshape((-1,) + Thickness.shape)
+    np.testing.assert_allclose(Table.Invert(0, Cube), Thickness, rtol=2e-3)
+    # outside of the sweep
+    assert np.isnan(Table.Invert(Labels[0], np.full_like(Cube, 1.01))).all()
+
+
+def test_save_and_load_round_trip(Setup, tmp_path):
+    Table = Setup[-1]
+    FileName = str(tmp_path / 'Table.npz')
+    Table.Save(FileName)
+    Loaded = dl.ThicknessSweepTable.Load(FileName)
+    assert Loaded.Labels == Table.Labels
+    np.testing.assert_array_equal(Loaded.Sweeps, Table.Sweeps)
+    np.testing.assert_array_equal(Loaded.ExpIndex, Table.ExpIndex)
+    for Window, LoadedWindow in zip(Table.Windows, Loaded.Windows):
+        np.testing.assert_array_equal(LoadedWindow, Window)
+    np.testing.assert_allclose(Loaded.Signals, Table.Signals, rtol=1e-6)
+    assert Loaded.WindowRanges() == Table.WindowRanges()
+
+
+def test_no_experimental_points_is_a_clear_error(Setup):
+    Par, S, Earr, Texp, Table = Setup
+    # all the points far beyond the longest TOF of the model
+    with pytest.raises(ValueError, match='None of the experimental points'):
+        dl.BuildThicknessSweepTable(Par, np.arange(5000, 6000, 0.48), Earr, S, Nsweep=8)
@@ -0,0 +1,62 @@
+from os import path
+import numpy as np
+import pytest
+import TransmissionCalc as tr
+from EnsembleSampler import EnsembleSampler, SampleArealDensities
+
+PARAMETERS = path.join(path.dirname(path.dirname(path.realpath(__file__))), 'AntonCode', 'IsotopesToFit.txt')
+
+
+def test_sampler_recovers_a_correlated_gaussian(tmp_path):
+    Mean = np.array([1.0, -2.0])
+    Cov = np.array([[1.0, 0.8], [0.8, 2.0]])
+    Inv = np.linalg.inv(Cov)
+
+    def LogProb(P):
+        d = P - Mean
+        return -0.5 * np.einsum('ij,jk,ik->i', d, Inv, d)
+
+    Sampler = EnsembleSampler(LogProb, 32, 2, Seed=1)
+    P0 = Mean + 0.1 * np.random.default_rng(0).standard_normal((32, 2))
+    ChainFile = str(tmp_path / 'Chain.npy')
+    Chain, LogProbs, AcceptanceFraction = Sampler.Run(P0, 2000, ChainFile, Thin=2)
+    assert Chain.shape == (1000, 32, 2) and LogProbs.shape == (1000, 32)
+    assert 0.2 < AcceptanceFraction.mean() < 0.9
+
+    Flat = np.asarray(Chain[200:]).reshape(-1, 2)
+    np.testing.assert_allclose(Flat.mean(axis=0), Mean, atol=0.15)
+    np.testing.assert_allclose(np.cov(Flat.T), Cov, atol=0.3)
+    # the chain on disk is the returned one
+    np.testing.assert_array_equal(np.load(ChainFile), Chain)
+    np.testing.assert_array_equal(np.load(str(tmp_path / 'Chain_logprob.npy')), LogProbs)
+
+
+def test_sampler_rejects_bad_start():
+    with pytest.raises(Exception):
+        EnsembleSampler(lambda P: np.zeros(len(P)), 5, 2)
+    Sampler = EnsembleSampler(lambda P: np.where(P[:, 0] > 0, 0.0, -np.inf), 4, 1)
+    with pytest.raises(Exception):
+        Sampler.Run(-np.ones((4, 1)), 10)
+
+
+def test_areal_density_posterior_brackets_the_truth():
+    Par = tr.LoadParameters(PARAMETERS)
+    S = tr.LoadCrossSectionsData(Par)
+    Earr = tr.Get_E_Array_Adaptive(Par)
+    Labels, D, p0 = tr.DensityParametrization(Par['Elmnts'])
+    G = D @ tr.BuildCrossSectionMatrix(S, list(Par['Elmnts']['Isotope Name']), Earr)
+    Texp = np.arange(40, 1000, 0.48)
+    R, ExpMask = tr.GetResolutionMatrixCache().Get(Par, Earr, Texp, tr.BEAM_ARR_DIM, tr.NsubCells,
+                                                   tr.CalcIdealTransmissionMatrix(G, np.outer(tr.TrialFactors, p0)))
+    # the model at 1.2 times the nominal densities with 1% noise, outside of the model range left at 1
+    Truth = 1.2 * p0
+    TrExp = np.ones(len(Texp))
+    TrExp[ExpMask] = R @ tr.CalcIdealTransmissionMatrix(G, Truth) + 0.01 * np.random.default_rng(2).standard_normal(ExpMask.sum())
+
+    Result = SampleArealDensities(Par, Texp, TrExp, Earr, S, Nwalkers=16, Nsteps=400, Seed=3)
+    assert Result['Chain'].shape == (400, 16, len(p0))
+    assert Result['Labels'] == Labels
+    Low, High = Result['Interval'].T
+    Width = High - Low
+    assert np.all(Width > 0)
+    assert np.all(np.abs(Result['Median'] - Truth) < 3 * Width)
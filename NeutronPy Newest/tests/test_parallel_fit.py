@@ -0,0 +1,31 @@
+from os import path
+import numpy as np
+import TransmissionCalc as tr
+import ParallelFit as pf
+
+PARAMETERS = path.join(path.dirname(path.dirname(path.realpath(__file__))), 'AntonCode', 'IsotopesToFit.txt')
+
+
+def test_landscape_minimum_and_out_of_range_rows():
+    Par = tr.LoadParameters(PARAMETERS)
+    S = tr.LoadCrossSectionsData(Par)
+    Earr = tr.Get_E_Array_Adaptive(Par)
+    Labels, D, p0 = tr.DensityParametrization(Par['Elmnts'])
+    G = D @ tr.BuildCrossSectionMatrix(S, list(Par['Elmnts']['Isotope Name']), Earr)
+    TrIdeal = tr.CalcIdealTransmissionMatrix(G, p0)
+    # the measurement is the model at the nominal L, dT
+    Texp = np.arange(40, 1000, 0.48)
+    TrConv, Tmax = tr.ConvolveTrWithPulseProfile(Par, Earr, TrIdeal, tr.BEAM_ARR_DIM)
+    Texp1, TrExp1, TrTheor = tr.CalcTheorForExpPoints(Par, Texp, np.ones(len(Texp)), TrConv, Tmax, tr.NsubCells)
+    TrExp = np.ones(len(Texp))
+    TrExp[np.isin(Texp, Texp1)] = TrTheor
+
+    L, dT = Par['Flight path'], Par['Trigger delay']
+    # at a hundredth of the flight path the model ends before the first measured TOF
+    Larr = np.array([L - 0.02, L, L + 0.02, L / 100])
+    dTarr = np.array([dT - 0.5, dT, dT + 0.5])
+    Landscape = pf.CalcChiSqLandscape(Par, Texp, TrExp, Earr, TrIdeal, Larr, dTarr, Workers=1)
+    assert Landscape.shape == (4, 3)
+    assert np.all(np.isinf(Landscape[3]))
+    assert np.all(np.isfinite(Landscape[:3]))
+    assert np.unravel_index(np.argmin(Landscape), Landscape.shape) == (1, 1)
@@ -0,0 +1,28 @@
+from os import path
+import numpy as np
+import TransmissionCalc as tr
+
+PARAMETERS = path.join(path.dirname(path.dirname(path.realpath(__file__))), 'AntonCode', 'IsotopesToFit.txt')
+
+
+def test_resolution_matrix_matches_convolution_on_adaptive_grid():
+    # the adaptive grid is sparse between resonances, where the convolved curve still has structure:
+    # the matrix has to be built on the same refined TOF grid as ConvolveTrWithPulseProfile
+    Par = tr.LoadParameters(PARAMETERS)
+    S = tr.LoadCrossSectionsData(Par)
+    Earr = tr.Get_E_Array_Adaptive(Par)
+    Labels, D, p0 = tr.DensityParametrization(Par['Elmnts'])
+    G = D @ tr.BuildCrossSectionMatrix(S, list(Par['Elmnts']['Isotope Name']), Earr)
+    Texp = np.arange(40, 1000, 0.48)
+
+    TrTrial = tr.CalcIdealTransmissionMatrix(G, np.outer(tr.TrialFactors, p0))
+    R, ExpMask = tr.BuildResolutionMatrix(Par, Earr, Texp, tr.BEAM_ARR_DIM, tr.NsubCells, TrTrial)
+    for Factor in [0.5, 1, 2]:
+        TrIdeal = tr.CalcIdealTransmissionMatrix(G, Factor * p0)
+        TrConvld, Tmax = tr.ConvolveTrWithPulseProfile(Par, Earr, TrIdeal, tr.BEAM_ARR_DIM)
+        Texp1, TrExp1, TrTheor = tr.CalcTheorForExpPoints(Par, Texp, np.ones(len(Texp)), TrConvld, Tmax, tr.NsubCells)
+        Common = np.isin(Texp[ExpMask], Texp1)
+        assert Common.sum() > 0.9 * len(Texp1)
+        Matrix = (R @ TrIdeal)[Common]
+        Reference = TrTheor[np.isin(Texp1, Texp[ExpMask])]
+        assert np.max(np.abs(Matrix - Reference)) < 1e-3
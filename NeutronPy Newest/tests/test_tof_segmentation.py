@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import TransmissionCalc as tr
+from TOFAxis import TOFAxis
+
+
+def test_uniform_binning_is_one_segment():
+    Texp = 10 + 0.32 * np.arange(100)
+    Starts, Widths, Index = tr.SegmentTOFArray(Texp)
+    np.testing.assert_array_equal(Starts, [0])
+    np.testing.assert_allclose(Widths, [0.32])
+    assert np.all(Index == 0)
+    np.testing.assert_allclose(tr.CalcTbinArray(Texp), 0.32)
+
+
+def test_readout_gaps_and_bin_changes():
+    # 0.32 us bins, a readout gap, the same bins again, then 0.64 us bins without a gap;
+    # the bin of a point is the spacing to its right, so the last 0.32 us point already has a 0.64 us bin
+    A = 10 + 0.32 * np.arange(50)
+    B = A[-1] + 5 + 0.32 * np.arange(50)
+    C = B[-1] + 0.64 * np.arange(1, 51)
+    Texp = np.concatenate((A, B, C))
+    Starts, Widths, Index = tr.SegmentTOFArray(Texp)
+    np.testing.assert_array_equal(Starts, [0, 50, 99])
+    np.testing.assert_allclose(Widths, [0.32, 0.32, 0.64])
+    np.testing.assert_array_equal(np.bincount(Index), [50, 49, 51])
+    np.testing.assert_allclose(tr.CalcTbinArray(Texp), np.repeat([0.32, 0.32, 0.64], [50, 49, 51]))
+
+
+def test_slightly_varying_bins_stay_in_one_segment():
+    # Spectra.txt has a limited number of digits, the spacings jitter by much less than RelTol
+    rng = np.random.default_rng(0)
+    Texp = np.cumsum(10.24 * (1 + 0.01 * rng.uniform(-1, 1, 200)))
+    Starts, Widths, Index = tr.SegmentTOFArray(Texp)
+    np.testing.assert_array_equal(Starts, [0])
+    assert abs(Widths[0] - 10.24) < 0.05
+
+
+def test_bad_tof_arrays_are_rejected():
+    with pytest.raises(Exception):
+        tr.SegmentTOFArray(np.array([1.0, 2.0]))
+    with pytest.raises(Exception):
+        tr.SegmentTOFArray(np.array([1.0, 3.0, 2.0, 4.0]))
+    # the binning changes every other point
+    with pytest.raises(Exception):
+        tr.CalcTbinArray(np.cumsum(np.tile([1.0, 1.0, 3.0, 3.0], 10)))
+
+
+def test_tof_axis_keeps_the_bins_when_the_delay_changes():
+    Raw = np.concatenate((10 + 0.32 * np.arange(50), 30 + 0.32 * np.arange(50)))
+    Axis = TOFAxis(Raw, 14.25, Delay=2.0)
+    np.testing.assert_allclose(Axis.TOF, Raw + 2.0)
+    Tbin = Axis.Tbin
+    Moved = Axis.Replace(Delay=3.0)
+    assert Moved.Tbin is Tbin
+    np.testing.assert_allclose(Moved.TOF, Raw + 3.0)
+    assert Axis.Replace(Delay=2.0) is Axis
+    with pytest.raises(AttributeError):
+        Axis.Delay = 1.0
+    with pytest.raises(ValueError):
+        Axis.TOF[0] = 0